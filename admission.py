@@ -0,0 +1,133 @@
+# admission.py
+import threading
+import time
+
+class RequestAborted(RuntimeError):
+    """The request stopped before finishing; on the engine it was aborted and its KV blocks freed"""
+
+    reason = "aborted"
+    default_message = "Request aborted"
+
+    def __init__(self, message=None, partial_text=""):
+        super().__init__(message or self.default_message)
+        self.partial_text = partial_text
+
+class DeadlineExceeded(RequestAborted):
+    reason = "deadline"
+    default_message = "Request deadline exceeded"
+
+class RequestCancelled(RequestAborted):
+    reason = "cancelled"
+    default_message = "Request cancelled"
+
+def aborted_error(reason, partial_text=""):
+    error = DeadlineExceeded if reason == "deadline" else RequestCancelled
+    return error(partial_text=partial_text)
+
+class RequestShed(RuntimeError):
+    """Turned away by admission control before reaching the engine"""
+
+    def __init__(self, reason, projected_wait):
+        super().__init__(f"Server overloaded ({reason}): projected wait {projected_wait:.1f}s")
+        self.reason = reason
+        self.projected_wait = projected_wait
+
+class RequestControl:
+    """Deadline and cancellation flag for one request, checked by the engine loop after every step.
+
+    ``timeout`` is seconds from now; ``cancel()`` may be called from any
+    thread, e.g. when the client disconnects.
+    """
+
+    def __init__(self, timeout=None):
+        self.deadline = time.perf_counter() + timeout if timeout else None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def remaining(self, now=None):
+        if self.deadline is None:
+            return None
+        return self.deadline - (now or time.perf_counter())
+
+    def abort_reason(self, now=None):
+        """"cancelled", "deadline" or None while the request may keep running"""
+        if self._cancelled.is_set():
+            return "cancelled"
+        if self.deadline is not None and (now or time.perf_counter()) >= self.deadline:
+            return "deadline"
+        return None
+
+class AdmissionController:
+    """Token-budget admission for one request queue.
+
+    A request costs its prompt tokens plus ``max_tokens``, held from
+    admission until it finishes. Its projected wait is the outstanding cost
+    ahead of it over the measured service rate (cost per second, smoothed
+    over finished requests). A request is shed when the outstanding cost
+    would pass ``max_queued_tokens``, when its projected wait passes
+    ``max_wait`` seconds, or when it could not finish before its deadline.
+    Until the first request is measured only the token budget applies.
+    """
+
+    def __init__(self, max_queued_tokens=None, max_wait=None, smoothing=0.3):
+        self.max_queued_tokens = max_queued_tokens
+        self.max_wait = max_wait
+        self.smoothing = smoothing
+        self.outstanding = 0
+        self.service_rate = None
+        self.shed = {}
+
+    def projected_wait(self, cost=0):
+        if not self.service_rate:
+            return 0.0
+        return (self.outstanding + cost) / self.service_rate
+
+    def check(self, cost, deadline=None):
+        """Raise RequestShed if a request of ``cost`` tokens would be turned away"""
+        wait = self.projected_wait()
+        reason = None
+        if self.max_queued_tokens and self.outstanding and self.outstanding + cost > self.max_queued_tokens:
+            reason = "token_budget"
+        elif self.max_wait is not None and wait > self.max_wait:
+            reason = "projected_wait"
+        elif deadline is not None and time.perf_counter() + self.projected_wait(cost) > deadline:
+            reason = "deadline"
+            # Including its own cost: the wait that would have made it miss the deadline
+            wait = self.projected_wait(cost)
+        if reason is not None:
+            raise RequestShed(reason, wait)
+
+    def admit(self, cost, deadline=None):
+        try:
+            self.check(cost, deadline)
+        except RequestShed as e:
+            self.shed[e.reason] = self.shed.get(e.reason, 0) + 1
+            raise
+        self.outstanding += cost
+
+    def release(self, cost):
+        self.outstanding = max(self.outstanding - cost, 0)
+
+    def observe(self, cost, seconds):
+        """Fold ``cost`` tokens served in ``seconds`` into the service rate"""
+        if seconds <= 0 or cost <= 0:
+            return
+        rate = cost / seconds
+        if self.service_rate is None:
+            self.service_rate = rate
+        else:
+            self.service_rate += self.smoothing * (rate - self.service_rate)
+
+    def stats(self):
+        return {
+            'queued_tokens': self.outstanding,
+            'projected_wait': self.projected_wait(),
+            'service_rate': self.service_rate or 0.0,
+            'shed': dict(self.shed),
+        }
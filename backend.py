@@ -0,0 +1,213 @@
+# backend.py
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import threading
+
+# Default backend for create_engine(); "sim" runs everything on CPU
+BACKEND_ENV_VAR = "QWEN_BACKEND"
+SIM_CONFIG_ENV_VAR = "QWEN_SIM_CONFIG"
+# Engine settings from capacity_planner.py --apply
+ENGINE_CONFIG_ENV_VAR = "QWEN_ENGINE_CONFIG"
+DEFAULT_ENGINE_CONFIG = "./models/engine_config.json"
+# draft_model_path for prompt-lookup speculation: proposals copy n-grams from the context, no draft model
+NGRAM_PROPOSER = "[ngram]"
+# vLLM's default KV cache block size; prefix caching shares whole blocks only
+KV_BLOCK_SIZE = 16
+
+class InferenceBackend:
+    """Interface every generator, the scheduler, the benchmark and the UI drive a model through.
+
+    Implemented by engine.QwenEngine (vLLM on GPU) and
+    sim_engine.SimulatedEngine (deterministic CPU stand-in). Outputs follow
+    vLLM's RequestOutput shape: ``request_id``, ``outputs[0].text`` /
+    ``.token_ids``, ``finished`` and ``metrics``.
+
+    All calls other than ``session`` and ``metrics`` must happen inside a
+    ``session``: engines are not thread-safe and the session selects whether
+    speculation is on for the requests it runs.
+    """
+
+    name = "base"
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # Seconds spent in each phase of the last engine build (weight_load, graph_capture, ...)
+        self.startup_phases = {}
+        # {request_id: draft tokens proposed} for every request the last step() verified speculatively
+        self.last_step_proposals = {}
+        # Cumulative per-sequence verification steps, i.e. entries in last_step_proposals over all steps
+        self.spec_steps = 0
+        self._request_counter = itertools.count()
+
+    @property
+    def supports_speculation(self):
+        return False
+
+    @property
+    def model_identity(self):
+        """Everything besides the prompt and sampling params that decides the output text"""
+        return {'backend': self.name}
+
+    def next_request_id(self, prefix):
+        # Unique across every generator sharing this engine
+        return f"{prefix}-{next(self._request_counter)}"
+
+    @contextmanager
+    def session(self, speculative):
+        """Exclusive access to the engine with speculation on or off"""
+        with self.lock:
+            self._set_mode(speculative)
+            yield self
+
+    def _set_mode(self, speculative):
+        raise NotImplementedError
+
+    # -- Engine surface --------------------------------------------------
+
+    def make_sampling_params(self, **kwargs):
+        raise NotImplementedError
+
+    def get_tokenizer(self):
+        raise NotImplementedError
+
+    def add_request(self, request_id, prompt, sampling_params):
+        """Queue a prompt: text, or ``{'prompt_token_ids': [...]}`` to skip tokenization"""
+        raise NotImplementedError
+
+    def step(self):
+        """Run one engine iteration; returns outputs for every request it advanced.
+
+        Also sets ``last_step_proposals``: requests missing from it took a
+        plain (non-speculative) step, e.g. prefill or speculation disabled
+        by batch size.
+        """
+        raise NotImplementedError
+
+    def abort_request(self, request_ids):
+        raise NotImplementedError
+
+    def has_unfinished_requests(self):
+        raise NotImplementedError
+
+    def metrics(self):
+        """Point-in-time engine state (queue sizes, KV cache usage, mode)"""
+        raise NotImplementedError
+
+    @property
+    def active_speculation_length(self):
+        """Draft tokens per step for requests in the current session (0: no speculation)"""
+        return 0
+
+    def set_speculation_length(self, num_tokens):
+        """Change the draft length for the following steps; returns the length in effect.
+
+        0 turns speculation off. Call inside a speculative session.
+        """
+        return 0
+
+    def speculation_counters(self):
+        """Cumulative draft/accepted/emitted token and verification step counts, or None without speculation"""
+        return None
+
+    def shutdown(self):
+        pass
+
+    # -- Generate / stream built on the surface above --------------------
+
+    def stream(self, prompts, params_list, prefix="req", should_abort=None, more=None):
+        """Add requests and yield ``(index, output)`` for every update until all finish.
+
+        Closing the iterator early aborts whatever is still running so its
+        KV cache blocks are released. ``should_abort(index)`` is asked
+        before every engine step for each unfinished request; those it
+        returns true for are aborted the same way and yield nothing more.
+        ``more()`` is also polled before every step and returns further
+        ``(prompts, params_list)`` to add to the running set (continuous
+        batching); they take the next indices.
+        """
+        request_ids = []
+        index = {}
+        finished = set()
+
+        def add(prompts, params_list):
+            for prompt, params in zip(prompts, params_list):
+                request_id = self.next_request_id(prefix)
+                index[request_id] = len(request_ids)
+                request_ids.append(request_id)
+                self.add_request(request_id, prompt, params)
+
+        add(prompts, params_list)
+        try:
+            while True:
+                if more is not None:
+                    add(*more())
+                if len(finished) >= len(request_ids) or not self.has_unfinished_requests():
+                    break
+                if should_abort is not None:
+                    doomed = [i for i in range(len(request_ids)) if i not in finished and should_abort(i)]
+                    if doomed:
+                        self.abort_request([request_ids[i] for i in doomed])
+                        finished.update(doomed)
+                        continue
+                for output in self.step():
+                    i = index.get(output.request_id)
+                    if i is None:
+                        continue
+                    if output.finished:
+                        finished.add(i)
+                    yield i, output
+        finally:
+            unfinished = [rid for i, rid in enumerate(request_ids) if i not in finished]
+            if unfinished:
+                self.abort_request(unfinished)
+
+    def generate(self, prompts, params_list):
+        """Run prompts to completion; returns final outputs in prompt order"""
+        final_outputs = [None] * len(prompts)
+        for i, output in self.stream(prompts, params_list, prefix="gen"):
+            if output.finished:
+                final_outputs[i] = output
+        return final_outputs
+
+def describe_startup_phases(phases):
+    """One-line startup breakdown for logs, e.g. ``weight_load 41.2s, graph_capture 9.8s``"""
+    return ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in phases.items())
+
+def load_sim_config(path=None):
+    """Simulation settings from a JSON file (``path`` or $QWEN_SIM_CONFIG)"""
+    path = path or os.environ.get(SIM_CONFIG_ENV_VAR)
+    if not path:
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def load_engine_config(path=None):
+    """Planned engine settings from ``path``, $QWEN_ENGINE_CONFIG or ./models/engine_config.json"""
+    path = path or os.environ.get(ENGINE_CONFIG_ENV_VAR)
+    if not path:
+        if not os.path.exists(DEFAULT_ENGINE_CONFIG):
+            return {}
+        path = DEFAULT_ENGINE_CONFIG
+    with open(path) as f:
+        return json.load(f)
+
+def create_engine(backend=None, sim_config_path=None, **config):
+    """Build the engine for ``backend`` ("vllm" or "sim", default $QWEN_BACKEND or "vllm").
+
+    ``config`` takes QwenEngine's arguments (model paths,
+    num_speculative_tokens, gpu_memory_utilization, max_model_len); the
+    simulated engine accepts the same ones plus its own cost-model knobs.
+    Settings written by capacity_planner.py --apply fill in whatever
+    ``config`` leaves out.
+    """
+    backend = backend or os.environ.get(BACKEND_ENV_VAR, "vllm")
+    config = {**load_engine_config(), **config}
+    if backend == "vllm":
+        from engine import QwenEngine
+        return QwenEngine(**config)
+    if backend == "sim":
+        from sim_engine import SimulatedEngine
+        return SimulatedEngine(**{**load_sim_config(sim_config_path), **config})
+    raise ValueError(f"Unknown backend: {backend!r} (expected 'vllm' or 'sim')")
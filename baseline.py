@@ -1,49 +1,20 @@
 # baseline.py
-from vllm import LLM, SamplingParams
-import time
+from backend import create_engine, describe_startup_phases
+from generator_base import QwenGeneratorBase
 
-class BaselineGenerator:
-    def __init__(self, model_path="./models/target"):
-        print("🚀 Loading Qwen2.5-72B-AWQ (Baseline Mode)...")
-        print("This may take 1-2 minutes...")
+class BaselineGenerator(QwenGeneratorBase):
+    def __init__(self, model_path="./models/target", engine=None, cache=None, prompt_policy="reject"):
+        """Standard decoding; pass ``engine`` to share a target with the speculative generator"""
+        if engine is None:
+            print("🚀 Loading Qwen2.5-72B-AWQ (Baseline Mode)...")
+            print("This may take 1-2 minutes...")
+            
+            engine = create_engine(target_model_path=model_path)
+            
+            print("✅ Qwen2.5-72B-AWQ loaded successfully!")
+            print(f"   Startup: {describe_startup_phases(engine.startup_phases)}")
         
-        self.llm = LLM(
-            model=model_path,
-            tensor_parallel_size=1,
-            gpu_memory_utilization=0.75,  # Reduced to prevent OOM
-            max_model_len=2048,  # Reduced context length for better memory efficiency
-            trust_remote_code=True,  # Required for Qwen
-            quantization="awq",  # Use AWQ quantization to fit in 80GB
-            dtype="auto"
-        )
-        
-        self.sampling_params = SamplingParams(
-            temperature=0.7,
-            top_p=0.9,
-            max_tokens=256,
-            stop=["<|endoftext|>", "<|im_end|>"]  # Qwen-specific stop tokens
-        )
-        
-        print("✅ Qwen2.5-72B-AWQ loaded successfully!")
-    
-    def generate(self, prompt):
-        """Generate response with timing"""
-        # Format prompt for Qwen chat template
-        formatted_prompt = f"<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
-        
-        start_time = time.time()
-        outputs = self.llm.generate([formatted_prompt], self.sampling_params)
-        latency = time.time() - start_time
-        
-        output_text = outputs[0].outputs[0].text
-        num_tokens = len(outputs[0].outputs[0].token_ids)
-        
-        return {
-            'text': output_text.strip(),
-            'latency': latency,
-            'tokens': num_tokens,
-            'tokens_per_sec': num_tokens / latency if latency > 0 else 0
-        }
+        super().__init__(engine, speculative=False, cache=cache, prompt_policy=prompt_policy)
 
 # Test
 if __name__ == "__main__":
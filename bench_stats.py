@@ -0,0 +1,45 @@
+# bench_stats.py
+import random
+import statistics
+
+def percentile(values, pct):
+    """Linear-interpolated percentile (numpy's default method); ``pct`` in [0, 100]"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def latency_summary(values):
+    """Mean, spread and p50/p90/p99 of a list of latencies"""
+    if not values:
+        return {'n': 0}
+    return {
+        'n': len(values),
+        'mean': statistics.fmean(values),
+        'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'min': min(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values),
+    }
+
+def bootstrap_ci(items, statistic, samples=2000, confidence=0.95, seed=0):
+    """Point estimate and percentile-bootstrap confidence interval of ``statistic(items)``.
+
+    ``items`` are resampled with replacement as whole units, so paired
+    measurements (e.g. a baseline and speculative run of one trial) stay together.
+    """
+    point = statistic(items)
+    if len(items) < 2:
+        return point, point, point
+    rng = random.Random(seed)
+    estimates = sorted(
+        statistic([items[rng.randrange(len(items))] for _ in items])
+        for _ in range(samples)
+    )
+    tail = (1 - confidence) / 2 * 100
+    return point, percentile(estimates, tail), percentile(estimates, 100 - tail)
@@ -1,8 +1,17 @@
 # benchmark.py
 from baseline import BaselineGenerator
-from speculative import QwenSpeculativeGenerator
-import pandas as pd
+from speculative import (QwenSpeculativeGenerator, DEFAULT_NUM_SPECULATIVE_TOKENS, DEFAULT_NGRAM_PROMPT_LOOKUP_MAX,
+                         DEFAULT_NGRAM_PROMPT_LOOKUP_MIN, PROPOSERS)
+from spec_controller import AdaptiveSpeculationController
+from backend import BACKEND_ENV_VAR, NGRAM_PROPOSER, create_engine
+from bench_stats import bootstrap_ci, latency_summary
+from generator_base import LATENCY_PHASES, speculative_metrics
+from result_store import RESULTS_STORE, RunRecorder
+from worker_pool import LAYOUTS, WorkerPool
+from concurrent.futures import ThreadPoolExecutor
 import json
+import os
+import statistics
 import time
 
 # Enterprise-relevant prompts for CEO demo
@@ -17,103 +26,291 @@ DEMO_PROMPTS = [
     "Write a brief response to a customer asking about our return policy for enterprise software licenses."
 ]
 
-def run_comprehensive_benchmark():
+# Summarize/rewrite prompts whose answers copy spans of the prompt, where prompt lookup speculation shines
+RELEASE_NOTES = (
+    "Release 4.2 adds single sign-on for all enterprise workspaces, role-based access control for shared "
+    "dashboards, and audit logs that record every export of customer data. Dashboards now load up to 40% "
+    "faster because queries are cached per workspace. The legacy reporting API will be retired on June 30; "
+    "customers should migrate to the analytics API, which supports the same reports and adds scheduled "
+    "exports. Data residency is now available in the EU and Canada regions."
+)
+COPY_PROMPTS = [
+    f"Summarize these release notes in 3 bullet points, reusing their wording:\n\n{RELEASE_NOTES}",
+    f"Rewrite these release notes as a customer email, keeping every feature name and date exact:\n\n{RELEASE_NOTES}",
+    f"Fix any grammar issues and return the full corrected text:\n\n{RELEASE_NOTES}",
+    f"Extract every sentence that mentions customers, quoted verbatim:\n\n{RELEASE_NOTES}",
+]
+
+def load_generators(num_speculative_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS, backend=None,
+                    adaptive_speculation=False, speculation_log=None, engine_config=None, cache=None,
+                    prompt_policy="reject", proposer="draft",
+                    ngram_prompt_lookup_max=DEFAULT_NGRAM_PROMPT_LOOKUP_MAX,
+                    ngram_prompt_lookup_min=DEFAULT_NGRAM_PROMPT_LOOKUP_MIN):
+    """Baseline and speculative generators sharing one resident target engine.
+
+    ``proposer`` is "draft" (the Qwen2.5-7B draft model) or "ngram"
+    (prompt lookup, no draft weights). ``engine_config`` overrides
+    create_engine() arguments such as max_model_len or draft_model_path.
+    ``cache`` is an optional response_cache.ResponseCache shared by both
+    generators.
+    """
+    if proposer not in PROPOSERS:
+        raise ValueError(f"Unknown proposer {proposer!r} (expected one of {', '.join(PROPOSERS)})")
+    engine = create_engine(
+        backend,
+        **{
+            'target_model_path': "./models/target",
+            'draft_model_path': NGRAM_PROPOSER if proposer == "ngram" else "./models/draft",
+            'num_speculative_tokens': num_speculative_tokens,
+            'ngram_prompt_lookup_max': ngram_prompt_lookup_max,
+            'ngram_prompt_lookup_min': ngram_prompt_lookup_min,
+            **(engine_config or {})
+        }
+    )
+    if not engine.can_toggle_speculation:
+        print("⚠️  Engine cannot switch speculation per request; modes will swap the engine")
+    
+    controller = None
+    if adaptive_speculation:
+        controller = AdaptiveSpeculationController(max_tokens=num_speculative_tokens,
+                                                   log_path=speculation_log)
+    return (BaselineGenerator(engine=engine, cache=cache, prompt_policy=prompt_policy),
+            QwenSpeculativeGenerator(engine=engine, controller=controller, cache=cache,
+                                     prompt_policy=prompt_policy))
+
+def describe_engine(proposer="draft"):
+    """Models load_generators() puts on the GPU for ``proposer``"""
+    if proposer == "ngram":
+        return "Qwen2.5-72B-AWQ with n-gram prompt lookup"
+    return "Qwen2.5-7B → Qwen2.5-72B-AWQ"
+
+def phase_summary(results):
+    """latency_summary of every latency phase over the results that report it"""
+    summary = {}
+    for phase in LATENCY_PHASES:
+        values = [r['phases'][phase] for r in results
+                  if r.get('phases') and r['phases'].get(phase) is not None]
+        summary[phase] = latency_summary(values)
+    return summary
+
+def format_phases(phases):
+    parts = []
+    for phase in LATENCY_PHASES:
+        value = (phases or {}).get(phase)
+        if value is not None:
+            parts.append(f"{phase} {value * 1000:.1f}ms" if phase == 'tpot' else f"{phase} {value:.3f}s")
+    return " | ".join(parts) or "n/a"
+
+def print_phase_breakdown(summaries):
+    """Mean and p50 of each phase per mode; decode/TPOT is where speculation should win"""
+    modes = list(summaries)
+    print(f"\n🧩 Latency phases (mean / p50):")
+    for phase in LATENCY_PHASES:
+        cells = []
+        for mode in modes:
+            stats = summaries[mode][phase]
+            scale, unit = (1000, "ms") if phase == 'tpot' else (1, "s")
+            if stats['n']:
+                cells.append(f"{mode} {stats['mean'] * scale:.3f}{unit} / {stats['p50'] * scale:.3f}{unit}")
+            else:
+                cells.append(f"{mode} n/a")
+        first, last = summaries[modes[0]][phase], summaries[modes[-1]][phase]
+        if len(modes) > 1 and first['n'] and last['n'] and last['mean'] > 0:
+            cells.append(f"{first['mean'] / last['mean']:.2f}x")
+        print(f"   {phase:<8} " + " | ".join(cells))
+
+def phase_columns(prefix, result):
+    phases = result.get('phases') or {}
+    return {f'{prefix}_{phase}': round(phases[phase], 4) if phases.get(phase) is not None else None
+            for phase in LATENCY_PHASES}
+
+def run_config(generator, backend, **options):
+    """Configuration a run is recorded under in the results store"""
+    config = {'backend': backend or os.environ.get(BACKEND_ENV_VAR, "vllm"), **options}
+    engine = getattr(generator, 'engine', None)
+    if engine is not None:
+        config['model'] = engine.model_identity
+    if getattr(generator, 'sampling_config', None) is not None:
+        config['sampling'] = generator.sampling_config
+    return config
+
+def open_recorder(store, benchmark, generator, backend, **options):
+    return RunRecorder(benchmark, run_config(generator, backend, **options), store) if store else None
+
+def run_comprehensive_benchmark(backend=None, workers=None, devices=None, store=RESULTS_STORE,
+                                **generator_options):
+    """One prompt at a time through both modes.
+
+    ``workers`` ("shared" or "isolated") hosts the engines in worker
+    processes; with isolated workers (one engine per mode, e.g. on the
+    GPUs in ``devices``) both modes of each prompt run concurrently.
+    Each prompt's row is appended to the results ``store`` as soon as it
+    is measured (``None`` disables the store).
+    """
     print("\n" + "="*80)
     print("🎯 QWEN 2.5 SPECULATIVE DECODING BENCHMARK")
     print("="*80)
-    print("\n⚠️  This benchmark loads both models simultaneously (~60GB GPU memory required)")
+    if generator_options.get('proposer', "draft") == "ngram":
+        print("\n⚠️  This benchmark loads one shared target with n-gram prompt lookup, no draft "
+              "(~40GB GPU memory required)")
+    else:
+        print("\n⚠️  This benchmark loads one shared target plus the draft (~54GB GPU memory required)")
     print("    Ensure sufficient GPU memory is available before proceeding.\n")
     
-    # Initialize both generators
-    print("\n[1/3] Loading Baseline Generator (Qwen2.5-72B-AWQ)...")
-    baseline = BaselineGenerator()
+    pool = None
+    # Workers hold GPU engines; stop them however the run ends (errors, Ctrl-C)
+    try:
+        if workers:
+            print(f"\n[1/2] Starting {workers} engine worker(s)...")
+            pool = WorkerPool(workers, backend=backend, generator_options=generator_options, devices=devices).start()
+            if not pool.wait_ready():
+                raise RuntimeError(f"Engine workers failed to start: {pool.stats()}")
+            baseline, speculative = pool.generator("baseline"), pool.generator("speculative")
+        else:
+            # One target engine serves both modes
+            print(f"\n[1/2] Loading shared engine ({describe_engine(generator_options.get('proposer', 'draft'))})...")
+            baseline, speculative = load_generators(backend=backend, **generator_options)
+        concurrent = pool is not None and pool.concurrent
+        recorder = open_recorder(store, "latency", baseline, backend, workers=workers, devices=devices,
+                                 num_prompts=len(DEMO_PROMPTS), **generator_options)
     
-    print("\n[2/3] Loading Speculative Generator (Qwen2.5-7B → Qwen2.5-72B-AWQ)...")
-    speculative = QwenSpeculativeGenerator(num_speculative_tokens=5)
+        print("\n[2/2] Running Benchmarks on {} prompts...".format(len(DEMO_PROMPTS)))
+        print("="*80)
     
-    print("\n[3/3] Running Benchmarks on {} prompts...".format(len(DEMO_PROMPTS)))
-    print("="*80)
-    
-    results = []
+        results = []
+        measured_results = {'baseline': [], 'speculative': []}
     
-    for i, prompt in enumerate(DEMO_PROMPTS, 1):
-        print(f"\n{'─'*80}")
-        print(f"PROMPT {i}/{len(DEMO_PROMPTS)}")
-        print(f"{'─'*80}")
-        print(f"📝 {prompt[:75]}...")
+        for i, prompt in enumerate(DEMO_PROMPTS, 1):
+            print(f"\n{'─'*80}")
+            print(f"PROMPT {i}/{len(DEMO_PROMPTS)}")
+            print(f"{'─'*80}")
+            print(f"📝 {prompt[:75]}...")
         
-        # Baseline inference
-        print("\n[BASELINE - Sequential Decoding]")
-        base_result = baseline.generate(prompt)
-        print(f"  ⏱️  Latency: {base_result['latency']:.2f}s")
-        print(f"  🚀 Speed: {base_result['tokens_per_sec']:.1f} tok/s")
-        print(f"  📊 Tokens: {base_result['tokens']}")
+            if concurrent:
+                # Separate engines: run both modes of this prompt at the same time
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    base_future = executor.submit(baseline.generate, prompt)
+                    spec_result = executor.submit(speculative.generate, prompt).result()
+                    base_result = base_future.result()
         
-        time.sleep(0.5)  # Brief pause
+            # Baseline inference
+            print("\n[BASELINE - Sequential Decoding]")
+            if not concurrent:
+                base_result = baseline.generate(prompt)
+            print(f"  ⏱️  Latency: {base_result['latency']:.2f}s")
+            print(f"  🚀 Speed: {base_result['tokens_per_sec']:.1f} tok/s")
+            print(f"  📊 Tokens: {base_result['tokens']}")
+            print(f"  🧩 Phases: {format_phases(base_result.get('phases'))}")
         
-        # Speculative inference
-        print("\n[SPECULATIVE - Parallel Verification]")
-        spec_result = speculative.generate(prompt)
-        print(f"  ⏱️  Latency: {spec_result['latency']:.2f}s")
-        print(f"  🚀 Speed: {spec_result['tokens_per_sec']:.1f} tok/s")
-        print(f"  📊 Tokens: {spec_result['tokens']}")
+            # Speculative inference
+            print("\n[SPECULATIVE - Parallel Verification]")
+            if not concurrent:
+                time.sleep(0.5)  # Brief pause
+                spec_result = speculative.generate(prompt)
+            print(f"  ⏱️  Latency: {spec_result['latency']:.2f}s")
+            print(f"  🚀 Speed: {spec_result['tokens_per_sec']:.1f} tok/s")
+            print(f"  📊 Tokens: {spec_result['tokens']}")
+            print(f"  🧩 Phases: {format_phases(spec_result.get('phases'))}")
+            spec_stats = spec_result.get('speculation') or {}
+            if spec_stats:
+                print(f"  🎯 Draft acceptance: {spec_stats['acceptance_rate']:.1%} "
+                      f"({spec_stats['accepted_tokens']}/{spec_stats['draft_tokens']} tokens, "
+                      f"{spec_stats['mean_accepted_per_step']:.2f} accepted/step, "
+                      f"efficiency {spec_stats['system_efficiency']:.1%})")
         
-        # Calculate metrics
-        speedup = base_result['latency'] / spec_result['latency']
-        latency_reduction = ((base_result['latency'] - spec_result['latency']) / base_result['latency']) * 100
-        throughput_increase = ((spec_result['tokens_per_sec'] - base_result['tokens_per_sec']) / base_result['tokens_per_sec']) * 100
+            # Calculate metrics
+            speedup = base_result['latency'] / spec_result['latency']
+            latency_reduction = ((base_result['latency'] - spec_result['latency']) / base_result['latency']) * 100
+            throughput_increase = ((spec_result['tokens_per_sec'] - base_result['tokens_per_sec']) / base_result['tokens_per_sec']) * 100
         
-        print(f"\n  🎯 SPEEDUP: {speedup:.2f}x faster")
-        print(f"  📉 Latency Reduction: {latency_reduction:.1f}%")
-        print(f"  📈 Throughput Increase: {throughput_increase:.1f}%")
+            print(f"\n  🎯 SPEEDUP: {speedup:.2f}x faster")
+            print(f"  📉 Latency Reduction: {latency_reduction:.1f}%")
+            print(f"  📈 Throughput Increase: {throughput_increase:.1f}%")
         
-        # Store results
-        results.append({
-            'prompt_id': i,
-            'prompt': prompt,
-            'prompt_preview': prompt[:60] + "...",
-            'baseline_latency': round(base_result['latency'], 3),
-            'baseline_tokens_per_sec': round(base_result['tokens_per_sec'], 1),
-            'baseline_tokens': base_result['tokens'],
-            'speculative_latency': round(spec_result['latency'], 3),
-            'speculative_tokens_per_sec': round(spec_result['tokens_per_sec'], 1),
-            'speculative_tokens': spec_result['tokens'],
-            'speedup': round(speedup, 2),
-            'latency_reduction_pct': round(latency_reduction, 1),
-            'throughput_increase_pct': round(throughput_increase, 1),
-            'baseline_output': base_result['text'],
-            'speculative_output': spec_result['text']
-        })
+            # Store results
+            results.append({
+                'prompt_id': i,
+                'prompt': prompt,
+                'prompt_preview': prompt[:60] + "...",
+                'baseline_latency': round(base_result['latency'], 3),
+                'baseline_tokens_per_sec': round(base_result['tokens_per_sec'], 1),
+                'baseline_tokens': base_result['tokens'],
+                'speculative_latency': round(spec_result['latency'], 3),
+                'speculative_tokens_per_sec': round(spec_result['tokens_per_sec'], 1),
+                'speculative_tokens': spec_result['tokens'],
+                'baseline_cache_hit': base_result.get('cache_hit', False),
+                'speculative_cache_hit': spec_result.get('cache_hit', False),
+                'speedup': round(speedup, 2),
+                'latency_reduction_pct': round(latency_reduction, 1),
+                'throughput_increase_pct': round(throughput_increase, 1),
+                'spec_draft_tokens': spec_stats.get('draft_tokens', 0),
+                'spec_accepted_tokens': spec_stats.get('accepted_tokens', 0),
+                'spec_acceptance_rate': round(spec_stats.get('acceptance_rate', 0), 3),
+                'spec_mean_accepted_per_step': round(spec_stats.get('mean_accepted_per_step', 0), 2),
+                'spec_system_efficiency': round(spec_stats.get('system_efficiency', 0), 3),
+                **phase_columns('baseline', base_result),
+                **phase_columns('speculative', spec_result),
+                'baseline_output': base_result['text'],
+                'speculative_output': spec_result['text']
+            })
+            if recorder:
+                recorder.record(results[-1])
+        
+            if not (base_result.get('cache_hit') or spec_result.get('cache_hit')):
+                measured_results['baseline'].append(base_result)
+                measured_results['speculative'].append(spec_result)
         
-        time.sleep(1)  # Cool down between runs
+            if not concurrent:
+                time.sleep(1)  # Cool down between runs
     
-    # Calculate summary statistics
-    df = pd.DataFrame(results)
+        # Calculate summary statistics
+        import pandas as pd  # Only the latency report needs pandas
+        df = pd.DataFrame(results)
+        # Cache hits never reached the engine; keep them out of the timing summary
+        cached = df['baseline_cache_hit'] | df['speculative_cache_hit']
+        if cached.any():
+            print(f"\n♻️  Excluding {int(cached.sum())} prompt(s) served from the response cache")
+        measured = df[~cached]
     
-    print("\n" + "="*80)
-    print("📊 BENCHMARK SUMMARY - QWEN 2.5 SPECULATIVE DECODING")
-    print("="*80)
+        print("\n" + "="*80)
+        print("📊 BENCHMARK SUMMARY - QWEN 2.5 SPECULATIVE DECODING")
+        print("="*80)
+    
+        print(f"\n🎯 Performance Metrics:")
+        print(f"   Average Speedup: {measured['speedup'].mean():.2f}x (range: {measured['speedup'].min():.2f}x - {measured['speedup'].max():.2f}x)")
+        print(f"   Median Speedup: {measured['speedup'].median():.2f}x")
     
-    print(f"\n🎯 Performance Metrics:")
-    print(f"   Average Speedup: {df['speedup'].mean():.2f}x (range: {df['speedup'].min():.2f}x - {df['speedup'].max():.2f}x)")
-    print(f"   Median Speedup: {df['speedup'].median():.2f}x")
+        print(f"\n⏱️  Latency:")
+        print(f"   Baseline Avg: {measured['baseline_latency'].mean():.2f}s")
+        print(f"   Speculative Avg: {measured['speculative_latency'].mean():.2f}s")
+        print(f"   Avg Reduction: {measured['latency_reduction_pct'].mean():.1f}%")
     
-    print(f"\n⏱️  Latency:")
-    print(f"   Baseline Avg: {df['baseline_latency'].mean():.2f}s")
-    print(f"   Speculative Avg: {df['speculative_latency'].mean():.2f}s")
-    print(f"   Avg Reduction: {df['latency_reduction_pct'].mean():.1f}%")
+        print(f"\n🚀 Throughput:")
+        print(f"   Baseline Avg: {measured['baseline_tokens_per_sec'].mean():.1f} tok/s")
+        print(f"   Speculative Avg: {measured['speculative_tokens_per_sec'].mean():.1f} tok/s")
+        print(f"   Avg Increase: {measured['throughput_increase_pct'].mean():.1f}%")
     
-    print(f"\n🚀 Throughput:")
-    print(f"   Baseline Avg: {df['baseline_tokens_per_sec'].mean():.1f} tok/s")
-    print(f"   Speculative Avg: {df['speculative_tokens_per_sec'].mean():.1f} tok/s")
-    print(f"   Avg Increase: {df['throughput_increase_pct'].mean():.1f}%")
+        phases = {mode: phase_summary(mode_results) for mode, mode_results in measured_results.items()}
+        print_phase_breakdown(phases)
+    
+        spec_summary = speculative.speculation_summary()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if recorder:
+        recorder.finish({'speculation': spec_summary, 'phases': phases})
+    print(f"\n🎯 Speculative Decoding (cumulative):")
+    print(f"   Draft tokens proposed: {spec_summary['draft_tokens']}, accepted: {spec_summary['accepted_tokens']}")
+    print(f"   Acceptance rate: {spec_summary['acceptance_rate']:.1%}")
+    print(f"   Mean accepted tokens/step: {spec_summary['mean_accepted_per_step']:.2f}")
+    print(f"   System efficiency: {spec_summary['system_efficiency']:.1%}")
     
     print(f"\n💰 Business Impact (assuming 1M queries/day):")
-    time_saved_per_query = df['baseline_latency'].mean() - df['speculative_latency'].mean()
+    time_saved_per_query = measured['baseline_latency'].mean() - measured['speculative_latency'].mean()
     total_time_saved_hours = (time_saved_per_query * 1_000_000) / 3600
     print(f"   Time saved per query: {time_saved_per_query:.2f}s")
     print(f"   Total time saved daily: {total_time_saved_hours:.1f} hours")
-    print(f"   GPU capacity increase: {df['speedup'].mean():.1f}x (serve {df['speedup'].mean():.1f}x more users)")
+    print(f"   GPU capacity increase: {measured['speedup'].mean():.1f}x (serve {measured['speedup'].mean():.1f}x more users)")
     
     # Save results
     output_files = {
@@ -124,23 +321,386 @@ def run_comprehensive_benchmark():
     
     df.to_csv(output_files['csv'], index=False)
     with open(output_files['json'], 'w') as f:
-        json.dump(results, f, indent=2)
+        json.dump({'results': results, 'speculation': spec_summary, 'phases': phases}, f, indent=2)
     
     # Save summary
     with open(output_files['summary'], 'w') as f:
         f.write("QWEN 2.5 SPECULATIVE DECODING BENCHMARK SUMMARY\n")
         f.write("="*60 + "\n\n")
-        f.write(f"Average Speedup: {df['speedup'].mean():.2f}x\n")
-        f.write(f"Latency Reduction: {df['latency_reduction_pct'].mean():.1f}%\n")
-        f.write(f"Throughput Increase: {df['throughput_increase_pct'].mean():.1f}%\n")
+        f.write(f"Average Speedup: {measured['speedup'].mean():.2f}x\n")
+        f.write(f"Latency Reduction: {measured['latency_reduction_pct'].mean():.1f}%\n")
+        f.write(f"Throughput Increase: {measured['throughput_increase_pct'].mean():.1f}%\n")
+        f.write(f"Draft Acceptance Rate: {spec_summary['acceptance_rate']:.1%}\n")
+        f.write(f"Mean Accepted Tokens/Step: {spec_summary['mean_accepted_per_step']:.2f}\n")
+        f.write(f"System Efficiency: {spec_summary['system_efficiency']:.1%}\n")
+        for phase in LATENCY_PHASES:
+            base_phase, spec_phase = phases['baseline'][phase], phases['speculative'][phase]
+            if base_phase['n'] and spec_phase['n']:
+                f.write(f"Mean {phase}: baseline {base_phase['mean']:.4f}s, "
+                        f"speculative {spec_phase['mean']:.4f}s\n")
     
     print(f"\n📁 Results saved:")
     for file_type, filename in output_files.items():
         print(f"   {file_type.upper()}: {filename}")
+    if recorder:
+        print(f"   RUN: {recorder.run_id} in {store}")
     
     print("\n✅ Benchmark complete!")
     
     return df
 
+def run_throughput_benchmark(prompts=DEMO_PROMPTS, repeat=4, max_batch_tokens=None, backend=None,
+                             store=RESULTS_STORE, **generator_options):
+    """Submit the whole prompt set as one batch per mode and report aggregate throughput"""
+    print("\n" + "="*80)
+    print("🎯 QWEN 2.5 BATCHED THROUGHPUT BENCHMARK")
+    print("="*80)
+    
+    batch_prompts = list(prompts) * repeat
+    print(f"\n📦 Batch: {len(batch_prompts)} prompts ({len(prompts)} unique x {repeat})")
+    if max_batch_tokens:
+        print(f"   Token budget per engine call: {max_batch_tokens}")
+    
+    print(f"\n[1/2] Loading shared engine ({describe_engine(generator_options.get('proposer', 'draft'))})...")
+    baseline, speculative = load_generators(backend=backend, **generator_options)
+    recorder = open_recorder(store, "throughput", baseline, backend, repeat=repeat,
+                             max_batch_tokens=max_batch_tokens, num_prompts=len(prompts), **generator_options)
+    
+    print("\n[2/2] Running batched generation...")
+    summary = {}
+    for mode, gen in (("baseline", baseline), ("speculative", speculative)):
+        batch = gen.generate_batch(batch_prompts, max_batch_tokens=max_batch_tokens)
+        latencies = [r['latency'] for r in batch['results']]
+        summary[mode] = {
+            'num_prompts': batch['num_prompts'],
+            'num_chunks': batch['num_chunks'],
+            'total_tokens': batch['total_tokens'],
+            'wall_time': round(batch['latency'], 3),
+            'tokens_per_sec': round(batch['tokens_per_sec'], 1),
+            'requests_per_sec': round(batch['num_prompts'] / batch['latency'], 2) if batch['latency'] > 0 else 0,
+            'mean_request_latency': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+            'phases': phase_summary(batch['results'])
+        }
+        print(f"\n[{mode.upper()}]")
+        print(f"  ⏱️  Wall time: {summary[mode]['wall_time']:.2f}s ({batch['num_chunks']} engine call(s))")
+        print(f"  🚀 Aggregate: {summary[mode]['tokens_per_sec']:.1f} tok/s, {summary[mode]['requests_per_sec']:.2f} req/s")
+        print(f"  📊 Tokens: {batch['total_tokens']}")
+        if 'speculation' in batch:
+            summary[mode]['speculation'] = batch['speculation']
+            print(f"  🎯 Draft acceptance: {batch['speculation']['acceptance_rate']:.1%}, "
+                  f"{batch['speculation']['mean_accepted_per_step']:.2f} accepted/step, "
+                  f"efficiency {batch['speculation']['system_efficiency']:.1%}")
+    
+    print_phase_breakdown({mode: summary[mode]['phases'] for mode in ("baseline", "speculative")})
+    
+    base_tps = summary['baseline']['tokens_per_sec']
+    spec_tps = summary['speculative']['tokens_per_sec']
+    summary['throughput_ratio'] = round(spec_tps / base_tps, 2) if base_tps > 0 else 0
+    print(f"\n  🎯 Speculative/Baseline aggregate throughput: {summary['throughput_ratio']:.2f}x")
+    if recorder:
+        # The whole batch is one comparable result
+        recorder.record({
+            'prompt_id': "batch",
+            'baseline_tokens_per_sec': base_tps,
+            'speculative_tokens_per_sec': spec_tps,
+            'baseline_latency': summary['baseline']['mean_request_latency'],
+            'speculative_latency': summary['speculative']['mean_request_latency'],
+            'throughput_ratio': summary['throughput_ratio'],
+        })
+        recorder.finish(summary)
+    
+    output_file = 'qwen_throughput_results.json'
+    with open(output_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(f"\n📁 Results saved: {output_file}")
+    print("\n✅ Throughput benchmark complete!")
+    
+    return summary
+
+def run_proposer_benchmark(prompts=None, proposers=PROPOSERS, backend=None, seed=1234, store=RESULTS_STORE,
+                           **generator_options):
+    """Baseline against each speculation proposer on the demo and copy-heavy prompts.
+
+    Proposers need different engines, so each one is loaded, measured and
+    released in turn (the baseline runs on the first). Decoding is greedy
+    and seeded so every mode should produce the same text.
+    """
+    print("\n" + "="*80)
+    print("🎯 QWEN 2.5 SPECULATION PROPOSER COMPARISON")
+    print("="*80)
+    if prompts is None:
+        prompts = [("demo", p) for p in DEMO_PROMPTS] + [("copy", p) for p in COPY_PROMPTS]
+    overrides = {'temperature': 0.0, 'seed': seed}
+    results, recorder = {}, None
+    for n, proposer in enumerate(proposers, 1):
+        print(f"\n[{n}/{len(proposers)}] Loading shared engine with the {proposer} proposer...")
+        baseline, speculative = load_generators(backend=backend, proposer=proposer, **generator_options)
+        if recorder is None:
+            recorder = open_recorder(store, "proposers", baseline, backend, proposers=list(proposers), seed=seed,
+                                     num_prompts=len(prompts), **generator_options)
+        try:
+            if 'baseline' not in results:
+                results['baseline'] = [baseline.generate(prompt, overrides) for _, prompt in prompts]
+            results[proposer] = [speculative.generate(prompt, overrides) for _, prompt in prompts]
+            spec_summary = speculative.speculation_summary()
+        finally:
+            speculative.engine.shutdown()
+        print(f"   {proposer}: acceptance {spec_summary['acceptance_rate']:.1%}, "
+              f"{spec_summary['mean_accepted_per_step']:.2f} accepted/step")
+    
+    rows = []
+    print(f"\n{'#':<4}{'kind':<6}{'baseline':>10}" + "".join(f"{p:>10}{'speedup':>9}{'accept':>8}" for p in proposers))
+    for i, (kind, prompt) in enumerate(prompts):
+        base = results['baseline'][i]
+        row = {'prompt_id': i + 1, 'kind': kind, 'prompt_preview': prompt[:60] + "...",
+               'baseline_latency': round(base['latency'], 3), 'baseline_tokens': base['tokens']}
+        line = f"{i + 1:<4}{kind:<6}{base['latency']:>9.2f}s"
+        for proposer in proposers:
+            spec = results[proposer][i]
+            speedup = base['latency'] / spec['latency'] if spec['latency'] > 0 else 0
+            acceptance = (spec.get('speculation') or {}).get('acceptance_rate', 0)
+            row.update({f'{proposer}_latency': round(spec['latency'], 3), f'{proposer}_speedup': round(speedup, 2),
+                        f'{proposer}_acceptance_rate': round(acceptance, 3),
+                        f'{proposer}_outputs_match': spec['text'] == base['text']})
+            line += f"{spec['latency']:>9.2f}s{speedup:>8.2f}x{acceptance:>8.1%}"
+        rows.append(row)
+        if recorder:
+            recorder.record(row)
+        print(line)
+    
+    summary = {}
+    for proposer in proposers:
+        summary[proposer] = {}
+        for kind in sorted({kind for kind, _ in prompts}):
+            kind_rows = [r for r in rows if r['kind'] == kind]
+            summary[proposer][kind] = {
+                'mean_speedup': round(statistics.fmean(r[f'{proposer}_speedup'] for r in kind_rows), 2),
+                'mean_acceptance_rate': round(statistics.fmean(r[f'{proposer}_acceptance_rate'] for r in kind_rows), 3),
+                'outputs_match_rate': sum(r[f'{proposer}_outputs_match'] for r in kind_rows) / len(kind_rows),
+            }
+    print("\n📊 Mean speedup over baseline:")
+    for proposer, kinds in summary.items():
+        print(f"   {proposer:<6} " + " | ".join(f"{kind}: {s['mean_speedup']:.2f}x "
+                                                f"(accept {s['mean_acceptance_rate']:.0%})"
+                                                for kind, s in kinds.items()))
+    if recorder:
+        recorder.finish({'proposers': summary})
+    
+    output_file = 'qwen_proposer_results.json'
+    with open(output_file, 'w') as f:
+        json.dump({'results': rows, 'summary': summary}, f, indent=2)
+    print(f"\n📁 Results saved: {output_file}")
+    print("\n✅ Proposer comparison complete!")
+    return summary
+
+def run_statistical_benchmark(prompts=DEMO_PROMPTS, trials=5, warmup=2, greedy=True, seed=1234,
+                              confidence=0.95, bootstrap_samples=2000, backend=None,
+                              store=RESULTS_STORE, **generator_options):
+    """Repeated, seeded, paired trials per prompt with percentiles and bootstrap CIs.
+
+    Warmup runs are discarded. Each trial runs both modes with the same
+    seed (and temperature 0 when ``greedy``) so they generate the same
+    tokens, alternating which mode goes first to cancel drift. Speedup is
+    reported per generated token as well as per request.
+    """
+    print("\n" + "="*80)
+    print("🎯 QWEN 2.5 SPECULATIVE DECODING BENCHMARK (STATISTICAL MODE)")
+    print("="*80)
+    print(f"\n🔁 {trials} trials x {len(prompts)} prompts, {warmup} warmup iteration(s), "
+          f"{'greedy' if greedy else 'seeded sampling'} (seed {seed})")
+    
+    print(f"\n[1/3] Loading shared engine ({describe_engine(generator_options.get('proposer', 'draft'))})...")
+    baseline, speculative = load_generators(backend=backend, **generator_options)
+    generators = {'baseline': baseline, 'speculative': speculative}
+    recorder = open_recorder(store, "stats", baseline, backend, trials=trials, warmup=warmup, greedy=greedy,
+                             seed=seed, num_prompts=len(prompts), **generator_options)
+    
+    def overrides_for(trial):
+        if greedy:
+            return {'temperature': 0.0, 'seed': seed}
+        return {'seed': seed + trial}
+    
+    print(f"\n[2/3] Warming up ({warmup} iteration(s) per mode, discarded)...")
+    for i in range(warmup):
+        for gen in generators.values():
+            gen.generate(prompts[i % len(prompts)], overrides_for(0))
+    # Cumulative counters include the warmup; the summary reports only what the trials added
+    spec_before = speculative.speculation_summary()
+    
+    print(f"\n[3/3] Running {trials * len(prompts)} paired trials...")
+    rows = []
+    trial_results = {'baseline': [], 'speculative': []}
+    for prompt_id, prompt in enumerate(prompts, 1):
+        print(f"\n📝 [{prompt_id}/{len(prompts)}] {prompt[:70]}...")
+        for trial in range(trials):
+            order = ['baseline', 'speculative'] if trial % 2 == 0 else ['speculative', 'baseline']
+            run = {}
+            for mode in order:
+                run[mode] = generators[mode].generate(prompt, overrides_for(trial))
+            base, spec = run['baseline'], run['speculative']
+            rows.append({
+                'prompt_id': prompt_id,
+                'trial': trial,
+                'first_mode': order[0],
+                'baseline_latency': base['latency'],
+                'baseline_tokens': base['tokens'],
+                'baseline_latency_per_token': base['latency'] / max(base['tokens'], 1),
+                'speculative_latency': spec['latency'],
+                'speculative_tokens': spec['tokens'],
+                'speculative_latency_per_token': spec['latency'] / max(spec['tokens'], 1),
+                'speedup': base['latency'] / spec['latency'] if spec['latency'] > 0 else 0,
+                'outputs_match': base['text'] == spec['text'],
+                'cache_hit': bool(base.get('cache_hit') or spec.get('cache_hit')),
+                'spec_acceptance_rate': (spec.get('speculation') or {}).get('acceptance_rate', 0),
+                **phase_columns('baseline', base),
+                **phase_columns('speculative', spec),
+            })
+            if recorder:
+                recorder.record(rows[-1])
+            trial_results['baseline'].append(base)
+            trial_results['speculative'].append(spec)
+        prompt_rows = rows[-trials:]
+        print(f"   Baseline p50: {latency_summary([r['baseline_latency'] for r in prompt_rows])['p50']:.2f}s | "
+              f"Speculative p50: {latency_summary([r['speculative_latency'] for r in prompt_rows])['p50']:.2f}s | "
+              f"Outputs match: {sum(r['outputs_match'] for r in prompt_rows)}/{trials}")
+    
+    # Cache hits never reached the engine; keep them out of the timing statistics
+    measured = [r for r in rows if not r['cache_hit']]
+    if not measured:
+        raise RuntimeError(f"All {len(rows)} trials were served from the response cache; "
+                           "nothing was measured (disable the cache or vary the seed)")
+    if len(measured) < len(rows):
+        print(f"\n♻️  Excluding {len(rows) - len(measured)} trial(s) served from the response cache")
+    spec_after = speculative.speculation_summary()
+    trial_speculation = speculative_metrics(**{key: spec_after[key] - spec_before[key] for key in
+                                               ('draft_tokens', 'accepted_tokens', 'emitted_tokens', 'steps')})
+    
+    def request_speedup(sample):
+        return statistics.fmean(r['baseline_latency'] for r in sample) / \
+            statistics.fmean(r['speculative_latency'] for r in sample)
+    
+    def per_token_speedup(sample):
+        return statistics.fmean(r['baseline_latency_per_token'] for r in sample) / \
+            statistics.fmean(r['speculative_latency_per_token'] for r in sample)
+    
+    ci_options = {'samples': bootstrap_samples, 'confidence': confidence, 'seed': seed}
+    speedup, speedup_low, speedup_high = bootstrap_ci(measured, request_speedup, **ci_options)
+    token_speedup, token_low, token_high = bootstrap_ci(measured, per_token_speedup, **ci_options)
+    
+    summary = {
+        'config': {
+            'trials': trials, 'warmup': warmup, 'greedy': greedy, 'seed': seed,
+            'confidence': confidence, 'bootstrap_samples': bootstrap_samples,
+            'num_prompts': len(prompts),
+        },
+        'measured_trials': len(measured),
+        'baseline_latency': latency_summary([r['baseline_latency'] for r in measured]),
+        'speculative_latency': latency_summary([r['speculative_latency'] for r in measured]),
+        'baseline_latency_per_token': latency_summary([r['baseline_latency_per_token'] for r in measured]),
+        'speculative_latency_per_token': latency_summary([r['speculative_latency_per_token'] for r in measured]),
+        'speedup_per_request': {'estimate': speedup, 'ci_low': speedup_low, 'ci_high': speedup_high},
+        'speedup_per_token': {'estimate': token_speedup, 'ci_low': token_low, 'ci_high': token_high},
+        'outputs_match_rate': sum(r['outputs_match'] for r in rows) / len(rows) if rows else 0,
+        'phases': {mode: phase_summary([r for r in mode_results if not r.get('cache_hit')])
+                   for mode, mode_results in trial_results.items()},
+        'speculation': trial_speculation,
+    }
+    
+    print("\n" + "="*80)
+    print("📊 STATISTICAL SUMMARY")
+    print("="*80)
+    for mode in ('baseline', 'speculative'):
+        lat = summary[f'{mode}_latency']
+        per_token = summary[f'{mode}_latency_per_token']
+        print(f"\n⏱️  {mode.capitalize()} latency (n={lat['n']}): p50 {lat['p50']:.3f}s | "
+              f"p90 {lat['p90']:.3f}s | p99 {lat['p99']:.3f}s")
+        print(f"   Per token: p50 {per_token['p50'] * 1000:.1f}ms | p99 {per_token['p99'] * 1000:.1f}ms")
+    print_phase_breakdown(summary['phases'])
+    pct = int(confidence * 100)
+    print(f"\n🎯 Speedup per request: {speedup:.2f}x ({pct}% CI {speedup_low:.2f}x - {speedup_high:.2f}x)")
+    print(f"🎯 Speedup per generated token: {token_speedup:.2f}x ({pct}% CI {token_low:.2f}x - {token_high:.2f}x)")
+    print(f"🔍 Identical outputs across modes: {summary['outputs_match_rate']:.0%}")
+    if recorder:
+        recorder.finish(summary)
+    
+    output_files = {
+        'csv': 'qwen_benchmark_trials.csv',
+        'json': 'qwen_benchmark_stats.json'
+    }
+    import pandas as pd
+    pd.DataFrame(rows).to_csv(output_files['csv'], index=False)
+    with open(output_files['json'], 'w') as f:
+        json.dump(summary, f, indent=2)
+    
+    print(f"\n📁 Results saved:")
+    for file_type, filename in output_files.items():
+        print(f"   {file_type.upper()}: {filename}")
+    print("\n✅ Statistical benchmark complete!")
+    
+    return summary
+
 if __name__ == "__main__":
-    results_df = run_comprehensive_benchmark()
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Qwen 2.5 speculative decoding benchmark")
+    parser.add_argument("--mode", choices=["latency", "throughput", "stats", "proposers"], default="latency",
+                        help="latency: one prompt at a time; throughput: all prompts batched per engine call; "
+                             "stats: warmup + repeated seeded trials with percentiles and bootstrap CIs; "
+                             "proposers: baseline vs the 7B draft vs n-gram prompt lookup, incl. copy-heavy prompts")
+    parser.add_argument("--repeat", type=int, default=4,
+                        help="Throughput mode: copies of DEMO_PROMPTS in the batch")
+    parser.add_argument("--max-batch-tokens", type=int, default=None,
+                        help="Throughput mode: prompt + max_tokens budget per engine call")
+    parser.add_argument("--backend", choices=["vllm", "sim"], default=None,
+                        help="Inference backend (default: $QWEN_BACKEND or vllm); sim runs on CPU")
+    parser.add_argument("--num-speculative-tokens", type=int, default=DEFAULT_NUM_SPECULATIVE_TOKENS,
+                        help="Draft tokens per verification step (maximum when adaptive)")
+    parser.add_argument("--proposer", choices=PROPOSERS, default="draft",
+                        help="Speculation proposer: the Qwen2.5-7B draft or n-gram prompt lookup")
+    parser.add_argument("--ngram-max", type=int, default=DEFAULT_NGRAM_PROMPT_LOOKUP_MAX,
+                        help="Prompt lookup: longest n-gram matched against the context")
+    parser.add_argument("--ngram-min", type=int, default=DEFAULT_NGRAM_PROMPT_LOOKUP_MIN,
+                        help="Prompt lookup: shortest n-gram matched against the context")
+    parser.add_argument("--adaptive-speculation", action="store_true",
+                        help="Let the controller pick the speculation length per request")
+    parser.add_argument("--speculation-log", default=None,
+                        help="JSONL audit log of the controller's decisions")
+    parser.add_argument("--trials", type=int, default=5,
+                        help="Stats mode: seeded trials per prompt")
+    parser.add_argument("--warmup", type=int, default=2,
+                        help="Stats mode: discarded warmup iterations per mode")
+    parser.add_argument("--sample", action="store_true",
+                        help="Stats mode: seeded sampling at the default temperature instead of greedy")
+    parser.add_argument("--seed", type=int, default=1234,
+                        help="Stats mode: base sampling seed")
+    parser.add_argument("--workers", choices=LAYOUTS, default=None,
+                        help="Latency mode: run the engines in worker processes; isolated runs both modes "
+                             "of each prompt concurrently on separate engines")
+    parser.add_argument("--worker-devices", default=None,
+                        help="Isolated workers: GPUs per mode, e.g. baseline=0,speculative=1")
+    parser.add_argument("--store", default=RESULTS_STORE,
+                        help="Append-only JSONL run history (compare runs with result_store.py)")
+    parser.add_argument("--no-store", action="store_true", help="Do not record this run")
+    args = parser.parse_args()
+    store = None if args.no_store else args.store
+    
+    generator_options = {
+        'num_speculative_tokens': args.num_speculative_tokens,
+        'adaptive_speculation': args.adaptive_speculation,
+        'speculation_log': args.speculation_log,
+        'ngram_prompt_lookup_max': args.ngram_max,
+        'ngram_prompt_lookup_min': args.ngram_min,
+    }
+    if args.mode == "proposers":
+        run_proposer_benchmark(backend=args.backend, seed=args.seed, store=store, **generator_options)
+    elif args.mode == "stats":
+        run_statistical_benchmark(trials=args.trials, warmup=args.warmup, greedy=not args.sample,
+                                  seed=args.seed, backend=args.backend, store=store, proposer=args.proposer,
+                                  **generator_options)
+    elif args.mode == "throughput":
+        run_throughput_benchmark(repeat=args.repeat, max_batch_tokens=args.max_batch_tokens,
+                                 backend=args.backend, store=store, proposer=args.proposer, **generator_options)
+    else:
+        devices = dict(item.split("=", 1) for item in args.worker_devices.split(",")) if args.worker_devices else None
+        results_df = run_comprehensive_benchmark(backend=args.backend, workers=args.workers, devices=devices,
+                                                 store=store, proposer=args.proposer, **generator_options)
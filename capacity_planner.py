@@ -0,0 +1,281 @@
+# capacity_planner.py
+from backend import DEFAULT_ENGINE_CONFIG, KV_BLOCK_SIZE
+from speculative import DEFAULT_NUM_SPECULATIVE_TOKENS, PROPOSERS
+import argparse
+import glob
+import json
+import math
+import os
+import subprocess
+import sys
+
+GB = 1024 ** 3
+DTYPE_BYTES = {'float32': 4, 'float16': 2, 'bfloat16': 2, 'fp8': 1}
+CANDIDATE_MODEL_LENS = (2048, 4096, 8192, 16384, 32768)
+VLLM_MAX_NUM_SEQS = 256  # vLLM's default cap on running sequences
+WEIGHT_FILE_PATTERNS = ("*.safetensors", "*.bin", "*.pt")
+
+def read_model_config(model_dir):
+    """Architecture and quantization metadata from a downloaded model's config.json"""
+    with open(os.path.join(model_dir, "config.json")) as f:
+        config = json.load(f)
+    quant = config.get('quantization_config')
+    if quant is None:
+        # AutoAWQ/AutoGPTQ checkpoints may keep it in a side file
+        for name in ("quant_config.json", "quantize_config.json"):
+            path = os.path.join(model_dir, name)
+            if os.path.exists(path):
+                with open(path) as f:
+                    quant = json.load(f)
+                break
+    heads = config['num_attention_heads']
+    return {
+        'path': model_dir,
+        'num_layers': config['num_hidden_layers'],
+        'hidden_size': config['hidden_size'],
+        'intermediate_size': config['intermediate_size'],
+        'num_heads': heads,
+        'num_kv_heads': config.get('num_key_value_heads') or heads,
+        'head_dim': config.get('head_dim') or config['hidden_size'] // heads,
+        'vocab_size': config['vocab_size'],
+        'tie_word_embeddings': config.get('tie_word_embeddings', False),
+        'max_position_embeddings': config.get('max_position_embeddings'),
+        'dtype': config.get('torch_dtype', "float16"),
+        'quantization': {
+            'method': quant.get('quant_method') or quant.get('quant_type', "awq"),
+            'bits': quant.get('bits') or quant.get('w_bit', 4),
+            'group_size': quant.get('group_size') or quant.get('q_group_size', 128),
+        } if quant else None,
+    }
+
+def estimate_weight_bytes(model):
+    """Weight footprint from the architecture (Qwen2 layout); quantized linears use bits plus group scales/zeros"""
+    h, i, kv_dim = model['hidden_size'], model['intermediate_size'], model['num_kv_heads'] * model['head_dim']
+    linear_params = model['num_layers'] * (2 * h * h + 2 * h * kv_dim + 3 * h * i)
+    other_params = model['num_layers'] * (h + 2 * kv_dim + 2 * h) + h  # q/k/v biases, norms, final norm
+    embedding_params = model['vocab_size'] * h * (1 if model['tie_word_embeddings'] else 2)
+    quant = model['quantization']
+    if quant:
+        bits = quant['bits']
+        # Per group: a 16-bit scale and a packed zero point
+        linear_bytes = linear_params * (bits / 8 + (2 + bits / 8) / quant['group_size'])
+    else:
+        linear_bytes = linear_params * DTYPE_BYTES.get(model['dtype'], 2)
+    # Embeddings, lm_head, biases and norms stay 16-bit
+    return int(linear_bytes + (other_params + embedding_params) * 2)
+
+def weight_bytes(model):
+    """Checkpoint size on disk when the weights are downloaded, else the architecture estimate"""
+    files = [path for pattern in WEIGHT_FILE_PATTERNS
+             for path in glob.glob(os.path.join(model['path'], pattern))]
+    if files:
+        return sum(os.path.getsize(path) for path in files), "checkpoint files"
+    return estimate_weight_bytes(model), "architecture estimate"
+
+def kv_bytes_per_token(model, kv_cache_dtype="auto"):
+    """K and V for every layer; "auto" stores them in the activation dtype (fp16 for AWQ)"""
+    if kv_cache_dtype == "auto":
+        kv_cache_dtype = "float16" if model['quantization'] else model['dtype']
+    return 2 * model['num_layers'] * model['num_kv_heads'] * model['head_dim'] * DTYPE_BYTES.get(kv_cache_dtype, 2)
+
+def profile_peak_bytes(model, max_model_len, max_num_seqs=VLLM_MAX_NUM_SEQS):
+    """Activation peak of vLLM's startup profiling run, which the KV cache is sized after.
+
+    The run prefills max(max_model_len, 2048) tokens: MLP gate/up and
+    residual buffers dominate, plus fp32 logits for every dummy sequence.
+    """
+    tokens = max(max_model_len, 2048)
+    activations = tokens * (3 * model['intermediate_size'] + 6 * model['hidden_size']) * 2
+    logits = max_num_seqs * model['vocab_size'] * 4 * 2
+    return activations + logits
+
+def detect_gpu_memory_gb():
+    """Memory of the first GPU from nvidia-smi, or None"""
+    try:
+        out = subprocess.run(["nvidia-smi", "--query-gpu=memory.total", "--format=csv,noheader,nounits"],
+                             capture_output=True, text=True, timeout=10, check=True).stdout
+        return int(out.split()[0]) / 1024
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return None
+
+def plan_engine(target, draft, gpu_memory_gb, gpu_memory_utilization, max_model_len,
+                num_speculative_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS, overhead_gb=1.0, speculative=None):
+    """KV cache and concurrency of one engine (``draft`` None: no draft model).
+
+    ``speculative`` defaults to whether there is a draft; pass True for
+    prompt-lookup speculation, which reserves lookahead slots but has no
+    draft weights or KV cache.
+
+    Mirrors vLLM 0.6: the budget is ``gpu_memory_gb * gpu_memory_utilization``;
+    weights, the profiling peak and non-torch overhead come off the top, and
+    the rest becomes KV blocks shared by target and draft, each sequence
+    reserving ``num_speculative_tokens`` lookahead slots.
+    """
+    weights = target['weight_bytes'] + (draft['weight_bytes'] if draft else 0)
+    peak = max(profile_peak_bytes(target, max_model_len),
+               profile_peak_bytes(draft, max_model_len) if draft else 0)
+    per_token = target['kv_bytes_per_token'] + (draft['kv_bytes_per_token'] if draft else 0)
+    budget = gpu_memory_gb * gpu_memory_utilization * GB
+    reserved = weights + peak + overhead_gb * GB
+    kv_bytes = max(budget - reserved, 0)
+    num_blocks = int(kv_bytes // (per_token * KV_BLOCK_SIZE))
+    speculative = draft is not None if speculative is None else speculative
+    lookahead = num_speculative_tokens if speculative else 0
+    blocks_per_seq = math.ceil((max_model_len + lookahead) / KV_BLOCK_SIZE)
+    max_full_length_seqs = num_blocks // blocks_per_seq
+    return {
+        'max_model_len': max_model_len,
+        'speculative': speculative,
+        'weights_gb': weights / GB,
+        'profile_peak_gb': peak / GB,
+        'kv_cache_gb': kv_bytes / GB,
+        'kv_bytes_per_token': per_token,
+        'num_gpu_blocks': num_blocks,
+        'kv_cache_tokens': num_blocks * KV_BLOCK_SIZE,
+        # vLLM refuses to start when a single full-length sequence does not fit
+        'fits': max_full_length_seqs >= 1,
+        'max_concurrent_seqs': min(max_full_length_seqs, VLLM_MAX_NUM_SEQS),
+        # Utilization at which exactly one full-length sequence fits
+        'min_gpu_memory_utilization': (reserved + blocks_per_seq * KV_BLOCK_SIZE * per_token) / (gpu_memory_gb * GB),
+    }
+
+def load_models(models_dir="./models"):
+    """``{'target': ..., 'draft': ...}`` with weight and KV sizes; the draft is None when not downloaded"""
+    models = {}
+    for name in ("target", "draft"):
+        model_dir = os.path.join(models_dir, name)
+        if not os.path.exists(os.path.join(model_dir, "config.json")):
+            if name == "target":
+                raise FileNotFoundError(f"No config.json in {model_dir}; run download_models.py first")
+            models[name] = None
+            continue
+        model = read_model_config(model_dir)
+        model['weight_bytes'], model['weight_source'] = weight_bytes(model)
+        model['kv_bytes_per_token'] = kv_bytes_per_token(model)
+        models[name] = model
+    return models
+
+def plan_capacity(models, gpu_memory_gb, gpu_memory_utilization=0.90, model_lens=None,
+                  num_speculative_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS, overhead_gb=1.0,
+                  target_concurrency=8, proposer="draft"):
+    """Plans for every ``max_model_len`` in both modes plus suggested engine parameters.
+
+    The suggestion is for the engine the generators share (with the draft
+    when it is downloaded, or prompt lookup for the "ngram" ``proposer``):
+    the longest context that still runs
+    ``target_concurrency`` full-length sequences, else the one running
+    the most.
+    """
+    target, draft = models['target'], models['draft'] if proposer == "draft" else None
+    speculative = draft is not None or proposer == "ngram"
+    limit = target['max_position_embeddings'] or max(CANDIDATE_MODEL_LENS)
+    model_lens = [n for n in (model_lens or CANDIDATE_MODEL_LENS) if n <= limit]
+    options = {'num_speculative_tokens': num_speculative_tokens, 'overhead_gb': overhead_gb}
+    engines = [(None, False)] + ([(draft, True)] if speculative else [])
+    rows = [plan_engine(target, engine_draft, gpu_memory_gb, gpu_memory_utilization, n,
+                        speculative=engine_speculative, **options)
+            for engine_draft, engine_speculative in engines for n in model_lens]
+
+    shared = [row for row in rows if row['speculative'] == speculative and row['fits']]
+    meeting = [row for row in shared if row['max_concurrent_seqs'] >= target_concurrency]
+    if meeting:
+        chosen = max(meeting, key=lambda row: row['max_model_len'])
+    else:
+        chosen = max(shared, key=lambda row: (row['max_concurrent_seqs'], row['max_model_len']), default=None)
+    suggestion = None
+    if chosen:
+        suggestion = {'gpu_memory_utilization': gpu_memory_utilization, 'max_model_len': chosen['max_model_len']}
+    return {
+        'gpu_memory_gb': gpu_memory_gb,
+        'gpu_memory_utilization': gpu_memory_utilization,
+        'proposer': proposer,
+        'models': {name: model and {k: model[k] for k in ('path', 'num_layers', 'num_kv_heads', 'head_dim',
+                                                           'quantization', 'weight_bytes', 'weight_source',
+                                                           'kv_bytes_per_token')}
+                   for name, model in models.items()},
+        'plans': rows,
+        'target_concurrency': target_concurrency,
+        'meets_target_concurrency': bool(meeting),
+        'suggested_engine_config': suggestion,
+    }
+
+def print_plan(plan):
+    print("\n" + "="*80)
+    print(f"🧮 CAPACITY PLAN: {plan['gpu_memory_gb']:.0f}GB GPU at "
+          f"gpu_memory_utilization={plan['gpu_memory_utilization']:.2f}")
+    print("="*80)
+    for name, model in plan['models'].items():
+        if model is None:
+            if plan['proposer'] == "draft":
+                print(f"\n📦 {name}: not downloaded, planning the baseline engine only")
+            continue
+        quant = model['quantization']
+        quant_text = f"{quant['method']} {quant['bits']}-bit g{quant['group_size']}" if quant else "unquantized"
+        print(f"\n📦 {name}: {model['weight_bytes'] / GB:.1f}GB weights ({model['weight_source']}, {quant_text})")
+        print(f"   KV cache: {model['kv_bytes_per_token'] / 1024:.0f}KB/token "
+              f"({model['num_layers']} layers x {model['num_kv_heads']} KV heads x {model['head_dim']})")
+
+    print(f"\n{'engine':<12}{'max_model_len':>14}{'KV GB':>8}{'KV tokens':>11}{'max seqs':>10}{'min util':>10}")
+    for row in plan['plans']:
+        engine = ("ngram" if plan['proposer'] == "ngram" else "speculative") if row['speculative'] else "baseline"
+        seqs = row['max_concurrent_seqs'] if row['fits'] else "OOM"
+        print(f"{engine:<12}{row['max_model_len']:>14}{row['kv_cache_gb']:>8.1f}{row['kv_cache_tokens']:>11}"
+              f"{seqs:>10}{row['min_gpu_memory_utilization']:>10.2f}")
+
+    suggestion = plan['suggested_engine_config']
+    if suggestion is None:
+        print("\n❌ No max_model_len fits this budget; raise gpu_memory_utilization or use a larger GPU")
+    else:
+        if not plan['meets_target_concurrency']:
+            print(f"\n⚠️  No context length runs {plan['target_concurrency']} full-length sequences; "
+                  f"suggesting the most concurrent one")
+        print(f"\n✅ Suggested engine config: {json.dumps(suggestion)}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Plan KV cache capacity and engine settings from model configs")
+    parser.add_argument("--models-dir", default="./models")
+    parser.add_argument("--gpu-memory-gb", type=float, default=None,
+                        help="GPU memory budget (default: first GPU from nvidia-smi, else 80)")
+    parser.add_argument("--gpu-memory-utilization", type=float, default=0.90)
+    parser.add_argument("--max-model-len", type=int, nargs="+", default=None,
+                        help=f"Context lengths to plan (default: {', '.join(map(str, CANDIDATE_MODEL_LENS))})")
+    parser.add_argument("--num-speculative-tokens", type=int, default=DEFAULT_NUM_SPECULATIVE_TOKENS)
+    parser.add_argument("--proposer", choices=PROPOSERS, default="draft",
+                        help="Plan the speculative engine with the draft model or n-gram prompt lookup")
+    parser.add_argument("--overhead-gb", type=float, default=1.0,
+                        help="CUDA context and other non-torch memory inside the budget")
+    parser.add_argument("--target-concurrency", type=int, default=8,
+                        help="Full-length sequences the suggested config must run at once")
+    parser.add_argument("--json", action="store_true", help="Print the plan as JSON")
+    parser.add_argument("--apply", nargs="?", const=DEFAULT_ENGINE_CONFIG, default=None, metavar="PATH",
+                        help=f"Write the suggested engine config (default path {DEFAULT_ENGINE_CONFIG}), "
+                             "which create_engine() picks up")
+    args = parser.parse_args(argv)
+
+    gpu_memory_gb = args.gpu_memory_gb or detect_gpu_memory_gb() or 80
+    try:
+        models = load_models(args.models_dir)
+    except FileNotFoundError as e:
+        print(f"❌ {e}")
+        return 1
+    plan = plan_capacity(models, gpu_memory_gb, args.gpu_memory_utilization, args.max_model_len,
+                         args.num_speculative_tokens, args.overhead_gb, args.target_concurrency, args.proposer)
+    if args.json:
+        print(json.dumps(plan, indent=2))
+    else:
+        print_plan(plan)
+
+    suggestion = plan['suggested_engine_config']
+    if suggestion is None:
+        return 1
+    if args.apply:
+        os.makedirs(os.path.dirname(args.apply) or ".", exist_ok=True)
+        tmp_path = args.apply + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(suggestion, f, indent=2)
+        os.replace(tmp_path, args.apply)
+        print(f"📝 Engine config written to {args.apply}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# chat.py
+from backend import KV_BLOCK_SIZE
+
+class ChatSession:
+    """One multi-turn conversation on a generator.
+
+    Every turn resends the whole history through the Qwen chat template.
+    With prefix caching on the engine the KV blocks of earlier turns are
+    still resident, so only the new message is prefilled. Each turn reports
+    ``reused_prompt_tokens``: the engine's own count when it provides one,
+    otherwise the block-aligned token prefix shared with the previous turn
+    (what the prefix cache can reuse while those blocks are not evicted).
+    """
+
+    def __init__(self, generator, system_prompt=None, messages=None):
+        self.generator = generator
+        self.system_prompt = system_prompt
+        self.messages = [{'role': m['role'], 'content': m['content']} for m in messages or []]
+        self.turns = []
+        self._previous_token_ids = []
+
+    def _turn_messages(self, message):
+        system = [{'role': 'system', 'content': self.system_prompt}] if self.system_prompt else []
+        return system + self.messages + [{'role': 'user', 'content': message}]
+
+    def send(self, message, sampling_overrides=None):
+        """Run one turn to completion; returns the generator result plus a ``turn`` entry"""
+        result = self.generator.generate(self._turn_messages(message), sampling_overrides)
+        return self._finish_turn(message, result, sampling_overrides)
+
+    async def stream(self, message, scheduler, sampling_overrides=None, timeout=None):
+        """Run one turn through a MicroBatchScheduler, yielding its streaming updates"""
+        async for update in scheduler.stream(self._turn_messages(message), sampling_overrides, timeout):
+            if update['finished']:
+                update = self._finish_turn(message, update, sampling_overrides)
+            yield update
+
+    def _estimate_reuse(self, prompt_token_ids):
+        shared = 0
+        for a, b in zip(prompt_token_ids, self._previous_token_ids):
+            if a != b:
+                break
+            shared += 1
+        # Only whole blocks are shared, and the last prompt token is always recomputed
+        shared = min(shared, len(prompt_token_ids) - 1)
+        return max(shared, 0) // KV_BLOCK_SIZE * KV_BLOCK_SIZE
+
+    def _finish_turn(self, message, result, sampling_overrides=None):
+        # Cached by the prompt pipeline: these are the ids the engine was sent
+        prepared = self.generator.prepare_prompt(self._turn_messages(message), sampling_overrides)
+        prompt_token_ids = prepared['token_ids']
+
+        if result.get('cache_hit'):
+            reused, source = 0, 'response_cache'
+        elif result.get('cached_prompt_tokens') is not None:
+            reused, source = result['cached_prompt_tokens'], 'engine'
+        else:
+            reused, source = self._estimate_reuse(prompt_token_ids), 'estimate'
+
+        self.messages.append({'role': 'user', 'content': message})
+        self.messages.append({'role': 'assistant', 'content': result['text']})
+        tokenizer = self.generator.engine.get_tokenizer()
+        self._previous_token_ids = prompt_token_ids + tokenizer.encode(result['text'])
+
+        turn = {
+            'turn': len(self.turns) + 1,
+            'prompt_tokens': len(prompt_token_ids),
+            'reused_prompt_tokens': reused,
+            'prefilled_prompt_tokens': len(prompt_token_ids) - reused,
+            'reuse_source': source,
+            'latency': result['latency'],
+        }
+        if 'ttft' in result:
+            turn['ttft'] = result['ttft']
+        self.turns.append(turn)
+        return dict(result, turn=turn)
+
+    def reset(self):
+        self.messages = []
+        self.turns = []
+        self._previous_token_ids = []
+
+    def summary(self):
+        """Prompt tokens sent and reused over the whole conversation"""
+        prompt_tokens = sum(t['prompt_tokens'] for t in self.turns)
+        reused = sum(t['reused_prompt_tokens'] for t in self.turns)
+        return {
+            'turns': len(self.turns),
+            'prompt_tokens': prompt_tokens,
+            'reused_prompt_tokens': reused,
+            'reuse_rate': reused / prompt_tokens if prompt_tokens else 0,
+        }
@@ -1,81 +1,179 @@
 # demo_ui.py
-import gradio as gr
 from baseline import BaselineGenerator
-from speculative import QwenSpeculativeGenerator
-import time
+from speculative import QwenSpeculativeGenerator, DEFAULT_NUM_SPECULATIVE_TOKENS
+from spec_controller import AdaptiveSpeculationController
+from scheduler import MicroBatchScheduler
+from backend import create_engine
+from response_cache import cache_from_env
+from chat import ChatSession
+from startup import EnginePreloader
+from status_server import StatusServer
+from metrics import PROMETHEUS_CONTENT_TYPE, metrics_route, register_scheduler_gauges
+from worker_pool import LAYOUTS, WorkerPool
+import argparse
+import asyncio
 import json
+import threading
+import uuid
 
-# Initialize models lazily to avoid OOM
-print("🚀 Models will be loaded on first use to optimize memory...")
-
+# Engines are built once, by the background preload at launch or on first use with --lazy
+shared_engine = None
 baseline_gen = None
 spec_gen = None
+schedulers = {}
+preloader = None  # Set when launched with background preload (the default), or by the first request with --lazy
+lazy_load = False  # --lazy: the first request starts the preload instead of launch
+worker_pool = None  # Set when launched with --workers: engines live in worker processes
+# Deadline and admission settings for every scheduler (--request-timeout, --max-queued-tokens, --max-queue-wait)
+scheduler_options = {}
+_init_lock = threading.RLock()  # Preload thread and first clicks must not build twice
+response_cache = None  # Set at launch from $QWEN_RESPONSE_CACHE
+
+def get_engine():
+    """One resident target engine serves both baseline and speculative mode"""
+    global shared_engine
+    with _init_lock:
+        if shared_engine is None:
+            print("Loading shared Qwen2.5-72B-AWQ engine with Qwen2.5-7B draft...")
+            # Backend comes from $QWEN_BACKEND ("sim" runs the UI on CPU)
+            shared_engine = create_engine(
+                target_model_path="./models/target",
+                draft_model_path="./models/draft",
+                num_speculative_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS
+            )
+    return shared_engine
 
 def get_baseline_generator():
     global baseline_gen
-    if baseline_gen is None:
-        print("Loading Baseline Generator...")
-        baseline_gen = BaselineGenerator()
+    with _init_lock:
+        if baseline_gen is None:
+            # Long conversations drop their oldest turns instead of failing
+            baseline_gen = BaselineGenerator(engine=get_engine(), cache=response_cache,
+                                             prompt_policy="truncate")
     return baseline_gen
 
 def get_speculative_generator():
     global spec_gen
-    if spec_gen is None:
-        print("Loading Speculative Generator...")
-        spec_gen = QwenSpeculativeGenerator(num_speculative_tokens=5)
+    with _init_lock:
+        if spec_gen is None:
+            # Shorten or switch off speculation when acceptance drops or batches grow
+            controller = AdaptiveSpeculationController(
+                max_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS,
+                log_path="speculation_decisions.jsonl"
+            )
+            spec_gen = QwenSpeculativeGenerator(engine=get_engine(), controller=controller,
+                                                cache=response_cache, prompt_policy="truncate")
     return spec_gen
 
-print("✅ Demo ready! Models will load on first inference.")
+def load_all_generators():
+    return {'baseline': get_baseline_generator(), 'speculative': get_speculative_generator()}
+
+def not_ready_message():
+    """Message for users arriving while the background preload is still running, else None"""
+    global preloader
+    if worker_pool is not None:
+        if worker_pool.ready:
+            return None
+        states = ", ".join(f"{name} {w.status}" for name, w in worker_pool.workers.items())
+        return f"⏳ Engine workers are not ready ({states}). Please retry shortly."
+    with _init_lock:
+        if preloader is None and lazy_load:
+            # Build on the preload thread; loading inside a handler would block the event loop
+            preloader = EnginePreloader(load_all_generators).start()
+    if preloader is None or preloader.ready:
+        return None
+    if preloader.status == "failed":
+        return f"❌ Engine failed to load: {preloader.error}"
+    return f"⏳ Engines are still loading ({preloader.status}, {preloader.readiness()['elapsed']:.0f}s so far). Please retry shortly."
 
-def single_inference(prompt, mode):
-    """Run inference with selected mode"""
+def get_scheduler(mode):
+    """Micro-batching scheduler in front of the generator for ``mode``"""
+    if worker_pool is not None:
+        return worker_pool.scheduler(mode)  # Batched inside the worker process
+    if mode not in schedulers:
+        gen = get_baseline_generator() if mode == "baseline" else get_speculative_generator()
+        schedulers[mode] = MicroBatchScheduler(gen, window_ms=5, max_batch_size=32, **scheduler_options)
+    return schedulers[mode]
+
+async def single_inference(prompt, mode):
+    """Run inference with selected mode, streaming tokens into the output box"""
     if not prompt.strip():
-        return "⚠️ Please enter a prompt", "", "", ""
+        yield "⚠️ Please enter a prompt", "", "", ""
+        return
+    if not_ready_message():
+        yield not_ready_message(), "", "", ""
+        return
     
     try:
         if mode == "Baseline (72B-AWQ Only)":
-            gen = get_baseline_generator()
-            result = gen.generate(prompt)
+            scheduler = get_scheduler("baseline")
             method = "Sequential Decoding (Standard)"
             model_info = "Qwen2.5-72B-AWQ"
         else:
-            gen = get_speculative_generator()
-            result = gen.generate(prompt)
+            scheduler = get_scheduler("speculative")
             method = "Speculative Decoding (7B→72B-AWQ)"
             model_info = "Qwen2.5-7B (draft) + Qwen2.5-72B-AWQ (verify)"
         
-        return (
-            result['text'],
-            f"⏱️ {result['latency']:.2f} seconds",
-            f"🚀 {result['tokens_per_sec']:.1f} tokens/sec",
-            f"📊 {method}\n💻 {model_info}\n🔢 {result['tokens']} tokens generated"
-        )
+        async for update in scheduler.stream(prompt):
+            if not update['finished']:
+                yield update['text'], "⏳ Generating...", "", f"📊 {method}\n💻 {model_info}"
+                continue
+            
+            yield (
+                update['text'],
+                f"⏱️ {update['latency']:.2f} seconds (first token: {update['ttft']:.2f}s)",
+                f"🚀 {update['tokens_per_sec']:.1f} tokens/sec",
+                f"📊 {method}\n💻 {model_info}\n🔢 {update['tokens']} tokens generated"
+                f"\n📥 Batched with {update['batch_size'] - 1} other request(s)"
+                + ("\n♻️ Served from response cache" if update.get('cache_hit') else "")
+                + (f"\n🎯 Draft acceptance {update['speculation']['acceptance_rate']:.0%}, "
+                   f"{update['speculation']['tokens_per_step']:.2f} tokens/step"
+                   if update.get('speculation') else "")
+            )
     except Exception as e:
-        return f"❌ Error: {str(e)}", "", "", ""
+        yield f"❌ Error: {str(e)}", "", "", ""
 
-def side_by_side_comparison(prompt):
+async def side_by_side_comparison(prompt):
     """Run both modes for direct comparison"""
     if not prompt.strip():
         return "", "", "⚠️ Please enter a prompt"
+    if not_ready_message():
+        return "", "", not_ready_message()
     
     try:
-        # Run baseline
-        print(f"Running baseline for: {prompt[:50]}...")
-        baseline = get_baseline_generator()
-        base_result = baseline.generate(prompt)
-        
-        # Brief pause
-        time.sleep(0.5)
-        
-        # Run speculative
-        print(f"Running speculative for: {prompt[:50]}...")
-        speculative = get_speculative_generator()
-        spec_result = speculative.generate(prompt)
+        if worker_pool is not None and worker_pool.concurrent:
+            # Separate engines: run both at once, so the comparison takes the longer latency, not the sum
+            print(f"Running baseline and speculative concurrently for: {prompt[:50]}...")
+            base_result, spec_result = await asyncio.gather(
+                get_scheduler("baseline").submit(prompt),
+                get_scheduler("speculative").submit(prompt)
+            )
+        else:
+            # Run baseline
+            print(f"Running baseline for: {prompt[:50]}...")
+            base_result = await get_scheduler("baseline").submit(prompt)
+            
+            # Brief pause
+            await asyncio.sleep(0.5)
+            
+            # Run speculative
+            print(f"Running speculative for: {prompt[:50]}...")
+            spec_result = await get_scheduler("speculative").submit(prompt)
         
         # Calculate metrics
         speedup = base_result['latency'] / spec_result['latency']
         latency_reduction = ((base_result['latency'] - spec_result['latency']) / base_result['latency']) * 100
         throughput_gain = ((spec_result['tokens_per_sec'] / base_result['tokens_per_sec']) - 1) * 100
+        spec_stats = spec_result.get('speculation')
+        if spec_stats:
+            spec_rows = f"""| **Draft Acceptance** | - | {spec_stats['acceptance_rate']:.1%} ({spec_stats['accepted_tokens']}/{spec_stats['draft_tokens']}) | Share of draft tokens kept |
+| **Accepted / Step** | - | {spec_stats['mean_accepted_per_step']:.2f} tokens | {spec_stats['tokens_per_step']:.2f} tokens per target pass |
+| **System Efficiency** | - | {spec_stats['system_efficiency']:.1%} | Emitted vs. maximum possible |
+"""
+        else:
+            spec_rows = "| **Draft Acceptance** | - | speculation off | Controller disabled drafting |\n"
+        if base_result.get('cache_hit') or spec_result.get('cache_hit'):
+            spec_rows += "\n♻️ **Served from the response cache:** timings do not reflect decoding speed\n"
         
         # Format comparison
         comparison = f"""
@@ -87,7 +185,7 @@ def side_by_side_comparison(prompt):
 | **Throughput** | {base_result['tokens_per_sec']:.1f} tok/s | {spec_result['tokens_per_sec']:.1f} tok/s | **+{throughput_gain:.1f}%** 📈 |
 | **Tokens Generated** | {base_result['tokens']} | {spec_result['tokens']} | Same output length |
 | **Latency Reduction** | - | - | **-{latency_reduction:.1f}%** 📉 |
-
+{spec_rows}
 ---
 
 ### 🎯 Key Insights
@@ -117,6 +215,47 @@ For **1,000 daily queries**:
     except Exception as e:
         return "", "", f"❌ Error: {str(e)}"
 
+async def chat_turn(message, history, mode, session):
+    """Send one chat turn, streaming the reply into the conversation"""
+    if not message.strip():
+        yield history, "", session, "⚠️ Please enter a message"
+        return
+    if not_ready_message():
+        yield history, message, session, not_ready_message()
+        return
+    
+    key = "baseline" if mode.startswith("Baseline") else "speculative"
+    if worker_pool is not None:
+        # The worker keeps the ChatSession; the UI only holds its id
+        if not isinstance(session, str):
+            session = uuid.uuid4().hex
+        updates = worker_pool.chat(key, session, history, message)
+    else:
+        gen = get_baseline_generator() if key == "baseline" else get_speculative_generator()
+        if session is None or session.generator is not gen:
+            # Switching modes keeps the conversation; both share the engine's prefix cache
+            session = ChatSession(gen, messages=history)
+        updates = session.stream(message, get_scheduler(key))
+    
+    history = history + [{'role': 'user', 'content': message}, {'role': 'assistant', 'content': ""}]
+    try:
+        async for update in updates:
+            history[-1] = {'role': 'assistant', 'content': update['text']}
+            if not update['finished']:
+                yield history, "", session, "⏳ Generating..."
+                continue
+            
+            turn = update['turn']
+            summary = update['summary'] if worker_pool is not None else session.summary()
+            yield history, "", session, (
+                f"🔁 Turn {turn['turn']}: {turn['reused_prompt_tokens']}/{turn['prompt_tokens']} prompt tokens "
+                f"reused from the prefix cache ({turn['reuse_source']}), {turn['prefilled_prompt_tokens']} prefilled\n\n"
+                f"⏱️ {update['latency']:.2f}s (first token: {update['ttft']:.2f}s) | "
+                f"📊 Conversation reuse: {summary['reuse_rate']:.0%} of {summary['prompt_tokens']} prompt tokens"
+            )
+    except Exception as e:
+        yield history[:-2], message, session, f"❌ Error: {str(e)}"
+
 # Example prompts for demo
 enterprise_examples = [
     "Summarize the key benefits of adopting AI in customer service operations.",
@@ -126,140 +265,247 @@ enterprise_examples = [
     "Draft a brief announcement about our new product feature launch for internal communication.",
 ]
 
-# Create Gradio interface
-with gr.Blocks(
-    title="Qwen 2.5 AI Response Accelerator",
-    theme=gr.themes.Soft(primary_hue="blue", secondary_hue="cyan")
-) as demo:
+def build_ui():
+    """Gradio Blocks for the demo; built at launch only, so spawned workers importing this module skip it"""
+    import gradio as gr
+
+    with gr.Blocks(
+        title="Qwen 2.5 AI Response Accelerator",
+        theme=gr.themes.Soft(primary_hue="blue", secondary_hue="cyan")
+    ) as demo:
     
-    gr.Markdown("""
-    # 🚀 AI Response Accelerator - Qwen 2.5 Edition
-    ### Enterprise-Grade LLM with 3× Faster Response Times
+        gr.Markdown("""
+        # 🚀 AI Response Accelerator - Qwen 2.5 Edition
+        ### Enterprise-Grade LLM with 3× Faster Response Times
     
-    **Powered by:** Speculative Decoding (Qwen2.5-7B → Qwen2.5-72B-AWQ)
+        **Powered by:** Speculative Decoding (Qwen2.5-7B → Qwen2.5-72B-AWQ)
     
-    ---
+        ---
     
-    **Demo for Leadership:** Experience how we achieve dramatically faster AI responses 
-    without sacrificing output quality using advanced GPU acceleration techniques.
-    """)
+        **Demo for Leadership:** Experience how we achieve dramatically faster AI responses 
+        without sacrificing output quality using advanced GPU acceleration techniques.
+        """)
     
-    with gr.Tab("⚡ Quick Demo"):
-        gr.Markdown("### Single Inference Mode")
-        gr.Markdown("Test individual queries with either baseline or speculative decoding.")
+        with gr.Tab("⚡ Quick Demo"):
+            gr.Markdown("### Single Inference Mode")
+            gr.Markdown("Test individual queries with either baseline or speculative decoding.")
+        
+            with gr.Row():
+                with gr.Column(scale=2):
+                    prompt_input = gr.Textbox(
+                        label="Enter Your Prompt",
+                        placeholder="Ask me anything...",
+                        lines=4
+                    )
+                    mode_select = gr.Radio(
+                        choices=["Baseline (72B-AWQ Only)", "Speculative (7B→72B-AWQ)"],
+                        value="Speculative (7B→72B-AWQ)",
+                        label="Inference Mode",
+                        info="Compare standard vs accelerated inference"
+                    )
+                    run_btn = gr.Button("🚀 Generate Response", variant="primary", size="lg")
+            
+                with gr.Column(scale=3):
+                    output_text = gr.Textbox(label="📝 Generated Response", lines=8)
+                    with gr.Row():
+                        latency_out = gr.Textbox(label="⏱️ Latency", scale=1)
+                        speed_out = gr.Textbox(label="🚀 Throughput", scale=1)
+                    method_out = gr.Textbox(label="ℹ️ Model Information", lines=3)
         
-        with gr.Row():
-            with gr.Column(scale=2):
-                prompt_input = gr.Textbox(
-                    label="Enter Your Prompt",
-                    placeholder="Ask me anything...",
-                    lines=4
+            gr.Examples(
+                examples=enterprise_examples,
+                inputs=prompt_input,
+                label="Example Enterprise Prompts"
+            )
+        
+            run_btn.click(
+                single_inference,
+                inputs=[prompt_input, mode_select],
+                outputs=[output_text, latency_out, speed_out, method_out],
+                concurrency_limit=None  # Concurrent users are batched by the scheduler
+            )
+        
+            with gr.Accordion("📥 Scheduler Stats", open=False):
+                stats_out = gr.JSON(label="Queue depth and batch sizes per mode")
+                stats_btn = gr.Button("🔄 Refresh")
+                stats_btn.click(
+                    lambda: {**{mode: sched.stats() for mode, sched in schedulers.items()},
+                             'response_cache': response_cache.stats() if response_cache else None,
+                             'workers': worker_pool.stats() if worker_pool else None},
+                    outputs=stats_out
                 )
-                mode_select = gr.Radio(
-                    choices=["Baseline (72B-AWQ Only)", "Speculative (7B→72B-AWQ)"],
-                    value="Speculative (7B→72B-AWQ)",
-                    label="Inference Mode",
-                    info="Compare standard vs accelerated inference"
+        
+            with gr.Accordion("🩺 Startup & Readiness", open=False):
+                startup_out = gr.JSON(label="Preload status and per-phase startup times (seconds)")
+                startup_btn = gr.Button("🔄 Refresh")
+                startup_btn.click(
+                    lambda: (worker_pool.readiness() if worker_pool else preloader.readiness() if preloader
+                             else {'status': "lazy: engines load on first use"}),
+                    outputs=startup_out
                 )
-                run_btn = gr.Button("🚀 Generate Response", variant="primary", size="lg")
-            
-            with gr.Column(scale=3):
-                output_text = gr.Textbox(label="📝 Generated Response", lines=8)
-                with gr.Row():
-                    latency_out = gr.Textbox(label="⏱️ Latency", scale=1)
-                    speed_out = gr.Textbox(label="🚀 Throughput", scale=1)
-                method_out = gr.Textbox(label="ℹ️ Model Information", lines=3)
+    
+        with gr.Tab("💬 Chat"):
+            gr.Markdown("### Multi-Turn Conversation")
+            gr.Markdown("Follow-ups resend the history, but its KV cache blocks are reused instead of recomputed.")
         
-        gr.Examples(
-            examples=enterprise_examples,
-            inputs=prompt_input,
-            label="Example Enterprise Prompts"
-        )
+            chat_mode = gr.Radio(
+                choices=["Baseline (72B-AWQ Only)", "Speculative (7B→72B-AWQ)"],
+                value="Speculative (7B→72B-AWQ)",
+                label="Inference Mode"
+            )
+            chatbot = gr.Chatbot(type="messages", height=420, label="Conversation")
+            chat_session = gr.State(None)
+            with gr.Row():
+                chat_input = gr.Textbox(placeholder="Type a message...", show_label=False, scale=5)
+                chat_send = gr.Button("💬 Send", variant="primary", scale=1)
+            chat_stats = gr.Markdown()
+            chat_clear = gr.Button("🗑️ New Conversation")
         
-        run_btn.click(
-            single_inference,
-            inputs=[prompt_input, mode_select],
-            outputs=[output_text, latency_out, speed_out, method_out]
-        )
+            for trigger in (chat_send.click, chat_input.submit):
+                trigger(
+                    chat_turn,
+                    inputs=[chat_input, chatbot, chat_mode, chat_session],
+                    outputs=[chatbot, chat_input, chat_session, chat_stats],
+                    concurrency_limit=None
+                )
+            chat_clear.click(lambda: ([], "", None, ""),
+                             outputs=[chatbot, chat_input, chat_session, chat_stats])
     
-    with gr.Tab("📊 Side-by-Side Comparison"):
-        gr.Markdown("### Direct Performance Comparison")
-        gr.Markdown("Run the same prompt through both methods to see the performance difference.")
-        gr.Markdown("⚠️ **Note:** This loads both models simultaneously and may require ~60GB GPU memory.")
+        with gr.Tab("📊 Side-by-Side Comparison"):
+            gr.Markdown("### Direct Performance Comparison")
+            gr.Markdown("Run the same prompt through both methods to see the performance difference.")
+            gr.Markdown("ℹ️ **Note:** Both modes share one resident 72B-AWQ target; only the 7B draft is added on top.")
         
-        compare_prompt = gr.Textbox(
-            label="Enter Prompt for Comparison",
-            placeholder="Enter your query to compare both inference methods...",
-            lines=3
-        )
+            compare_prompt = gr.Textbox(
+                label="Enter Prompt for Comparison",
+                placeholder="Enter your query to compare both inference methods...",
+                lines=3
+            )
         
-        compare_btn = gr.Button("⚡ Run Comparison", variant="primary", size="lg")
+            compare_btn = gr.Button("⚡ Run Comparison", variant="primary", size="lg")
         
-        with gr.Row():
-            with gr.Column():
-                gr.Markdown("### 🐢 Baseline (Sequential)")
-                baseline_output = gr.Textbox(label="Output", lines=10)
+            with gr.Row():
+                with gr.Column():
+                    gr.Markdown("### 🐢 Baseline (Sequential)")
+                    baseline_output = gr.Textbox(label="Output", lines=10)
             
-            with gr.Column():
-                gr.Markdown("### 🚀 Speculative (Parallel)")
-                spec_output = gr.Textbox(label="Output", lines=10)
+                with gr.Column():
+                    gr.Markdown("### 🚀 Speculative (Parallel)")
+                    spec_output = gr.Textbox(label="Output", lines=10)
         
-        performance_summary = gr.Markdown(label="Performance Analysis")
+            performance_summary = gr.Markdown(label="Performance Analysis")
         
-        gr.Examples(
-            examples=enterprise_examples,
-            inputs=compare_prompt,
-            label="Try These Examples"
-        )
+            gr.Examples(
+                examples=enterprise_examples,
+                inputs=compare_prompt,
+                label="Try These Examples"
+            )
         
-        compare_btn.click(
-            side_by_side_comparison,
-            inputs=compare_prompt,
-            outputs=[baseline_output, spec_output, performance_summary]
-        )
+            compare_btn.click(
+                side_by_side_comparison,
+                inputs=compare_prompt,
+                outputs=[baseline_output, spec_output, performance_summary],
+                concurrency_limit=None
+            )
     
-    with gr.Tab("ℹ️ About"):
-        gr.Markdown("""
-        ## How Speculative Decoding Works
+        with gr.Tab("ℹ️ About"):
+            gr.Markdown("""
+            ## How Speculative Decoding Works
         
-        **Traditional Approach (Baseline):**
-        - Generates tokens one at a time sequentially
-        - Each token requires a full model forward pass
-        - Limited by sequential dependencies
+            **Traditional Approach (Baseline):**
+            - Generates tokens one at a time sequentially
+            - Each token requires a full model forward pass
+            - Limited by sequential dependencies
         
-        **Speculative Decoding (Accelerated):**
-        1. **Draft Phase:** Small model (7B) quickly generates multiple token candidates
-        2. **Verification Phase:** Large model (72B) verifies all candidates in parallel
-        3. **Acceptance:** Keep correct predictions, regenerate incorrect ones
+            **Speculative Decoding (Accelerated):**
+            1. **Draft Phase:** Small model (7B) quickly generates multiple token candidates
+            2. **Verification Phase:** Large model (72B) verifies all candidates in parallel
+            3. **Acceptance:** Keep correct predictions, regenerate incorrect ones
         
-        **Result:** 2-4× faster inference with identical output quality!
+            **Result:** 2-4× faster inference with identical output quality!
         
-        ---
+            ---
         
-        ### Technical Specifications
+            ### Technical Specifications
         
-        - **Draft Model:** Qwen2.5-7B-Instruct (~14GB)
-        - **Target Model:** Qwen2.5-72B-Instruct-AWQ (~40GB, 4-bit quantized)
-        - **Hardware:** NVIDIA H100 (80GB)
-        - **Framework:** vLLM with speculative decoding
-        - **Expected Speedup:** 2.5-3.5×
+            - **Draft Model:** Qwen2.5-7B-Instruct (~14GB)
+            - **Target Model:** Qwen2.5-72B-Instruct-AWQ (~40GB, 4-bit quantized)
+            - **Hardware:** NVIDIA H100 (80GB)
+            - **Framework:** vLLM with speculative decoding
+            - **Expected Speedup:** 2.5-3.5×
         
-        ---
+            ---
         
-        ### Business Benefits
+            ### Business Benefits
         
-        ✅ **3× more throughput** with same hardware  
-        ✅ **Sub-2-second responses** for better UX  
-        ✅ **Zero quality loss** - same model outputs  
-        ✅ **Lower inference costs** per query  
-        """)
+            ✅ **3× more throughput** with same hardware  
+            ✅ **Sub-2-second responses** for better UX  
+            ✅ **Zero quality loss** - same model outputs  
+            ✅ **Lower inference costs** per query  
+            """)
+    return demo
+
 
 # Launch demo
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Qwen 2.5 AI Response Accelerator demo")
+    parser.add_argument("--lazy", action="store_true",
+                        help="Load engines on the first request instead of preloading at startup")
+    parser.add_argument("--status-port", type=int, default=8000,
+                        help="Port for the /health, /ready and /metrics endpoints")
+    parser.add_argument("--workers", choices=LAYOUTS, default=None,
+                        help="Host the engines in worker processes: shared (one engine, both modes) "
+                             "or isolated (one engine per mode, compared concurrently)")
+    parser.add_argument("--worker-devices", default=None,
+                        help="Isolated workers: GPUs per mode, e.g. baseline=0,speculative=1")
+    parser.add_argument("--request-timeout", type=float, default=None,
+                        help="Abort requests that have not finished after this many seconds")
+    parser.add_argument("--max-queued-tokens", type=int, default=None,
+                        help="Shed requests once admitted prompt + max_tokens would pass this")
+    parser.add_argument("--max-queue-wait", type=float, default=None,
+                        help="Shed requests whose projected wait passes this many seconds")
+    args = parser.parse_args()
+    scheduler_options.update(default_timeout=args.request_timeout, max_queued_tokens=args.max_queued_tokens,
+                             max_queue_wait=args.max_queue_wait)
+    
     print("\n" + "="*70)
     print("🌐 Launching Qwen 2.5 AI Response Accelerator Demo")
     print("="*70)
-    demo.launch(
+
+    # Opt-in: set $QWEN_RESPONSE_CACHE to "memory" or a cache directory
+    response_cache = cache_from_env()
+    register_scheduler_gauges(schedulers)  # Queue depth per mode on /metrics
+    
+    status = StatusServer(port=args.status_port)
+    status.add_route("/health", lambda: (200, {'status': "ok"}))
+    if args.workers:
+        devices = dict(item.split("=", 1) for item in args.worker_devices.split(",")) if args.worker_devices else None
+        worker_pool = WorkerPool(
+            args.workers,
+            prompt_policy="truncate",
+            generator_options={'adaptive_speculation': True,
+                               'speculation_log': "speculation_decisions.jsonl"},
+            devices=devices,
+            scheduler_options=scheduler_options
+        ).start()
+        status.add_route("/metrics", lambda: (200, worker_pool.metrics_text()),
+                         content_type=PROMETHEUS_CONTENT_TYPE)
+        status.add_route("/ready", lambda: (200 if worker_pool.ready else 503, worker_pool.readiness()))
+    elif not args.lazy:
+        status.add_route("/metrics", metrics_route(), content_type=PROMETHEUS_CONTENT_TYPE)
+        print("🚀 Models load in the background at launch...")
+        preloader = EnginePreloader(load_all_generators).start()
+        status.add_route("/ready", lambda: (200 if preloader.ready else 503, preloader.readiness()))
+    else:
+        status.add_route("/metrics", metrics_route(), content_type=PROMETHEUS_CONTENT_TYPE)
+        print("🚀 Models load on the first request (--lazy)")
+        lazy_load = True
+        status.add_route("/ready", lambda: (200, preloader.readiness() if preloader
+                                            else {'ready': True, 'status': "lazy"}))
+    status.start()
+    print("✅ Demo UI ready!")
+    
+    build_ui().launch(
         server_name="0.0.0.0",
         server_port=7860,
         share=True,  # Creates public link
@@ -1,40 +1,230 @@
 # download_models.py
-from huggingface_hub import snapshot_download
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import fnmatch
+import hashlib
+import json
 import os
+import shutil
+import sys
+import time
 
-def download_models():
-    """Download Qwen2.5 draft and target models"""
-    
-    models = {
-        "draft": "Qwen/Qwen2.5-7B-Instruct",
-        "target": "Qwen/Qwen2.5-72B-Instruct-AWQ"
-    }
-    
-    for name, model_id in models.items():
-        print(f"\n{'='*70}")
-        print(f"📦 Downloading {name.upper()} model: {model_id}")
-        print(f"{'='*70}")
-        
+MODELS = {
+    "draft": "Qwen/Qwen2.5-7B-Instruct",
+    "target": "Qwen/Qwen2.5-72B-Instruct-AWQ"
+}
+
+IGNORE_PATTERNS = ["*.md", "*.txt", "*.pdf", ".gitattributes"]  # Skip docs
+MANIFEST_NAME = "manifest.json"
+HASH_CHUNK_BYTES = 16 * 1024 * 1024
+
+def file_hashes(path, git_blob=False):
+    """sha256 of the file, or its git blob sha1 (what the hub lists for non-LFS files)"""
+    digest = hashlib.sha1() if git_blob else hashlib.sha256()
+    if git_blob:
+        digest.update(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, 'rb') as f:
+        while chunk := f.read(HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def fetch_remote_manifest(models):
+    """Pinned revision plus size and hash of every file to fetch, per model"""
+    from huggingface_hub import HfApi
+    api = HfApi()
+    manifest = {}
+    for name, repo_id in models.items():
+        info = api.model_info(repo_id, files_metadata=True)
+        files = {}
+        for sibling in info.siblings:
+            if any(fnmatch.fnmatch(sibling.rfilename, p) for p in IGNORE_PATTERNS):
+                continue
+            entry = {'size': sibling.size}
+            if sibling.lfs:
+                entry['sha256'] = sibling.lfs.sha256
+            else:
+                entry['git_sha1'] = sibling.blob_id
+            files[sibling.rfilename] = entry
+        manifest[name] = {'repo_id': repo_id, 'revision': info.sha, 'files': files}
+    return manifest
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def verify_file(path, expected, verify_all=False):
+    """None if ``path`` matches the manifest entry, otherwise why it does not.
+
+    A file whose size and mtime match its last successful check is not
+    hashed again unless ``verify_all``.
+    """
+    if not os.path.exists(path):
+        return "missing"
+    stat = os.stat(path)
+    if expected.get('size') is not None and stat.st_size != expected['size']:
+        return f"size {stat.st_size} != {expected['size']}"
+    if not verify_all and expected.get('verified_mtime_ns') == stat.st_mtime_ns:
+        return None
+    if 'sha256' in expected:
+        actual = file_hashes(path)
+        if actual != expected['sha256']:
+            return f"sha256 {actual[:12]}... != {expected['sha256'][:12]}..."
+    elif 'git_sha1' in expected:
+        actual = file_hashes(path, git_blob=True)
+        if actual != expected['git_sha1']:
+            return f"git sha1 {actual[:12]}... != {expected['git_sha1'][:12]}..."
+    expected['verified_mtime_ns'] = stat.st_mtime_ns
+    return None
+
+def fetch_file(repo_id, revision, filename, local_dir, mirror=None, offline=False):
+    dest = os.path.join(local_dir, filename)
+    if mirror:
+        source = os.path.join(mirror, repo_id, filename)
+        if not os.path.exists(source):
+            raise FileNotFoundError(f"not in mirror: {source}")
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        tmp_path = dest + ".partial"
+        shutil.copyfile(source, tmp_path)
+        os.replace(tmp_path, dest)
+        return
+    if offline:
+        raise FileNotFoundError("missing locally and running offline")
+    from huggingface_hub import hf_hub_download
+    hf_hub_download(repo_id=repo_id, filename=filename, revision=revision, local_dir=local_dir)
+
+def sync_file(name, model, filename, models_dir, mirror, offline, verify_all):
+    """Make one file present and verified; returns (status, bytes fetched, problem)"""
+    expected = model['files'][filename]
+    local_dir = os.path.join(models_dir, name)
+    path = os.path.join(local_dir, filename)
+
+    problem = verify_file(path, expected, verify_all)
+    if problem is None:
+        return "skipped", 0, None
+    if problem != "missing":
+        os.remove(path)  # Corrupt or partial: fetch it again from scratch
+
+    fetch_file(model['repo_id'], model.get('revision'), filename, local_dir, mirror, offline)
+    problem = verify_file(path, expected, verify_all=True)
+    if problem is not None:
+        return "corrupt", 0, problem
+    return "fetched", expected.get('size') or os.path.getsize(path), None
+
+def download_models(models=MODELS, models_dir="./models", workers=8, mirror=None, offline=False,
+                    verify_all=False):
+    """Fetch and verify Qwen2.5 draft and target models; returns True if every file is good.
+
+    All files of all models are fetched concurrently by ``workers`` threads.
+    Expected sizes and hashes come from the hub, or, with ``offline`` or a
+    ``mirror`` directory (laid out as ``<mirror>/<repo_id>/<file>``), from
+    the local manifest or the mirror's own manifest.json.
+    """
+    manifest_path = os.path.join(models_dir, MANIFEST_NAME)
+    os.makedirs(models_dir, exist_ok=True)
+    local_manifest = load_manifest(manifest_path) or {}
+
+    print(f"\n{'='*70}")
+    print(f"📦 Syncing {', '.join(f'{n} ({r})' for n, r in models.items())}")
+    print(f"{'='*70}")
+
+    if offline or mirror:
+        source = local_manifest
+        if mirror and not all(name in source for name in models):
+            source = {**(load_manifest(os.path.join(mirror, MANIFEST_NAME)) or {}), **source}
+        missing = [name for name in models if name not in source]
+        if missing:
+            print(f"❌ No manifest entry for {', '.join(missing)}; run once online to create {manifest_path}")
+            return False
+        manifest = {name: source[name] for name in models}
+        print(f"📴 Using {'mirror ' + mirror if mirror else 'local files only'} with the saved manifest")
+    else:
         try:
-            snapshot_download(
-                repo_id=model_id,
-                local_dir=f"./models/{name}",
-                local_dir_use_symlinks=False,
-                resume_download=True,
-                ignore_patterns=["*.md", "*.txt", "*.pdf"]  # Skip docs
-            )
-            print(f"✅ {name.upper()} model downloaded successfully!")
-            
+            manifest = fetch_remote_manifest(models)
         except Exception as e:
-            print(f"❌ Error downloading {name}: {e}")
-            print("Make sure you have access to Qwen models on HuggingFace")
-    
+            print(f"❌ Could not list model files on the hub: {e}")
+            print("Make sure you have access to Qwen models on HuggingFace, or use --offline / --mirror")
+            return False
+        # Keep verification stamps for files whose expected hash has not changed
+        for name, model in manifest.items():
+            previous = local_manifest.get(name, {}).get('files', {})
+            for filename, entry in model['files'].items():
+                old = previous.get(filename, {})
+                if old.get('sha256') == entry.get('sha256') and old.get('git_sha1') == entry.get('git_sha1'):
+                    if 'verified_mtime_ns' in old:
+                        entry['verified_mtime_ns'] = old['verified_mtime_ns']
+
+    tasks = [(name, filename) for name, model in manifest.items() for filename in sorted(model['files'])]
+    total_bytes = sum(manifest[n]['files'][f].get('size') or 0 for n, f in tasks)
+    print(f"🧾 {len(tasks)} files, {total_bytes / 1024**3:.1f} GB, {workers} workers")
+
+    start = time.perf_counter()
+    counts = {'skipped': 0, 'fetched': 0, 'corrupt': 0, 'failed': 0}
+    fetched_bytes = 0
+    failures = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(sync_file, name, manifest[name], filename, models_dir, mirror, offline, verify_all):
+                (name, filename)
+            for name, filename in tasks
+        }
+        for future in as_completed(futures):
+            name, filename = futures[future]
+            try:
+                status, size, problem = future.result()
+            except Exception as e:
+                status, size, problem = "failed", 0, str(e)
+            counts[status] += 1
+            fetched_bytes += size
+            if problem:
+                failures.append((name, filename, problem))
+                print(f"  ❌ {name}/{filename}: {problem}")
+            elif status == "fetched":
+                print(f"  ✅ {name}/{filename} ({size / 1024**2:.0f} MB)")
+
+    # Only verified files keep their stamp, so a failed file is checked in full next time
+    save_manifest(manifest_path, {**local_manifest, **manifest})
+    elapsed = time.perf_counter() - start
+
     print(f"\n{'='*70}")
-    print("✅ All models downloaded!")
+    print(f"📊 {counts['fetched']} fetched, {counts['skipped']} already complete, "
+          f"{counts['corrupt']} corrupt, {counts['failed']} failed "
+          f"({fetched_bytes / 1024**3:.1f} GB in {elapsed:.0f}s)")
+    if failures:
+        print(f"❌ {len(failures)} file(s) missing or corrupt; rerun to retry them")
+        print(f"{'='*70}")
+        return False
+
+    print("✅ All models downloaded and verified!")
     print(f"{'='*70}")
-    print(f"\nModels saved in: ./models/")
-    print(f"  - Draft:  ./models/draft/  (~14 GB)")
-    print(f"  - Target: ./models/target/ (~40 GB - AWQ quantized)")
+    print(f"\nModels saved in: {models_dir}/  (manifest: {manifest_path})")
+    print(f"  - Draft:  {models_dir}/draft/  (~14 GB)")
+    print(f"  - Target: {models_dir}/target/ (~40 GB - AWQ quantized)")
+    return True
 
 if __name__ == "__main__":
-    download_models()
+    parser = argparse.ArgumentParser(description="Download and verify the Qwen2.5 draft and target models")
+    parser.add_argument("--models", nargs="+", choices=list(MODELS), default=list(MODELS),
+                        help="Models to fetch (default: all)")
+    parser.add_argument("--models-dir", default="./models")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Files fetched concurrently across all models")
+    parser.add_argument("--mirror", default=None,
+                        help="Local mirror directory laid out as <mirror>/<repo_id>/<file>")
+    parser.add_argument("--offline", action="store_true",
+                        help="Do not contact the hub; verify local files against the saved manifest")
+    parser.add_argument("--verify-all", action="store_true",
+                        help="Re-hash every file, even ones verified on a previous run")
+    args = parser.parse_args()
+
+    selected = {name: MODELS[name] for name in args.models}
+    ok = download_models(selected, models_dir=args.models_dir, workers=args.workers,
+                         mirror=args.mirror, offline=args.offline, verify_all=args.verify_all)
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,318 @@
+# engine.py
+from backend import NGRAM_PROPOSER, InferenceBackend
+from contextlib import contextmanager
+import gc
+import time
+
+# vLLM Worker methods run while an engine is built, by startup phase (the draft worker subclasses Worker)
+STARTUP_PHASE_METHODS = {
+    'weight_load': "load_model",
+    'kv_cache_profiling': "determine_num_available_blocks",
+    'kv_cache_allocation': "_init_cache_engine",
+    'graph_capture': "_warm_up_model",
+}
+
+@contextmanager
+def profile_startup_phases():
+    """Time vLLM's worker startup steps while an engine is constructed in this process.
+
+    Yields a dict that fills with seconds per phase; phases whose method is
+    missing in the installed vLLM are simply not reported.
+    """
+    phases = {}
+    try:
+        from vllm.worker.worker import Worker
+    except ImportError:
+        yield phases
+        return
+
+    originals = {}
+    for phase, method in STARTUP_PHASE_METHODS.items():
+        original = getattr(Worker, method, None)
+        if original is None:
+            continue
+        originals[method] = original
+
+        def timed(self, *args, _original=original, _phase=phase, **kwargs):
+            start = time.perf_counter()
+            try:
+                return _original(self, *args, **kwargs)
+            finally:
+                phases[_phase] = phases.get(_phase, 0.0) + time.perf_counter() - start
+        setattr(Worker, method, timed)
+    try:
+        yield phases
+    finally:
+        for method, original in originals.items():
+            setattr(Worker, method, original)
+
+class QwenEngine(InferenceBackend):
+    """Owns the single resident Qwen2.5-72B-AWQ target engine.
+
+    With a draft model configured the engine is built with speculative
+    decoding, and baseline requests switch speculation off on the
+    spec-decode worker for the duration of their session, so both modes
+    share one copy of the target weights. If the worker does not expose
+    that switch, the engine is torn down and rebuilt in the requested mode
+    instead (a managed swap): still only one engine is resident at a time.
+    A ``draft_model_path`` of NGRAM_PROPOSER speculates by prompt lookup
+    instead: the next tokens after the latest earlier occurrence of the
+    last ``ngram_prompt_lookup_min``..``max`` tokens are proposed, so no
+    draft weights are loaded.
+    """
+
+    name = "vllm"
+
+    def __init__(self,
+                 target_model_path="./models/target",
+                 draft_model_path=None,
+                 num_speculative_tokens=5,
+                 gpu_memory_utilization=0.90,  # Only one target resident, rest goes to KV cache
+                 max_model_len=2048,
+                 speculative_disable_by_batch_size=None,
+                 use_v2_block_manager=True,
+                 enable_prefix_caching=True,
+                 ngram_prompt_lookup_max=4,
+                 ngram_prompt_lookup_min=1):
+        super().__init__()
+        self.target_model_path = target_model_path
+        self.draft_model_path = draft_model_path
+        self.num_speculative_tokens = num_speculative_tokens
+        self.gpu_memory_utilization = gpu_memory_utilization
+        self.max_model_len = max_model_len
+        # vLLM skips proposals for any step whose running batch reaches this size
+        self.speculative_disable_by_batch_size = speculative_disable_by_batch_size
+        self.use_v2_block_manager = use_v2_block_manager
+        # Multi-turn requests resend the history; cached KV blocks skip its prefill
+        self.enable_prefix_caching = enable_prefix_caching
+        self.ngram_prompt_lookup_max = ngram_prompt_lookup_max
+        self.ngram_prompt_lookup_min = ngram_prompt_lookup_min
+        self.speculation_length = num_speculative_tokens
+        self._active_speculation_length = 0
+
+        self.llm = None
+        self.speculative = None
+        self._spec_worker = None
+        self._spec_disable_threshold = None
+        # Filled by the wrapped proposer during step(); None when it could not be wrapped
+        self._step_proposals = None
+        self._load(speculative=self.supports_speculation)
+
+    @property
+    def supports_speculation(self):
+        return self.draft_model_path is not None
+
+    @property
+    def model_identity(self):
+        return {'backend': self.name, 'target_model': self.target_model_path,
+                'draft_model': self.draft_model_path, 'quantization': "awq"}
+
+    @property
+    def can_toggle_speculation(self):
+        """True when both modes are served without rebuilding the engine"""
+        return self._spec_worker is not None
+
+    def _engine_kwargs(self, speculative):
+        kwargs = dict(
+            model=self.target_model_path,
+            tensor_parallel_size=1,
+            gpu_memory_utilization=self.gpu_memory_utilization,
+            max_model_len=self.max_model_len,
+            trust_remote_code=True,  # Required for Qwen
+            quantization="awq",  # Use AWQ quantization to fit in 80GB
+            dtype="auto",
+            enable_prefix_caching=self.enable_prefix_caching
+        )
+        if speculative:
+            kwargs.update(
+                speculative_model=self.draft_model_path,
+                num_speculative_tokens=self.num_speculative_tokens,
+                speculative_disable_by_batch_size=self.speculative_disable_by_batch_size,
+                use_v2_block_manager=self.use_v2_block_manager
+            )
+            if self.draft_model_path == NGRAM_PROPOSER:
+                kwargs.update(ngram_prompt_lookup_max=self.ngram_prompt_lookup_max,
+                              ngram_prompt_lookup_min=self.ngram_prompt_lookup_min)
+        return kwargs
+
+    def _load(self, speculative):
+        start = time.perf_counter()
+        from vllm import LLM
+        import_time = time.perf_counter() - start
+        with profile_startup_phases() as phases:
+            self.llm = LLM(**self._engine_kwargs(speculative))
+        total = time.perf_counter() - start
+        self.startup_phases = {'import': import_time, **phases, 'engine_total': total}
+        self.startup_phases['other'] = max(total - sum(v for k, v in self.startup_phases.items()
+                                                       if k != 'engine_total'), 0.0)
+        self.speculative = speculative
+        self._active_speculation_length = self.num_speculative_tokens if speculative else 0
+        self._spec_worker = self._find_spec_decode_worker() if speculative else None
+        if self._spec_worker is not None:
+            self._spec_disable_threshold = self._spec_worker.disable_by_batch_size
+        self._step_proposals = self._watch_proposals(self._spec_worker)
+
+    def _find_spec_decode_worker(self):
+        # SpecDecodeWorker skips the proposer for a step once the running
+        # batch reaches disable_by_batch_size; 0 turns speculation off.
+        executor = getattr(self.llm.llm_engine, "model_executor", None)
+        worker = getattr(executor, "driver_worker", None)
+        return worker if hasattr(worker, "disable_by_batch_size") else None
+
+    def _watch_proposals(self, worker):
+        # The proposer reports a length per sequence; n-gram lookup proposes
+        # nothing for sequences without a match, and prefill or disabled steps
+        # never reach it. Returns the dict each step's proposals go into.
+        proposer = getattr(worker, "proposer_worker", None)
+        if proposer is None or not hasattr(proposer, "get_spec_proposals"):
+            return None
+        step_proposals = {}
+        get_spec_proposals = proposer.get_spec_proposals
+
+        def recording(execute_model_req, *args, **kwargs):
+            proposals = get_spec_proposals(execute_model_req, *args, **kwargs)
+            for metadata, length in zip(execute_model_req.seq_group_metadata_list,
+                                        proposals.proposal_lens.tolist()):
+                if length > 0:
+                    step_proposals[metadata.request_id] = length
+            return proposals
+
+        proposer.get_spec_proposals = recording
+        return step_proposals
+
+    def _unload(self):
+        self.llm = None
+        self._spec_worker = None
+        self._step_proposals = None
+        gc.collect()
+        try:
+            import torch
+            from vllm.distributed.parallel_state import (
+                destroy_distributed_environment, destroy_model_parallel)
+        except ImportError:
+            return
+        destroy_model_parallel()
+        destroy_distributed_environment()
+        torch.cuda.empty_cache()
+
+    def _set_mode(self, speculative):
+        if speculative and not self.supports_speculation:
+            raise ValueError("Speculative mode requested but no draft model is configured")
+
+        if self._spec_worker is not None:
+            self._apply_speculation_length(self.speculation_length if speculative else 0)
+            return
+
+        if self.speculative != speculative:
+            print(f"🔄 Swapping engine to {'speculative' if speculative else 'baseline'} mode...")
+            self._unload()
+            self._load(speculative)
+
+    @property
+    def active_speculation_length(self):
+        return self._active_speculation_length
+
+    def _apply_speculation_length(self, num_tokens):
+        self._active_speculation_length = num_tokens
+        self._spec_worker.disable_by_batch_size = self._spec_disable_threshold if num_tokens > 0 else 0
+        if num_tokens > 0:
+            # The scheduler reserves, and the proposer drafts, num_lookahead_slots
+            # tokens per step; lowering it below the configured value is safe
+            self.llm.llm_engine.scheduler_config.num_lookahead_slots = num_tokens
+
+    def set_speculation_length(self, num_tokens):
+        if self._spec_worker is None:
+            # Rebuilt engines keep their configured length; nothing to adjust
+            return self.num_speculative_tokens if self.speculative else 0
+        num_tokens = max(0, min(num_tokens, self.num_speculative_tokens))
+        if num_tokens > 0:
+            self.speculation_length = num_tokens
+        self._apply_speculation_length(num_tokens)
+        return num_tokens
+
+    def speculation_counters(self):
+        sampler = getattr(self._spec_worker, "spec_decode_sampler", None)
+        if sampler is None or sampler.num_accepted_tokens is None:
+            return None
+        return {
+            'draft_tokens': int(sampler.num_draft_tokens),
+            'accepted_tokens': int(sampler.num_accepted_tokens.item()),
+            'emitted_tokens': int(sampler.num_emitted_tokens.item()),
+            'steps': self.spec_steps,
+        }
+
+    def make_sampling_params(self, **kwargs):
+        from vllm import SamplingParams
+        return SamplingParams(**kwargs)
+
+    def get_tokenizer(self):
+        return self.llm.get_tokenizer()
+
+    def add_request(self, request_id, prompt, sampling_params):
+        self.llm.llm_engine.add_request(request_id, prompt, sampling_params)
+
+    def step(self):
+        if self._step_proposals is not None:
+            self._step_proposals.clear()
+            outputs = self.llm.llm_engine.step()
+            self.last_step_proposals = dict(self._step_proposals)
+        elif self.draft_model_path == NGRAM_PROPOSER:
+            # Without the proposer's own lengths per-sequence n-gram proposals are unknown;
+            # the rejection sampler totals in speculation_counters() still hold
+            outputs = self.llm.llm_engine.step()
+            self.last_step_proposals = {}
+        else:
+            outputs = self._step_assuming_full_proposals()
+        self.spec_steps += len(self.last_step_proposals)
+        return outputs
+
+    def _step_assuming_full_proposals(self):
+        k = self.active_speculation_length
+        running = set()
+        if k > 0:
+            schedulers = getattr(self.llm.llm_engine, "scheduler", None) or []
+            running = {group.request_id for scheduler in schedulers for group in scheduler.running}
+        outputs = self.llm.llm_engine.step()
+        # A draft-model decode step proposes k tokens for every running sequence unless the
+        # batch reaches disable_by_batch_size; a step that scheduled new requests was a prefill
+        threshold = getattr(self._spec_worker, "disable_by_batch_size", None)
+        prefill = any(output.request_id not in running for output in outputs)
+        if not running or prefill or (threshold is not None and len(running) >= threshold):
+            self.last_step_proposals = {}
+        else:
+            self.last_step_proposals = {request_id: k for request_id in running}
+        return outputs
+
+    def abort_request(self, request_ids):
+        self.llm.llm_engine.abort_request(request_ids)
+
+    def has_unfinished_requests(self):
+        return self.llm.llm_engine.has_unfinished_requests()
+
+    def generate(self, prompts, params_list):
+        return self.llm.generate(prompts, params_list, use_tqdm=False)
+
+    def metrics(self):
+        stats = {
+            'backend': self.name,
+            'speculative': self.speculative,
+            'can_toggle_speculation': self.can_toggle_speculation,
+        }
+        if self.llm is None:
+            return stats
+        engine = self.llm.llm_engine
+        stats['unfinished_requests'] = engine.get_num_unfinished_requests()
+        schedulers = getattr(engine, "scheduler", None) or []
+        if schedulers:
+            scheduler = schedulers[0]
+            stats['running'] = len(scheduler.running)
+            stats['waiting'] = len(scheduler.waiting)
+            total_blocks = engine.cache_config.num_gpu_blocks
+            if total_blocks:
+                free_blocks = scheduler.block_manager.get_num_free_gpu_blocks()
+                stats['kv_cache_usage'] = 1 - free_blocks / total_blocks
+        return stats
+
+    def shutdown(self):
+        with self.lock:
+            self._unload()
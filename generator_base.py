@@ -0,0 +1,564 @@
+# generator_base.py
+from prompt_pipeline import PromptPipeline, as_messages
+from metrics import count_errors, record_aborted, record_result
+from admission import RequestControl, aborted_error
+from contextlib import closing
+import time
+
+# Qwen-specific stop tokens
+QWEN_STOP_TOKENS = ["<|endoftext|>", "<|im_end|>"]
+
+DEFAULT_SAMPLING = {
+    'temperature': 0.7,
+    'top_p': 0.9,
+    'max_tokens': 256,
+    'stop': QWEN_STOP_TOKENS,
+}
+
+def speculative_metrics(draft_tokens, accepted_tokens, emitted_tokens, steps):
+    """Spec-decode metrics in vLLM's definitions from raw token and step counts.
+
+    ``steps`` counts verification steps per sequence, each proposing
+    ``draft_tokens / steps`` tokens and emitting the accepted prefix plus one.
+    """
+    return {
+        'draft_tokens': draft_tokens,
+        'accepted_tokens': accepted_tokens,
+        'emitted_tokens': emitted_tokens,
+        'steps': steps,
+        'acceptance_rate': accepted_tokens / draft_tokens if draft_tokens else 0,
+        'mean_accepted_per_step': accepted_tokens / steps if steps else 0,
+        'tokens_per_step': emitted_tokens / steps if steps else 0,
+        # Emitted tokens over the most the steps could have emitted (k + 1 each)
+        'system_efficiency': emitted_tokens / (draft_tokens + steps) if steps else 0,
+    }
+
+# Per-request latency phases, in seconds; see RequestTrace.phases
+LATENCY_PHASES = ('queue', 'prefill', 'ttft', 'decode', 'tpot', 'total')
+
+class RequestTrace:
+    """Token arrival bookkeeping for one request, fed from the engine step stream"""
+
+    def __init__(self, start_time):
+        self.start_time = start_time
+        self.num_tokens = 0
+        self.prefill_tokens = 0
+        self.decode_steps = 0
+        self.ttft = None
+        self.last_token_time = None
+        self.inter_token_latencies = []
+        # Decode steps verified speculatively, the draft tokens they proposed and the tokens they emitted
+        self.spec_steps = 0
+        self.draft_tokens = 0
+        self.spec_emitted_tokens = 0
+        # "deadline" or "cancelled" once the engine request was aborted
+        self.abort_reason = None
+
+    def update(self, num_tokens, now, proposed=None):
+        """Record the cumulative output length at ``now``; returns how many tokens are new.
+
+        ``proposed`` is the number of draft tokens the step verified for this
+        request (the engine's ``last_step_proposals``), None for a plain step.
+        """
+        new_tokens = num_tokens - self.num_tokens
+        if new_tokens <= 0:
+            return 0
+        if self.ttft is None:
+            # The prefill step emits the first token; later steps are decode/verify steps
+            self.ttft = now - self.start_time
+            self.prefill_tokens = new_tokens
+            gaps = [0.0] * (new_tokens - 1)
+        else:
+            self.decode_steps += 1
+            if proposed is not None:
+                self.spec_steps += 1
+                self.draft_tokens += proposed
+                self.spec_emitted_tokens += new_tokens
+            gaps = [now - self.last_token_time] + [0.0] * (new_tokens - 1)
+        # Tokens that arrive in the same engine step (accepted draft tokens) get 0
+        self.inter_token_latencies.extend(gaps)
+        self.last_token_time = now
+        self.num_tokens = num_tokens
+        return new_tokens
+
+    def phases(self, engine_metrics=None):
+        """Latency breakdown of the request, see LATENCY_PHASES.
+
+        ``ttft``, ``decode`` (first to last token), ``tpot`` (decode time per
+        output token after the first) and ``total`` come from this trace's
+        monotonic clock, measured from submission. ``queue`` (waiting for a
+        batch slot in the engine) and ``prefill`` (scheduled to first token)
+        need the engine's own RequestMetrics timestamps and are None when
+        the engine does not report them. Speculation only shortens decode.
+        """
+        if self.ttft is None:
+            return {phase: None for phase in LATENCY_PHASES}
+        total = self.last_token_time - self.start_time
+        decode = total - self.ttft
+        phases = {
+            'queue': None,
+            'prefill': None,
+            'ttft': self.ttft,
+            'decode': decode,
+            'tpot': decode / (self.num_tokens - 1) if self.num_tokens > 1 else None,
+            'total': total,
+        }
+        scheduled = getattr(engine_metrics, 'first_scheduled_time', None)
+        if scheduled is not None:
+            queue = getattr(engine_metrics, 'time_in_queue', None)
+            phases['queue'] = queue if queue is not None else scheduled - engine_metrics.arrival_time
+            first_token = getattr(engine_metrics, 'first_token_time', None)
+            if first_token is not None:
+                phases['prefill'] = first_token - scheduled
+        return phases
+
+    def speculation(self):
+        """Per-request spec metrics over the steps that speculated, each emitting accepted + 1 tokens.
+
+        Steps run with speculation off (batch too large, length set to 0)
+        are left out, and each step counts the draft length it used.
+        """
+        if not self.spec_steps:
+            return None
+        accepted = max(self.spec_emitted_tokens - self.spec_steps, 0)
+        return speculative_metrics(self.draft_tokens, accepted, self.spec_emitted_tokens, self.spec_steps)
+
+class QwenGeneratorBase:
+    """Prompt formatting and generate/generate_batch/generate_stream shared by both generators"""
+
+    def __init__(self, engine, speculative, cache=None, prompt_policy="reject", **sampling_overrides):
+        # engine: any backend.InferenceBackend (vLLM or the CPU simulator)
+        # cache: optional response_cache.ResponseCache, may be shared by both modes
+        # prompt_policy: "reject" or "truncate" prompts that do not fit max_model_len
+        self.engine = engine
+        self.speculative = speculative
+        self.mode = "speculative" if speculative else "baseline"  # Metrics label
+        self.cache = cache
+        self.sampling_config = {**DEFAULT_SAMPLING, **sampling_overrides}
+        self.sampling_params = engine.make_sampling_params(**self.sampling_config)
+        self.prompts = PromptPipeline(engine.get_tokenizer(), engine.max_model_len, policy=prompt_policy)
+        self._speculation_totals = {'draft_tokens': 0, 'accepted_tokens': 0,
+                                    'emitted_tokens': 0, 'steps': 0}
+
+    def _session(self, batch_size=1):
+        """Exclusive engine access in this generator's mode for ``batch_size`` requests"""
+        return self.engine.session(self.speculative)
+
+    def _before_step(self, engine, batch_size):
+        """Called before every batched engine step with the number of unfinished requests"""
+
+    def format_prompt(self, prompt):
+        """Format prompt with the model's chat template; ``prompt`` may also be a list of chat messages"""
+        return self.prompts.render(as_messages(prompt))
+
+    def prepare_prompt(self, prompt, sampling_overrides=None):
+        """Rendered text and token ids that fit max_model_len with the request's max_tokens.
+
+        Raises prompt_pipeline.PromptTooLongError under the reject policy,
+        before anything is queued on the engine.
+        """
+        max_tokens = (sampling_overrides or {}).get('max_tokens', self.sampling_config['max_tokens'])
+        return self.prompts.prepare(prompt, max_tokens)
+
+    def make_sampling_params(self, overrides=None):
+        """Default sampling params, or a fresh copy with ``overrides`` applied"""
+        if not overrides:
+            return self.sampling_params
+        return self.engine.make_sampling_params(**{**self.sampling_config, **overrides})
+
+    @staticmethod
+    def _abort_check(controls, traces, on_abort=None):
+        """``should_abort`` for InferenceBackend.stream from per-request RequestControls (or None).
+
+        Records the deadline/cancel reason on the request's trace and calls
+        ``on_abort(index)``. Reads ``controls`` and ``traces`` at call time,
+        so requests appended to them later are covered too.
+        """
+        def should_abort(i):
+            reason = controls[i].abort_reason() if controls[i] is not None else None
+            if reason is None:
+                return False
+            traces[i].abort_reason = reason
+            if on_abort is not None:
+                on_abort(i)
+            return True
+        return should_abort
+
+    def _build_result(self, output, latency, trace=None):
+        completion = output.outputs[0]
+        num_tokens = len(completion.token_ids)
+        result = {
+            'text': completion.text.strip(),
+            'latency': latency,
+            'tokens': num_tokens,
+            'tokens_per_sec': num_tokens / latency if latency > 0 else 0,
+            'cache_hit': False,
+            'finish_reason': completion.finish_reason,
+            'prompt_tokens': len(output.prompt_token_ids),
+            # Prompt tokens served from the engine's prefix cache (None if the engine does not say)
+            'cached_prompt_tokens': getattr(output, 'num_cached_tokens', None),
+            'phases': trace.phases(getattr(output, 'metrics', None)) if trace is not None else None
+        }
+        speculation = trace.speculation() if trace is not None else None
+        if speculation is not None:
+            result['speculation'] = speculation
+            for key in self._speculation_totals:
+                self._speculation_totals[key] += speculation[key]
+        return result
+
+    def _cache_key(self, formatted_prompt, sampling_overrides):
+        """Response cache key, or None when caching is off or the request is not cacheable"""
+        if self.cache is None:
+            return None
+        sampling_config = {**self.sampling_config, **(sampling_overrides or {})}
+        if not self.cache.cacheable(sampling_config):
+            return None
+        model = {**self.engine.model_identity, 'speculative': self.speculative}
+        return self.cache.make_key(model, formatted_prompt, sampling_config)
+
+    def _cached_result(self, cache_key, start_time):
+        cached = self.cache.get(cache_key) if cache_key is not None else None
+        if cached is None:
+            return None
+        latency = time.perf_counter() - start_time
+        return {
+            'text': cached['text'],
+            'latency': latency,
+            'tokens': cached['tokens'],
+            'tokens_per_sec': cached['tokens'] / latency if latency > 0 else 0,
+            'cache_hit': True
+        }
+
+    def _store_result(self, cache_key, result):
+        if cache_key is not None:
+            self.cache.put(cache_key, {'text': result['text'], 'tokens': result['tokens']})
+
+    def speculation_summary(self):
+        """Cumulative spec-decode metrics over every request this generator served"""
+        return speculative_metrics(**self._speculation_totals)
+
+    def generate(self, prompt, sampling_overrides=None, timeout=None, control=None):
+        """Generate response with timing.
+
+        ``timeout`` (seconds) or an admission.RequestControl bounds the
+        request: once it expires or is cancelled the engine request is
+        aborted and RequestAborted is raised with the partial text.
+        """
+        if control is None and timeout:
+            control = RequestControl(timeout)
+        with count_errors(self.mode):
+            prepared = self.prepare_prompt(prompt, sampling_overrides)
+            cache_key = self._cache_key(prepared['text'], sampling_overrides)
+            cached = self._cached_result(cache_key, time.perf_counter())
+            if cached is not None:
+                record_result(self.mode, cached)
+                return dict(cached, prompt_truncated=prepared['truncated'])
+            params = self.make_sampling_params(sampling_overrides)
+
+            with self._session() as engine:
+                start_time = time.perf_counter()
+                outputs, traces = self._run_requests(engine, [prepared['token_ids']], [params], controls=[control])
+                latency = time.perf_counter() - start_time
+
+            if traces[0].abort_reason is not None:
+                record_aborted(self.mode, traces[0].abort_reason)
+                raise aborted_error(traces[0].abort_reason, self._partial_text(outputs[0]))
+            result = self._build_result(outputs[0], latency, traces[0])
+            self._store_result(cache_key, result)
+            record_result(self.mode, result)
+            result['prompt_truncated'] = prepared['truncated']
+            return result
+
+    def _chunk_by_token_budget(self, prompt_token_ids, params_list, max_batch_tokens):
+        """Split prompt indices into chunks whose prompt + max_tokens fit the budget"""
+        if not prompt_token_ids:
+            return []
+        if not max_batch_tokens:
+            return [list(range(len(prompt_token_ids)))]
+
+        chunks, current, used = [], [], 0
+        for i, (token_ids, params) in enumerate(zip(prompt_token_ids, params_list)):
+            cost = len(token_ids) + params.max_tokens
+            if current and used + cost > max_batch_tokens:
+                chunks.append(current)
+                current, used = [], 0
+            current.append(i)
+            used += cost
+        if current:
+            chunks.append(current)
+        return chunks
+
+    @staticmethod
+    def _partial_text(output):
+        return output.outputs[0].text.strip() if output is not None else ""
+
+    def _run_requests(self, engine, prompt_token_ids, params_list, on_update=None, controls=None,
+                      on_finish=None, more=None):
+        """Drive the engine step loop for a set of pre-tokenized requests.
+
+        Returns the final outputs and a RequestTrace per request, in order.
+        ``on_update(index, output)`` is called from this thread for every
+        intermediate and final engine output. ``controls`` holds an optional
+        RequestControl per request; a request whose deadline passes or that
+        is cancelled is aborted on the engine between steps, its trace gets
+        the ``abort_reason`` and its output is the last partial one (or None).
+        ``on_finish(index, output, trace)`` is called as soon as a request
+        completes or is aborted. ``more()`` is polled before every engine
+        step for further ``(token_ids, params, control)`` requests to add to
+        the running set; they take the next indices. _before_step() then
+        gets the number of unfinished requests.
+        """
+        controls = list(controls) if controls is not None else [None] * len(prompt_token_ids)
+        final_outputs = [None] * len(prompt_token_ids)
+        start_time = time.perf_counter()
+        traces = [RequestTrace(start_time) for _ in prompt_token_ids]
+        engine_prompts = [{'prompt_token_ids': token_ids} for token_ids in prompt_token_ids]
+
+        def on_abort(i):
+            if on_finish is not None:
+                on_finish(i, final_outputs[i], traces[i])
+
+        def add_more():
+            added = more() if more is not None else []
+            now = time.perf_counter()
+            for token_ids, params, control in added:
+                controls.append(control)
+                final_outputs.append(None)
+                traces.append(RequestTrace(now))
+            unfinished = sum(1 for output, trace in zip(final_outputs, traces)
+                             if trace.abort_reason is None and not (output is not None and output.finished))
+            self._before_step(engine, unfinished)
+            return [{'prompt_token_ids': token_ids} for token_ids, _, _ in added], [params for _, params, _ in added]
+
+        watch = more is not None or any(control is not None for control in controls)
+        # closing(): abort leftovers right away (still inside the session) if on_update raises
+        updates = engine.stream(engine_prompts, params_list, prefix="batch",
+                                should_abort=self._abort_check(controls, traces, on_abort) if watch else None,
+                                more=add_more)
+        with closing(updates):
+            for i, output in updates:
+                traces[i].update(len(output.outputs[0].token_ids), time.perf_counter(),
+                                 engine.last_step_proposals.get(output.request_id))
+                if on_update is not None:
+                    on_update(i, output)
+                final_outputs[i] = output
+                if output.finished and on_finish is not None:
+                    on_finish(i, output, traces[i])
+        return final_outputs, traces
+
+    def _aborted_result(self, output, latency, trace):
+        """Result for a request stopped by its RequestControl; not cached or counted as a completion"""
+        num_tokens = trace.num_tokens
+        return {
+            'text': self._partial_text(output),
+            'latency': latency,
+            'tokens': num_tokens,
+            'tokens_per_sec': num_tokens / latency if latency > 0 else 0,
+            'cache_hit': False,
+            'finish_reason': "abort",
+            'aborted': trace.abort_reason,
+            'prompt_tokens': len(output.prompt_token_ids) if output is not None else None,
+        }
+
+    def generate_batch(self, prompts, sampling_overrides=None, max_batch_tokens=None, on_update=None, controls=None,
+                       on_result=None, admit=None):
+        """Generate responses for many prompts in as few engine calls as possible.
+
+        ``sampling_overrides`` is either one dict applied to every prompt or a
+        list with one dict (or None) per prompt. ``max_batch_tokens`` caps the
+        prompt + max_tokens budget of each engine call; prompts beyond it are
+        submitted in further chunks. ``on_update(index, output)`` receives every
+        intermediate engine output, keyed by position in ``prompts``. Response
+        cache hits are filled in without reaching the engine. Every prompt is
+        checked against max_model_len before any of them is queued.
+        ``controls`` holds an optional RequestControl per prompt; prompts
+        aborted by theirs get a result with ``aborted`` set to the reason,
+        ``finish_reason`` "abort" and the partial text.
+
+        Each result's latency runs from its engine call's start (or its
+        joining) to its own last token. ``on_result(index, result)`` gets
+        every result as soon as it is ready rather than when the batch ends.
+        ``admit()`` is polled between engine steps for further
+        ``(prompt, sampling_overrides, control)`` requests, which join the
+        running engine call (continuous batching) and take the indices after
+        ``prompts``.
+        """
+        controls = list(controls) if controls is not None else [None] * len(prompts)
+        with count_errors(self.mode, len(prompts)):
+            if isinstance(sampling_overrides, (list, tuple)):
+                if len(sampling_overrides) != len(prompts):
+                    raise ValueError("sampling_overrides must have one entry per prompt")
+                overrides_list = list(sampling_overrides)
+                params_list = [self.make_sampling_params(o) for o in sampling_overrides]
+            else:
+                overrides_list = [sampling_overrides] * len(prompts)
+                params_list = [self.make_sampling_params(sampling_overrides)] * len(prompts)
+
+            prepared = [self.prepare_prompt(p, o) for p, o in zip(prompts, overrides_list)]
+            batch_start = time.perf_counter()
+
+            results = [None] * len(prompts)
+
+            def finish(i, result):
+                if result.get('aborted'):
+                    record_aborted(self.mode, result['aborted'])
+                else:
+                    record_result(self.mode, result)
+                result['prompt_truncated'] = prepared[i]['truncated']
+                results[i] = result
+                if on_result is not None:
+                    on_result(i, result)
+
+            cache_keys = [self._cache_key(p['text'], o) for p, o in zip(prepared, overrides_list)]
+            for i, cache_key in enumerate(cache_keys):
+                cached = self._cached_result(cache_key, batch_start)
+                if cached is not None:
+                    finish(i, cached)
+            pending = [i for i, result in enumerate(results) if result is None]
+            chunks = [[pending[j] for j in chunk] for chunk in self._chunk_by_token_budget(
+                [prepared[i]['token_ids'] for i in pending], [params_list[i] for i in pending], max_batch_tokens)]
+
+            def join():
+                """Indices of newly admitted requests that need the engine; cache hits finish right away"""
+                joined = []
+                for prompt, overrides, control in admit():
+                    i = len(results)
+                    prepared.append(self.prepare_prompt(prompt, overrides))
+                    params_list.append(self.make_sampling_params(overrides))
+                    controls.append(control)
+                    cache_keys.append(self._cache_key(prepared[i]['text'], overrides))
+                    results.append(None)
+                    cached = self._cached_result(cache_keys[i], time.perf_counter())
+                    if cached is not None:
+                        finish(i, cached)
+                    else:
+                        joined.append(i)
+                return joined
+
+            engine_counts = {'draft_tokens': 0, 'accepted_tokens': 0, 'emitted_tokens': 0, 'steps': 0}
+            for chunk in chunks:
+                chunk_update = None
+                if on_update is not None:
+                    chunk_update = lambda j, output, chunk=chunk: on_update(chunk[j], output)
+
+                def chunk_finish(j, output, trace, chunk=chunk):
+                    i = chunk[j]
+                    latency = time.perf_counter() - trace.start_time
+                    if trace.abort_reason is not None:
+                        finish(i, self._aborted_result(output, latency, trace))
+                        return
+                    result = self._build_result(output, latency, trace)
+                    self._store_result(cache_keys[i], result)
+                    finish(i, result)
+
+                def chunk_more(chunk=chunk):
+                    joined = join()
+                    chunk.extend(joined)
+                    return [(prepared[i]['token_ids'], params_list[i], controls[i]) for i in joined]
+
+                with self._session(batch_size=len(chunk)) as engine:
+                    num_speculative_tokens = engine.active_speculation_length
+                    counters_before = engine.speculation_counters()
+                    self._run_requests(
+                        engine,
+                        [prepared[i]['token_ids'] for i in chunk],
+                        [params_list[i] for i in chunk],
+                        on_update=chunk_update,
+                        controls=[controls[i] for i in chunk],
+                        on_finish=chunk_finish,
+                        more=chunk_more if admit is not None else None
+                    )
+                    counters_after = engine.speculation_counters()
+                if num_speculative_tokens and counters_before and counters_after:
+                    for key in ('draft_tokens', 'accepted_tokens', 'emitted_tokens'):
+                        engine_counts[key] += counters_after[key] - counters_before[key]
+                    engine_counts['steps'] += counters_after['steps'] - counters_before['steps']
+            total_latency = time.perf_counter() - batch_start
+
+            total_tokens = sum(r['tokens'] for r in results)
+            batch = {
+                'results': results,
+                'num_prompts': len(results),
+                'num_chunks': len(chunks),
+                'cache_hits': sum(1 for r in results if r['cache_hit']),
+                'latency': total_latency,
+                'total_tokens': total_tokens,
+                'tokens_per_sec': total_tokens / total_latency if total_latency > 0 else 0
+            }
+            if engine_counts['steps']:
+                # Exact batch-wide counts from the engine's rejection sampler
+                batch['speculation'] = speculative_metrics(**engine_counts)
+            return batch
+
+    def generate_stream(self, prompt, sampling_overrides=None, use_cache=True, timeout=None, control=None):
+        """Yield incremental text as the engine decodes it.
+
+        Every update is a dict with the new ``delta`` text, the cumulative
+        ``text`` and ``finished``. The final update also carries the usual
+        result fields plus ``ttft`` (seconds to the first token) and
+        ``inter_token_latencies`` (gap before each later token; tokens that
+        arrive in the same engine step, e.g. accepted draft tokens, get 0).
+        A response cache hit is delivered as a single final update;
+        ``use_cache=False`` always runs the engine (e.g. for warmup).
+        ``timeout`` or ``control`` abort the request as in ``generate``;
+        closing the stream before the final update counts as a cancellation.
+        """
+        if control is None and timeout:
+            control = RequestControl(timeout)
+        with count_errors(self.mode):
+            prepared = self.prepare_prompt(prompt, sampling_overrides)
+            cache_key = self._cache_key(prepared['text'], sampling_overrides) if use_cache else None
+            cached = self._cached_result(cache_key, time.perf_counter())
+            if cached is not None:
+                cached.update({'delta': cached['text'], 'finished': True, 'prompt_truncated': prepared['truncated'],
+                               'ttft': cached['latency'], 'inter_token_latencies': []})
+                record_result(self.mode, cached)
+                yield cached
+                return
+            params = self.make_sampling_params(sampling_overrides)
+
+            text = ""
+            with self._session() as engine:
+                start_time = time.perf_counter()
+                trace = RequestTrace(start_time)
+                # Leaving this loop early closes the engine stream, which aborts
+                # the request and frees its KV blocks
+                should_abort = self._abort_check([control], [trace]) if control is not None else None
+                updates = engine.stream([{'prompt_token_ids': prepared['token_ids']}], [params], prefix="stream",
+                                        should_abort=should_abort)
+                finished = False
+                try:
+                    with closing(updates):
+                        for _, output in updates:
+                            completion = output.outputs[0]
+                            trace.update(len(completion.token_ids), time.perf_counter(),
+                                         engine.last_step_proposals.get(output.request_id))
+                            delta = completion.text[len(text):]
+                            text = completion.text
+                            if not output.finished:
+                                if delta:
+                                    yield {'delta': delta, 'text': text, 'finished': False}
+                                continue
+
+                            latency = time.perf_counter() - start_time
+                            result = self._build_result(output, latency, trace)
+                            result.update({
+                                'delta': delta,
+                                'finished': True,
+                                'ttft': trace.ttft if trace.ttft is not None else latency,
+                                'inter_token_latencies': trace.inter_token_latencies
+                            })
+                            self._store_result(cache_key, result)
+                            record_result(self.mode, result)
+                            result['prompt_truncated'] = prepared['truncated']
+                            finished = True
+                            yield result
+                except GeneratorExit:
+                    # The consumer stopped reading (e.g. the client disconnected)
+                    if not finished:
+                        record_aborted(self.mode, "cancelled")
+                    raise
+
+            if trace.abort_reason is not None:
+                record_aborted(self.mode, trace.abort_reason)
+                raise aborted_error(trace.abort_reason, text.strip())
@@ -0,0 +1,216 @@
+# load_test.py
+from benchmark import DEMO_PROMPTS, load_generators
+from bench_stats import latency_summary
+from scheduler import MicroBatchScheduler
+import argparse
+import asyncio
+import json
+import random
+import time
+
+def load_trace(path):
+    """Read a JSONL trace: one request per line with ``prompt`` and optional arrival and max_tokens.
+
+    The arrival time may be given as ``timestamp``, ``arrival_time`` or
+    ``arrival`` (seconds); arrivals are made relative to the first request.
+    """
+    requests = []
+    with open(path) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if 'prompt' not in record:
+                raise ValueError(f"{path}:{line_no}: trace record has no 'prompt'")
+            arrival = record.get('timestamp', record.get('arrival_time', record.get('arrival', 0.0)))
+            requests.append({
+                'prompt': record['prompt'],
+                'arrival': float(arrival),
+                'max_tokens': record.get('max_tokens'),
+            })
+    if not requests:
+        raise ValueError(f"{path}: trace has no requests")
+    requests.sort(key=lambda r: r['arrival'])
+    start = requests[0]['arrival']
+    for request in requests:
+        request['arrival'] -= start
+    return requests
+
+def poisson_arrivals(qps, num_requests, prompts=DEMO_PROMPTS, max_tokens=None, seed=0):
+    """Open-loop Poisson arrivals at ``qps``, cycling through ``prompts``"""
+    rng = random.Random(seed)
+    arrival = 0.0
+    requests = []
+    for i in range(num_requests):
+        requests.append({'prompt': prompts[i % len(prompts)], 'arrival': arrival, 'max_tokens': max_tokens})
+        arrival += rng.expovariate(qps)
+    return requests
+
+def scale_arrivals(requests, rate_multiplier):
+    """Replay a trace ``rate_multiplier`` times faster (2.0 doubles the offered load)"""
+    return [dict(r, arrival=r['arrival'] / rate_multiplier) for r in requests]
+
+async def run_load(scheduler, requests):
+    """Fire every request at its arrival time, without waiting for earlier ones to finish"""
+    records = []
+    in_flight = 0
+    concurrency_samples = []
+    start = time.perf_counter()
+
+    async def one(request):
+        nonlocal in_flight
+        delay = start + request['arrival'] - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        overrides = {'max_tokens': request['max_tokens']} if request['max_tokens'] else None
+        sent = time.perf_counter()
+        in_flight += 1
+        concurrency_samples.append(in_flight)
+        try:
+            result = None
+            async for update in scheduler.stream(request['prompt'], overrides):
+                result = update
+            records.append({
+                'arrival': request['arrival'],
+                'latency': time.perf_counter() - sent,
+                'ttft': result['ttft'],
+                'tokens': result['tokens'],
+                'batch_size': result['batch_size'],
+                'error': None,
+            })
+        except Exception as e:
+            records.append({'arrival': request['arrival'], 'latency': None, 'ttft': None,
+                            'tokens': 0, 'batch_size': 0, 'error': str(e)})
+        finally:
+            in_flight -= 1
+
+    await asyncio.gather(*(one(r) for r in requests))
+    duration = time.perf_counter() - start
+    return records, duration, concurrency_samples
+
+def summarize_level(mode, level, offered_qps, records, duration, concurrency_samples):
+    ok = [r for r in records if r['error'] is None]
+    latency = latency_summary([r['latency'] for r in ok])
+    ttft = latency_summary([r['ttft'] for r in ok])
+    total_tokens = sum(r['tokens'] for r in ok)
+    return {
+        'mode': mode,
+        'level': level,
+        'offered_qps': round(offered_qps, 3),
+        'requests': len(records),
+        'errors': len(records) - len(ok),
+        'duration': round(duration, 3),
+        'throughput_rps': round(len(ok) / duration, 3) if duration > 0 else 0,
+        'throughput_tps': round(total_tokens / duration, 1) if duration > 0 else 0,
+        'mean_concurrency': round(sum(concurrency_samples) / len(concurrency_samples), 2) if concurrency_samples else 0,
+        'mean_batch_size': round(sum(r['batch_size'] for r in ok) / len(ok), 2) if ok else 0,
+        'latency_p50': round(latency.get('p50', 0), 3),
+        'latency_p99': round(latency.get('p99', 0), 3),
+        'ttft_p50': round(ttft.get('p50', 0), 3),
+        'ttft_p99': round(ttft.get('p99', 0), 3),
+    }
+
+def find_crossover(rows):
+    """Lowest load level at which speculative p50 latency is no better than baseline"""
+    by_level = {}
+    for row in rows:
+        by_level.setdefault(row['level'], {})[row['mode']] = row
+    for level in sorted(by_level):
+        modes = by_level[level]
+        if 'baseline' in modes and 'speculative' in modes:
+            if modes['speculative']['latency_p50'] >= modes['baseline']['latency_p50']:
+                return level
+    return None
+
+def run_load_test(levels, trace_path=None, num_requests=64, max_tokens=None, modes=("baseline", "speculative"),
+                  window_ms=5, max_batch_size=32, seed=0, backend=None, **generator_options):
+    """Sweep load levels for each mode and report throughput against latency percentiles.
+
+    With a trace, each level is a replay speed multiplier; otherwise it is
+    the Poisson arrival rate in requests per second. Requests go through
+    MicroBatchScheduler, so arrivals join the running engine call between
+    steps rather than queueing behind a whole batch.
+    """
+    print("\n" + "="*80)
+    print("🎯 QWEN 2.5 OPEN-LOOP LOAD TEST")
+    print("="*80)
+
+    trace = load_trace(trace_path) if trace_path else None
+    if trace:
+        span = trace[-1]['arrival']
+        print(f"\n📼 Replaying {len(trace)} requests from {trace_path} ({span:.1f}s trace)")
+    else:
+        print(f"\n🎲 Poisson arrivals, {num_requests} requests per level")
+
+    print("\n[1/2] Loading shared engine (Qwen2.5-7B → Qwen2.5-72B-AWQ)...")
+    baseline, speculative = load_generators(backend=backend, **generator_options)
+    generators = {'baseline': baseline, 'speculative': speculative}
+
+    print(f"\n[2/2] Sweeping levels {list(levels)} for {', '.join(modes)}...")
+    rows = []
+    for mode in modes:
+        scheduler = MicroBatchScheduler(generators[mode], window_ms=window_ms, max_batch_size=max_batch_size)
+        try:
+            for level in levels:
+                if trace:
+                    requests = scale_arrivals(trace, level)
+                    span = requests[-1]['arrival']
+                    # n arrivals span n - 1 inter-arrival gaps
+                    offered_qps = (len(requests) - 1) / span if span > 0 else float(len(requests))
+                else:
+                    requests = poisson_arrivals(level, num_requests, max_tokens=max_tokens, seed=seed)
+                    offered_qps = level
+                records, duration, concurrency = asyncio.run(run_load(scheduler, requests))
+                row = summarize_level(mode, level, offered_qps, records, duration, concurrency)
+                rows.append(row)
+                print(f"  [{mode.upper():11}] level {level:<6} offered {row['offered_qps']:.2f} qps → "
+                      f"{row['throughput_rps']:.2f} req/s, {row['throughput_tps']:.0f} tok/s | "
+                      f"p50 {row['latency_p50']:.2f}s p99 {row['latency_p99']:.2f}s | "
+                      f"concurrency {row['mean_concurrency']:.1f}")
+        finally:
+            scheduler.shutdown()
+
+    crossover = find_crossover(rows)
+    print("\n" + "="*80)
+    if crossover is None:
+        print("✅ Speculative p50 latency beat baseline at every level tested")
+    else:
+        print(f"⚠️  Crossover: at level {crossover} speculative p50 latency is no better than baseline")
+
+    output_file = 'qwen_load_test_results.json'
+    with open(output_file, 'w') as f:
+        json.dump({'levels': list(levels), 'trace': trace_path, 'crossover_level': crossover,
+                   'results': rows}, f, indent=2)
+    print(f"\n📁 Results saved: {output_file}")
+
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Open-loop load test for baseline vs speculative decoding")
+    parser.add_argument("--trace", default=None,
+                        help="JSONL trace with prompt, timestamp and max_tokens per line (default: Poisson)")
+    parser.add_argument("--levels", default="0.5,1,2,4,8",
+                        help="Comma-separated Poisson QPS values, or replay speed multipliers with --trace")
+    parser.add_argument("--num-requests", type=int, default=64,
+                        help="Poisson mode: requests per level")
+    parser.add_argument("--max-tokens", type=int, default=None,
+                        help="Poisson mode: max_tokens per request (default: generator default)")
+    parser.add_argument("--modes", default="baseline,speculative")
+    parser.add_argument("--window-ms", type=float, default=5)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=["vllm", "sim"], default=None)
+    args = parser.parse_args()
+
+    run_load_test(
+        levels=[float(x) for x in args.levels.split(",")],
+        trace_path=args.trace,
+        num_requests=args.num_requests,
+        max_tokens=args.max_tokens,
+        modes=tuple(args.modes.split(",")),
+        window_ms=args.window_ms,
+        max_batch_size=args.max_batch_size,
+        seed=args.seed,
+        backend=args.backend
+    )
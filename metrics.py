@@ -0,0 +1,220 @@
+# metrics.py
+from admission import RequestAborted, RequestShed
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+TTFT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+TPOT_BUCKETS = (0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2, 0.5)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{n}="{v}"' for (n, _), v in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic count per label set, e.g. ``requests.inc("speculative")``"""
+
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, labels), value) for labels, value in items]
+
+class Gauge(Counter):
+    """Point-in-time value; ``collect`` (if given) returns ``{label_values: value}`` at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), collect=None):
+        super().__init__(name, help, labelnames)
+        self.collect = collect
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def samples(self):
+        if self.collect is not None:
+            for label_values, value in self.collect().items():
+                self.set(value, *label_values)
+        return super().samples()
+
+class Histogram:
+    """Bucketed observations per label set; only the bucket index is computed on the hot path"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+
+    def snapshot(self, *label_values):
+        """Count and sum for one label set"""
+        series = self._series.get(label_values)
+        if series is None:
+            return {'count': 0, 'sum': 0.0}
+        return {'count': sum(series[:-1]), 'sum': series[-1]}
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        samples = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                le = bound if bound == "+Inf" else _format_value(float(bound))
+                samples.append((f"{self.name}_bucket",
+                                _format_labels(self.labelnames, labels, [('le', le)]), cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.labelnames, labels), series[-1]))
+            samples.append((f"{self.name}_count", _format_labels(self.labelnames, labels), cumulative))
+        return samples
+
+class MetricsRegistry:
+    """Named metrics rendered together in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), collect=None):
+        return self._register(Gauge(name, help, labelnames, collect))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+# Serving-path metrics, labelled by generator mode
+REQUESTS = REGISTRY.counter("qwen_requests_total", "Completed generation requests", ("mode",))
+CACHE_HITS = REGISTRY.counter("qwen_response_cache_hits_total", "Requests served from the response cache", ("mode",))
+ERRORS = REGISTRY.counter("qwen_request_errors_total", "Failed generation requests", ("mode", "error"))
+PROMPT_TOKENS = REGISTRY.counter("qwen_prompt_tokens_total", "Prompt tokens sent to the engine", ("mode",))
+GENERATED_TOKENS = REGISTRY.counter("qwen_generated_tokens_total", "Output tokens generated", ("mode",))
+DRAFT_TOKENS = REGISTRY.counter("qwen_spec_draft_tokens_total", "Draft tokens proposed", ("mode",))
+ACCEPTED_TOKENS = REGISTRY.counter("qwen_spec_accepted_tokens_total", "Draft tokens accepted", ("mode",))
+LATENCY = REGISTRY.histogram("qwen_request_latency_seconds", "End-to-end latency of engine-served requests",
+                             ("mode",))
+TTFT = REGISTRY.histogram("qwen_time_to_first_token_seconds", "Time to first token", ("mode",),
+                          buckets=TTFT_BUCKETS)
+TPOT = REGISTRY.histogram("qwen_time_per_output_token_seconds", "Decode time per output token after the first",
+                          ("mode",), buckets=TPOT_BUCKETS)
+ABORTED = REGISTRY.counter("qwen_requests_aborted_total", "Requests stopped by a deadline or cancellation",
+                           ("mode", "reason"))
+SHED = REGISTRY.counter("qwen_requests_shed_total", "Requests turned away by admission control", ("mode", "reason"))
+ACCEPTANCE = REGISTRY.histogram("qwen_spec_acceptance_rate", "Per-request draft acceptance rate", ("mode",),
+                                buckets=RATIO_BUCKETS)
+
+def record_result(mode, result):
+    """Count one finished generator result (engine-served or a response cache hit)"""
+    REQUESTS.inc(mode)
+    GENERATED_TOKENS.inc(mode, amount=result['tokens'])
+    if result.get('cache_hit'):
+        # Near-zero hit latencies would skew the serving-latency histograms
+        CACHE_HITS.inc(mode)
+        return
+    LATENCY.observe(result['latency'], mode)
+    PROMPT_TOKENS.inc(mode, amount=result.get('prompt_tokens') or 0)
+    phases = result.get('phases') or {}
+    if phases.get('ttft') is not None:
+        TTFT.observe(phases['ttft'], mode)
+    if phases.get('tpot') is not None:
+        TPOT.observe(phases['tpot'], mode)
+    speculation = result.get('speculation')
+    if speculation:
+        DRAFT_TOKENS.inc(mode, amount=speculation['draft_tokens'])
+        ACCEPTED_TOKENS.inc(mode, amount=speculation['accepted_tokens'])
+        ACCEPTANCE.observe(speculation['acceptance_rate'], mode)
+
+def record_error(mode, error, count=1):
+    ERRORS.inc(mode, type(error).__name__, amount=count)
+
+def record_aborted(mode, reason):
+    ABORTED.inc(mode, reason)
+
+def record_shed(mode, reason):
+    SHED.inc(mode, reason)
+
+@contextmanager
+def count_errors(mode, count=1):
+    """Record any exception escaping the block against ``mode``, then re-raise it.
+
+    Aborted and shed requests have counters of their own.
+    """
+    try:
+        yield
+    except (RequestAborted, RequestShed):
+        raise
+    except Exception as e:
+        record_error(mode, e, count)
+        raise
+
+def register_scheduler_gauges(schedulers, registry=REGISTRY):
+    """Queue depth and in-flight gauges read from ``{mode: MicroBatchScheduler}`` at scrape time"""
+    for name, help, key in (("qwen_scheduler_queue_depth", "Requests waiting for a batch", 'queue_depth'),
+                            ("qwen_scheduler_in_flight", "Requests in the batch on the engine", 'in_flight'),
+                            ("qwen_scheduler_queued_tokens", "Prompt + max_tokens admitted and not finished",
+                             'queued_tokens'),
+                            ("qwen_scheduler_projected_wait_seconds", "Projected wait for a new request",
+                             'projected_wait')):
+        gauge = registry.metrics.get(name) or registry.gauge(name, help, ("mode",))
+        # Re-registering points the gauge at the newest set of schedulers
+        gauge.collect = lambda key=key: {(mode,): s.stats().get(key, 0) for mode, s in list(schedulers.items())}
+
+def metrics_route(registry=REGISTRY):
+    """StatusServer handler for /metrics"""
+    return lambda: (200, registry.render())
@@ -0,0 +1,316 @@
+# openai_server.py
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from admission import DeadlineExceeded, RequestCancelled, RequestShed
+from benchmark import load_generators
+from generator_base import QWEN_STOP_TOKENS
+from metrics import PROMETHEUS_CONTENT_TYPE, REGISTRY, register_scheduler_gauges
+from prompt_pipeline import PromptTooLongError
+from response_cache import cache_from_env
+from scheduler import MicroBatchScheduler
+from contextlib import aclosing, asynccontextmanager
+import argparse
+import asyncio
+import json
+import math
+import time
+import uuid
+
+MODEL_NAME = "qwen2.5-72b-instruct-awq"
+MODES = ("baseline", "speculative")
+
+class BadRequest(ValueError):
+    """Client error, returned as an OpenAI-style 400"""
+
+    def __init__(self, message, param=None, code=None):
+        super().__init__(message)
+        self.param = param
+        self.code = code
+
+def error_response(status, message, error_type="invalid_request_error", param=None, code=None):
+    return JSONResponse(status_code=status, content={
+        'error': {'message': message, 'type': error_type, 'param': param, 'code': code}})
+
+def resolve_mode(body, default_mode):
+    """``mode`` in the body, else a ``:baseline`` / ``:speculative`` model suffix, else the default.
+
+    Other suffixes (``qwen2.5:latest``, ``org/model:v1``) are client model tags, not modes, and are ignored.
+    """
+    mode = body.get('mode')
+    model = body.get('model') or MODEL_NAME
+    if mode is None and isinstance(model, str) and model.rsplit(":", 1)[-1] in MODES:
+        mode = model.rsplit(":", 1)[1]
+    mode = mode or default_mode
+    if mode not in MODES:
+        raise BadRequest(f"Unknown mode {mode!r}; expected one of {', '.join(MODES)}", param="mode")
+    return mode
+
+def request_timeout(body, default):
+    """``timeout`` seconds from the body (an extension field), else the server default"""
+    timeout = body.get('timeout')
+    if timeout is None:
+        return default
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+        raise BadRequest("timeout must be a positive number of seconds", param="timeout")
+    return float(timeout)
+
+def overloaded_response(error):
+    response = error_response(503, str(error), error_type="server_error", code="overloaded")
+    response.headers['Retry-After'] = str(max(math.ceil(error.projected_wait), 1))
+    return response
+
+def sampling_overrides(body):
+    """Generator sampling overrides from the OpenAI request fields we support"""
+    # bool is an int subclass; true/false are not numbers here
+    if isinstance(body.get('n', 1), bool) or body.get('n', 1) != 1:
+        raise BadRequest("Only n=1 is supported", param="n")
+    overrides = {}
+    max_tokens = body.get('max_completion_tokens', body.get('max_tokens'))
+    if max_tokens is not None:
+        if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1:
+            raise BadRequest("max_tokens must be a positive integer", param="max_tokens")
+        overrides['max_tokens'] = max_tokens
+    for key in ('temperature', 'top_p'):
+        if body.get(key) is not None:
+            if isinstance(body[key], bool) or not isinstance(body[key], (int, float)):
+                raise BadRequest(f"{key} must be a number", param=key)
+            overrides[key] = float(body[key])
+    if body.get('seed') is not None:
+        if isinstance(body['seed'], bool) or not isinstance(body['seed'], int):
+            raise BadRequest("seed must be an integer", param="seed")
+        overrides['seed'] = body['seed']
+    stop = body.get('stop')
+    if stop:
+        # Qwen's end-of-turn tokens always stop generation
+        overrides['stop'] = QWEN_STOP_TOKENS + ([stop] if isinstance(stop, str) else list(stop))
+    return overrides
+
+def chat_messages(body):
+    messages = body.get('messages')
+    if not isinstance(messages, list) or not messages:
+        raise BadRequest("messages must be a non-empty list", param="messages")
+    parsed = []
+    for message in messages:
+        content = message.get('content') if isinstance(message, dict) else None
+        if isinstance(content, list):
+            # Text-only content parts
+            content = "".join(part.get('text', "") for part in content if part.get('type') == "text")
+        if not isinstance(content, str) or message.get('role') not in ("system", "user", "assistant"):
+            raise BadRequest("Each message needs a system/user/assistant role and text content",
+                             param="messages")
+        parsed.append({'role': message['role'], 'content': content})
+    return parsed
+
+def completion_prompt(body):
+    prompt = body.get('prompt')
+    if isinstance(prompt, list) and len(prompt) == 1:
+        prompt = prompt[0]
+    if not isinstance(prompt, str):
+        raise BadRequest("prompt must be a single string", param="prompt")
+    return prompt
+
+def usage(generator, prompt, overrides, result):
+    prompt_tokens = result.get('prompt_tokens')
+    if prompt_tokens is None:
+        # Response cache hits skip the engine; the pipeline has the ids cached
+        prompt_tokens = len(generator.prepare_prompt(prompt, overrides)['token_ids'])
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': result['tokens'],
+            'total_tokens': prompt_tokens + result['tokens']}
+
+def sse(payload):
+    return f"data: {json.dumps(payload)}\n\n"
+
+def create_app(generators, default_mode="speculative", window_ms=5, max_batch_size=32, request_timeout_s=None,
+               max_queued_tokens=None, max_queue_wait=None):
+    """OpenAI-compatible API over ``{mode: generator}``.
+
+    Concurrent requests for a mode are micro-batched into the shared engine
+    by its MicroBatchScheduler. Both routes take the usual sampling fields,
+    ``stream`` for server-sent events, and a ``mode`` field (or a
+    ``:baseline`` / ``:speculative`` model suffix) picking the generator.
+    ``/v1/completions`` prompts are sent as a single user turn, since every
+    prompt in this repo goes through the chat template.
+
+    A ``timeout`` body field (default ``request_timeout_s``) bounds each
+    request: past it the engine request is aborted and a 504 returned.
+    Clients that disconnect have their request aborted too. Requests shed
+    by admission control (``max_queued_tokens``, ``max_queue_wait``) get a
+    503 with Retry-After.
+    """
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        for scheduler in schedulers.values():
+            scheduler.shutdown()
+
+    app = FastAPI(title="Qwen 2.5 speculative decoding API", lifespan=lifespan)
+    schedulers = {mode: MicroBatchScheduler(gen, window_ms=window_ms, max_batch_size=max_batch_size,
+                                            max_queued_tokens=max_queued_tokens, max_queue_wait=max_queue_wait,
+                                            default_timeout=request_timeout_s)
+                  for mode, gen in generators.items()}
+    register_scheduler_gauges(schedulers)
+
+    async def respond(request, kind):
+        try:
+            body = await request.json()
+        except ValueError:
+            return error_response(400, "Request body must be JSON")
+        try:
+            if not isinstance(body, dict):
+                raise BadRequest("Request body must be a JSON object")
+            mode = resolve_mode(body, default_mode)
+            overrides = sampling_overrides(body)
+            timeout = request_timeout(body, request_timeout_s)
+            prompt = chat_messages(body) if kind == "chat" else completion_prompt(body)
+            # Fails fast on prompts that do not fit max_model_len
+            generators[mode].prepare_prompt(prompt, overrides)
+            if body.get('stream'):
+                # Streams cannot change their status once started: shed before sending headers
+                schedulers[mode].check_admission(prompt, overrides, timeout)
+        except PromptTooLongError as e:
+            return error_response(400, str(e), param="messages" if kind == "chat" else "prompt",
+                                  code="context_length_exceeded")
+        except BadRequest as e:
+            return error_response(400, str(e), param=e.param, code=e.code)
+        except RequestShed as e:
+            return overloaded_response(e)
+
+        request_id = f"{'chatcmpl' if kind == 'chat' else 'cmpl'}-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = f"{MODEL_NAME}:{mode}"
+        if body.get('stream'):
+            include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
+            events = stream_events(kind, request_id, created, model, generators[mode], schedulers[mode],
+                                   prompt, overrides, include_usage, timeout)
+            return StreamingResponse(events, media_type="text/event-stream",
+                                     headers={'Cache-Control': "no-cache", 'X-Accel-Buffering': "no"})
+
+        try:
+            result = await until_disconnected(request, schedulers[mode].submit(prompt, overrides, timeout))
+        except RequestShed as e:
+            return overloaded_response(e)
+        except DeadlineExceeded:
+            return error_response(504, f"Request did not finish within {timeout}s", error_type="server_error",
+                                  code="deadline_exceeded")
+        except RequestCancelled:
+            # Nobody is listening any more
+            return error_response(499, "Client closed the request", code="client_closed_request")
+        finish_reason = result.get('finish_reason') or "stop"
+        if kind == "chat":
+            choice = {'index': 0, 'message': {'role': "assistant", 'content': result['text']},
+                      'finish_reason': finish_reason}
+        else:
+            choice = {'index': 0, 'text': result['text'], 'finish_reason': finish_reason}
+        return JSONResponse({
+            'id': request_id,
+            'object': "chat.completion" if kind == "chat" else "text_completion",
+            'created': created,
+            'model': model,
+            'choices': [choice],
+            'usage': usage(generators[mode], prompt, overrides, result),
+        })
+
+    async def until_disconnected(request, coroutine, poll_interval=0.25):
+        """Await ``coroutine``, cancelling it (and so its engine request) if the client disconnects"""
+        task = asyncio.ensure_future(coroutine)
+        try:
+            while not task.done():
+                await asyncio.wait((task,), timeout=poll_interval)
+                if not task.done() and await request.is_disconnected():
+                    task.cancel()
+                    raise RequestCancelled()
+            return task.result()
+        finally:
+            task.cancel()
+
+    async def stream_events(kind, request_id, created, model, generator, scheduler, prompt, overrides,
+                            include_usage, timeout):
+        base = {'id': request_id, 'created': created, 'model': model,
+                'object': "chat.completion.chunk" if kind == "chat" else "text_completion"}
+
+        def chunk(text, finish_reason=None):
+            if kind == "chat":
+                delta = {'content': text} if text else {}
+                choice = {'index': 0, 'delta': delta, 'finish_reason': finish_reason}
+            else:
+                choice = {'index': 0, 'text': text, 'finish_reason': finish_reason}
+            return sse({**base, 'choices': [choice]})
+
+        if kind == "chat":
+            yield sse({**base, 'choices': [{'index': 0, 'delta': {'role': "assistant"}, 'finish_reason': None}]})
+        try:
+            # aclosing(): a client disconnect closes the scheduler stream right away, which cancels the request
+            async with aclosing(scheduler.stream(prompt, overrides, timeout)) as updates:
+                async for update in updates:
+                    if not update['finished']:
+                        yield chunk(update['delta'])
+                        continue
+                    if update['delta']:
+                        yield chunk(update['delta'])
+                    yield chunk("", update.get('finish_reason') or "stop")
+                    if include_usage:
+                        yield sse({**base, 'choices': [], 'usage': usage(generator, prompt, overrides, update)})
+        except DeadlineExceeded:
+            # The text streamed so far stands; the error event marks it as cut short
+            yield sse({'error': {'message': f"Request did not finish within {timeout}s", 'type': "server_error",
+                                 'param': None, 'code': "deadline_exceeded"}})
+        except Exception as e:
+            # Headers are already sent; report the failure in-band
+            yield sse({'error': {'message': str(e), 'type': "server_error", 'param': None, 'code': None}})
+        yield "data: [DONE]\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        return await respond(request, "chat")
+
+    @app.post("/v1/completions")
+    async def completions(request: Request):
+        return await respond(request, "completion")
+
+    @app.get("/v1/models")
+    async def models():
+        names = [MODEL_NAME] + [f"{MODEL_NAME}:{mode}" for mode in generators]
+        return {'object': "list",
+                'data': [{'id': name, 'object': "model", 'created': 0, 'owned_by': "local"} for name in names]}
+
+    @app.get("/health")
+    async def health():
+        return {'status': "ok", 'schedulers': {mode: s.stats() for mode, s in schedulers.items()}}
+
+    @app.get("/metrics")
+    async def metrics():
+        return PlainTextResponse(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+    return app
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="OpenAI-compatible API for the Qwen 2.5 generators")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--backend", choices=["vllm", "sim"], default=None,
+                        help="Inference backend (default: $QWEN_BACKEND or vllm); sim runs on CPU")
+    parser.add_argument("--default-mode", choices=MODES, default="speculative",
+                        help="Mode for requests that do not pick one")
+    parser.add_argument("--window-ms", type=float, default=5,
+                        help="Micro-batching window per mode")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--request-timeout", type=float, default=None,
+                        help="Default per-request deadline in seconds (requests may set 'timeout')")
+    parser.add_argument("--max-queued-tokens", type=int, default=None,
+                        help="Shed requests once admitted prompt + max_tokens would pass this")
+    parser.add_argument("--max-queue-wait", type=float, default=None,
+                        help="Shed requests whose projected wait passes this many seconds")
+    parser.add_argument("--keep-alive", type=int, default=30,
+                        help="Seconds an idle keep-alive connection stays open")
+    args = parser.parse_args()
+
+    print("🚀 Loading shared engine (Qwen2.5-7B → Qwen2.5-72B-AWQ)...")
+    baseline, speculative = load_generators(backend=args.backend, cache=cache_from_env())
+    app = create_app({'baseline': baseline, 'speculative': speculative}, default_mode=args.default_mode,
+                     window_ms=args.window_ms, max_batch_size=args.max_batch_size,
+                     request_timeout_s=args.request_timeout, max_queued_tokens=args.max_queued_tokens,
+                     max_queue_wait=args.max_queue_wait)
+    print(f"🌐 OpenAI-compatible API on http://{args.host}:{args.port}/v1")
+    uvicorn.run(app, host=args.host, port=args.port, timeout_keep_alive=args.keep_alive, log_level="warning")
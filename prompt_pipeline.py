@@ -0,0 +1,136 @@
+# prompt_pipeline.py
+from collections import OrderedDict
+import threading
+
+# What Qwen2.5's chat template inserts when a conversation has no system message
+QWEN_DEFAULT_SYSTEM_PROMPT = "You are Qwen, created by Alibaba Cloud. You are a helpful assistant."
+
+class PromptTooLongError(ValueError):
+    """Prompt plus max_tokens does not fit in the engine's max_model_len"""
+
+def render_chatml(messages, add_generation_prompt=True):
+    """Qwen2.5's chat template (without tool calls), for tokenizers that do not ship one"""
+    if not messages or messages[0]['role'] != 'system':
+        messages = [{'role': 'system', 'content': QWEN_DEFAULT_SYSTEM_PROMPT}] + list(messages)
+    text = "".join(f"<|im_start|>{m['role']}\n{m['content']}<|im_end|>\n" for m in messages)
+    return text + ("<|im_start|>assistant\n" if add_generation_prompt else "")
+
+def as_messages(prompt):
+    """A plain prompt string becomes one user message; message lists are copied as role/content"""
+    if isinstance(prompt, str):
+        return [{'role': 'user', 'content': prompt}]
+    return [{'role': m['role'], 'content': m['content']} for m in prompt]
+
+class PromptPipeline:
+    """Chat-template rendering, tokenization and the context-length guard, done once per prompt.
+
+    Prompts are rendered with the tokenizer's own chat template and their
+    token ids are kept in an LRU keyed by rendered text. A conversation's
+    earlier turns (including a shared system prompt) are cached as a prefix,
+    so a new turn only tokenizes its tail. ``prepare`` checks that the
+    prompt plus ``max_tokens`` fits ``max_model_len`` before anything is
+    queued: ``policy="reject"`` raises PromptTooLongError, ``"truncate"``
+    drops the oldest turns and then the start of the last message.
+    """
+
+    def __init__(self, tokenizer, max_model_len, policy="reject", cache_size=1024):
+        if policy not in ("reject", "truncate"):
+            raise ValueError(f"Unknown prompt policy: {policy!r} (expected 'reject' or 'truncate')")
+        self.tokenizer = tokenizer
+        self.max_model_len = max_model_len
+        self.policy = policy
+        self.cache_size = cache_size
+        self._token_cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'cache_hits': 0, 'cache_misses': 0, 'truncated': 0, 'rejected': 0}
+
+    def render(self, messages, add_generation_prompt=True):
+        if getattr(self.tokenizer, 'chat_template', None):
+            return self.tokenizer.apply_chat_template(
+                messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+        return render_chatml(messages, add_generation_prompt)
+
+    def _cached(self, text):
+        with self._lock:
+            token_ids = self._token_cache.get(text)
+            if token_ids is not None:
+                self._token_cache.move_to_end(text)
+                self.counters['cache_hits'] += 1
+            return token_ids
+
+    def _store(self, text, token_ids):
+        with self._lock:
+            self.counters['cache_misses'] += 1
+            self._token_cache[text] = token_ids
+            while len(self._token_cache) > self.cache_size:
+                self._token_cache.popitem(last=False)
+        return token_ids
+
+    def _encode(self, text):
+        token_ids = self._cached(text)
+        if token_ids is None:
+            token_ids = self._store(text, self.tokenizer.encode(text))
+        return token_ids
+
+    def tokenize(self, messages):
+        """Rendered text and its token ids, reusing the cached ids of earlier turns"""
+        text = self.render(messages)
+        token_ids = self._cached(text)
+        if token_ids is not None:
+            return text, token_ids
+        if len(messages) > 1:
+            prefix = self.render(messages[:-1], add_generation_prompt=False)
+            if text.startswith(prefix):
+                # Turns start with the <|im_start|> special token, so splitting there tokenizes the same
+                token_ids = self._encode(prefix) + self.tokenizer.encode(text[len(prefix):])
+                return text, self._store(text, token_ids)
+        return text, self._store(text, self.tokenizer.encode(text))
+
+    def prepare(self, prompt, max_tokens):
+        """Rendered ``text`` and ``token_ids`` for a prompt string or message list.
+
+        ``truncated`` says whether the truncate policy had to shorten it.
+        """
+        messages = as_messages(prompt)
+        budget = self.max_model_len - max_tokens
+        text, token_ids = self.tokenize(messages)
+        if len(token_ids) <= budget:
+            return {'text': text, 'token_ids': token_ids, 'truncated': False}
+        if self.policy == "reject" or budget <= 0:
+            self.counters['rejected'] += 1
+            raise PromptTooLongError(
+                f"Prompt is {len(token_ids)} tokens; with max_tokens={max_tokens} it does not fit "
+                f"max_model_len={self.max_model_len}")
+        prepared = self._truncate(messages, budget)
+        self.counters['truncated'] += 1
+        return prepared
+
+    def _truncate(self, messages, budget):
+        system = messages[:1] if messages[0]['role'] == 'system' else []
+        turns = messages[len(system):]
+        # Drop the oldest user/assistant exchanges first, always keeping the last message
+        while len(turns) > 1:
+            turns = turns[2:] if len(turns) > 2 else turns[-1:]
+            text, token_ids = self.tokenize(system + turns)
+            if len(token_ids) <= budget:
+                return {'text': text, 'token_ids': token_ids, 'truncated': True}
+
+        # Then keep only the end of the last message
+        last = turns[-1]
+        content_ids = self.tokenizer.encode(last['content'])
+        overhead = len(self.tokenize(system + [dict(last, content="")])[1])
+        keep = budget - overhead
+        while keep > 0:
+            content = self.tokenizer.decode(content_ids[-keep:])
+            text, token_ids = self.tokenize(system + [dict(last, content=content)])
+            if len(token_ids) <= budget:
+                return {'text': text, 'token_ids': token_ids, 'truncated': True}
+            # Decoding and re-encoding can merge differently at the cut; shrink and retry
+            keep -= len(token_ids) - budget
+        self.counters['rejected'] += 1
+        raise PromptTooLongError(
+            f"The chat template alone takes {overhead} tokens, more than the {budget} left "
+            f"after max_tokens in max_model_len={self.max_model_len}")
+
+    def stats(self):
+        return {**self.counters, 'cached_prompts': len(self._token_cache)}
@@ -0,0 +1,152 @@
+# response_cache.py
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+
+# Enables the cache in demo_ui: "memory" for the in-memory tier only, or a directory for both tiers
+CACHE_ENV_VAR = "QWEN_RESPONSE_CACHE"
+# Set to 1 to also cache sampled (temperature > 0, unseeded) responses
+CACHE_SAMPLED_ENV_VAR = "QWEN_RESPONSE_CACHE_SAMPLED"
+
+def is_deterministic(sampling_config):
+    """Greedy decoding or a fixed seed: the same request always produces the same text"""
+    return sampling_config.get('temperature', 1.0) == 0 or sampling_config.get('seed') is not None
+
+class ResponseCache:
+    """Finished generation results, keyed on model, formatted prompt and sampling params.
+
+    A size-bounded in-memory LRU sits over an optional on-disk tier (one
+    JSON file per entry under ``disk_path``). Entries older than ``ttl``
+    seconds are evicted from both tiers when they are read or by
+    ``evict_expired``. Only deterministic requests are cached unless
+    ``allow_nondeterministic`` is set. Safe to share between threads and
+    between the baseline and speculative generators.
+    """
+
+    def __init__(self, max_entries=256, disk_path=None, ttl=24 * 3600, allow_nondeterministic=False):
+        self.max_entries = max_entries
+        self.disk_path = disk_path
+        self.ttl = ttl
+        self.allow_nondeterministic = allow_nondeterministic
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0,
+                         'uncacheable': 0, 'evictions': 0}
+        if disk_path:
+            os.makedirs(disk_path, exist_ok=True)
+
+    def cacheable(self, sampling_config):
+        if self.allow_nondeterministic or is_deterministic(sampling_config):
+            return True
+        with self._lock:
+            self.counters['uncacheable'] += 1
+        return False
+
+    @staticmethod
+    def make_key(model_identity, formatted_prompt, sampling_config):
+        payload = json.dumps({'model': model_identity, 'prompt': formatted_prompt,
+                              'sampling': sampling_config}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _disk_file(self, key):
+        return os.path.join(self.disk_path, f"{key}.json")
+
+    def get(self, key):
+        """Cached result dict for ``key``, or None"""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and self._expired(entry['created']):
+                del self._memory[key]
+                self.counters['evictions'] += 1
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return dict(entry['result'])
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['disk_hits'] += 1
+            self._remember(key, entry)
+        return dict(entry['result'])
+
+    def put(self, key, result):
+        entry = {'created': time.time(), 'result': result}
+        with self._lock:
+            self._remember(key, entry)
+            self.counters['stores'] += 1
+        if self.disk_path:
+            path = self._disk_file(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)  # Readers never see a half-written entry
+
+    def _remember(self, key, entry):
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.counters['evictions'] += 1
+
+    def _read_disk(self, key):
+        if not self.disk_path:
+            return None
+        path = self._disk_file(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if self._expired(entry['created']):
+            self._remove_file(path)
+            return None
+        return entry
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            self.counters['evictions'] += 1
+
+    def evict_expired(self):
+        """Drop every expired entry from both tiers; returns how many were removed"""
+        before = self.counters['evictions']
+        with self._lock:
+            for key in [k for k, e in self._memory.items() if self._expired(e['created'])]:
+                del self._memory[key]
+                self.counters['evictions'] += 1
+        if self.disk_path:
+            for name in os.listdir(self.disk_path):
+                if name.endswith(".json"):
+                    self._read_disk(name[:-len(".json")])
+        return self.counters['evictions'] - before
+
+    def stats(self):
+        hits = self.counters['memory_hits'] + self.counters['disk_hits']
+        lookups = hits + self.counters['misses']
+        return {
+            **self.counters,
+            'hits': hits,
+            'hit_rate': hits / lookups if lookups else 0,
+            'memory_entries': len(self._memory),
+        }
+
+def cache_from_env():
+    """ResponseCache configured by $QWEN_RESPONSE_CACHE, or None when it is unset"""
+    setting = os.environ.get(CACHE_ENV_VAR)
+    if not setting:
+        return None
+    return ResponseCache(disk_path=None if setting == "memory" else setting,
+                         allow_nondeterministic=os.environ.get(CACHE_SAMPLED_ENV_VAR) == "1")
@@ -0,0 +1,260 @@
+# result_store.py
+from importlib import metadata
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+RESULTS_STORE = "qwen_benchmark_runs.jsonl"
+
+# Compared metrics and whether a larger value is better
+COMPARE_METRICS = {
+    'baseline_latency': False,
+    'speculative_latency': False,
+    'baseline_ttft': False,
+    'speculative_ttft': False,
+    'baseline_tpot': False,
+    'speculative_tpot': False,
+    'baseline_tokens_per_sec': True,
+    'speculative_tokens_per_sec': True,
+    'speedup': True,
+    'draft_speedup': True,
+    'ngram_speedup': True,
+}
+
+def load_store(path):
+    """Records already in an append-only JSONL store, skipping a torn last line"""
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"⚠️  Ignoring unreadable line in {path}")
+    return records
+
+def append_record(path, record):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def git_info():
+    """Commit, branch and dirty flag of the checkout this code runs from, or {} outside git"""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    def git(*args):
+        return subprocess.run(["git", *args], capture_output=True, text=True, timeout=10, cwd=repo,
+                              check=True).stdout.strip()
+    try:
+        return {'commit': git("rev-parse", "HEAD"), 'branch': git("rev-parse", "--abbrev-ref", "HEAD"),
+                'dirty': bool(git("status", "--porcelain", "--untracked-files=no"))}
+    except (OSError, subprocess.SubprocessError):
+        return {}
+
+def hardware_info():
+    """Host, GPUs and inference library versions, without importing torch or vllm"""
+    info = {'hostname': platform.node(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'cpu_count': os.cpu_count()}
+    try:
+        query = subprocess.run(
+            ["nvidia-smi", "--query-gpu=name,memory.total,driver_version", "--format=csv,noheader"],
+            capture_output=True, text=True, timeout=10, check=True).stdout
+        info['gpus'] = [line.strip() for line in query.splitlines() if line.strip()]
+    except (OSError, subprocess.SubprocessError):
+        info['gpus'] = []
+    for package in ("vllm", "torch"):
+        try:
+            info[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            pass
+    return info
+
+class RunRecorder:
+    """Streams one benchmark run into the append-only store as it happens.
+
+    A ``run`` record (run ID, git commit, config, hardware) is written when
+    the recorder is created, every ``result`` is appended and fsynced as
+    soon as it is measured, and ``finish`` adds a ``summary`` record. A run
+    that crashes keeps every result measured before the crash.
+    """
+
+    def __init__(self, benchmark, config, path=RESULTS_STORE):
+        self.path = path
+        self.run_id = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.benchmark = benchmark
+        self.results = 0
+        append_record(path, {
+            'type': "run",
+            'run_id': self.run_id,
+            'benchmark': benchmark,
+            'started_at': time.time(),
+            'git': git_info(),
+            'config': config,
+            'hardware': hardware_info(),
+        })
+        print(f"🗃️  Recording run {self.run_id} to {path}")
+
+    def record(self, row):
+        append_record(self.path, {'type': "result", 'run_id': self.run_id, **row})
+        self.results += 1
+
+    def finish(self, summary=None):
+        append_record(self.path, {'type': "summary", 'run_id': self.run_id, 'finished_at': time.time(),
+                                  'results': self.results, **(summary or {})})
+
+def load_runs(path=RESULTS_STORE):
+    """``{run_id: {'run': ..., 'results': [...], 'summary': ...}}`` in the order runs started"""
+    runs = {}
+    for record in load_store(path):
+        run = runs.setdefault(record['run_id'], {'run': None, 'results': [], 'summary': None})
+        if record['type'] == "run":
+            run['run'] = record
+        elif record['type'] == "result":
+            run['results'].append(record)
+        elif record['type'] == "summary":
+            run['summary'] = record
+    return runs
+
+def resolve_run(runs, ref, benchmark=None):
+    """A run ID, a unique prefix of one, ``latest`` or ``previous`` (optionally of one benchmark kind)"""
+    ids = [run_id for run_id, run in runs.items()
+           if run['run'] and (benchmark is None or run['run']['benchmark'] == benchmark)]
+    if ref in ("latest", "previous"):
+        index = -1 if ref == "latest" else -2
+        if len(ids) < -index:
+            raise KeyError(f"No {ref} run in the store")
+        return ids[index]
+    matches = [run_id for run_id in ids if run_id.startswith(ref)]
+    if len(matches) != 1:
+        raise KeyError(f"{ref!r} matches {len(matches)} runs")
+    return matches[0]
+
+def per_prompt_metrics(results):
+    """Median of every compared metric per prompt (stats runs have several trials per prompt)"""
+    by_prompt = {}
+    for row in results:
+        if row.get('baseline_cache_hit') or row.get('speculative_cache_hit'):
+            continue
+        for metric in COMPARE_METRICS:
+            if row.get(metric) is not None:
+                by_prompt.setdefault(row['prompt_id'], {}).setdefault(metric, []).append(row[metric])
+    return {prompt_id: {metric: statistics.median(values) for metric, values in metrics.items()}
+            for prompt_id, metrics in by_prompt.items()}
+
+def relative_change(before, after, higher_is_better):
+    """Signed change where positive is worse, as a fraction of ``before``"""
+    if not before:
+        return 0.0
+    change = (after - before) / before
+    return -change if higher_is_better else change
+
+def compare_runs(base, candidate, threshold=0.05, per_prompt=False, metrics=None):
+    """Per-metric and per-prompt diff of two loaded runs.
+
+    A metric regresses when its mean over the prompts both runs measured
+    gets worse by more than ``threshold`` (a fraction); with
+    ``per_prompt`` any single prompt doing so also counts. ``metrics``
+    limits the comparison to some of COMPARE_METRICS.
+    """
+    before, after = per_prompt_metrics(base['results']), per_prompt_metrics(candidate['results'])
+    prompts = sorted(set(before) & set(after))
+    compared, rows, regressions = {}, [], []
+    for metric, higher_is_better in COMPARE_METRICS.items():
+        if metrics and metric not in metrics:
+            continue
+        shared = [p for p in prompts if metric in before[p] and metric in after[p]]
+        if not shared:
+            continue
+        for prompt_id in shared:
+            change = relative_change(before[prompt_id][metric], after[prompt_id][metric], higher_is_better)
+            rows.append({'prompt_id': prompt_id, 'metric': metric, 'before': before[prompt_id][metric],
+                         'after': after[prompt_id][metric], 'worse_by': change})
+            if per_prompt and change > threshold:
+                regressions.append(f"prompt {prompt_id} {metric} worse by {change:.1%}")
+        mean_before = statistics.fmean(before[p][metric] for p in shared)
+        mean_after = statistics.fmean(after[p][metric] for p in shared)
+        change = relative_change(mean_before, mean_after, higher_is_better)
+        compared[metric] = {'before': mean_before, 'after': mean_after, 'worse_by': change, 'prompts': len(shared)}
+        if change > threshold:
+            regressions.append(f"{metric} worse by {change:.1%} ({mean_before:.4g} -> {mean_after:.4g})")
+    return {'metrics': compared, 'per_prompt': rows, 'regressions': regressions, 'prompts_compared': len(prompts)}
+
+def describe_run(run):
+    meta = run['run']
+    git = meta.get('git') or {}
+    commit = git.get('commit', "?")[:10] + ("+dirty" if git.get('dirty') else "")
+    gpus = ", ".join(meta['hardware'].get('gpus') or []) or "no GPU"
+    status = "complete" if run['summary'] else "incomplete"
+    return (f"{meta['run_id']}  {meta['benchmark']:<10} {commit:<16} {len(run['results']):>3} results  "
+            f"{status:<10} {meta['config'].get('backend') or 'vllm'} | {gpus}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark run history and regression gate")
+    parser.add_argument("--store", default=RESULTS_STORE)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List recorded runs")
+    compare = commands.add_parser("compare", help="Diff two runs; exit 1 on a regression")
+    compare.add_argument("base", nargs="?", default="previous", help="Run ID/prefix, latest or previous")
+    compare.add_argument("candidate", nargs="?", default="latest", help="Run ID/prefix, latest or previous")
+    compare.add_argument("--benchmark", default=None, help="Only consider runs of this benchmark kind")
+    compare.add_argument("--threshold", type=float, default=0.05,
+                         help="Allowed fractional slowdown per metric (default 0.05 = 5%%)")
+    compare.add_argument("--metrics", nargs="+", choices=list(COMPARE_METRICS), default=None,
+                         help="Only compare these metrics (default: all)")
+    compare.add_argument("--per-prompt", action="store_true",
+                         help="Also fail when any single prompt regresses past the threshold")
+    args = parser.parse_args(argv)
+
+    runs = load_runs(args.store)
+    if args.command == "list":
+        for run in runs.values():
+            if run['run']:
+                print(describe_run(run))
+        return 0
+
+    try:
+        base_id = resolve_run(runs, args.base, args.benchmark)
+        candidate_id = resolve_run(runs, args.candidate, args.benchmark)
+    except KeyError as e:
+        print(f"❌ {e.args[0]}")
+        return 2
+    base, candidate = runs[base_id], runs[candidate_id]
+    if base['run']['benchmark'] != candidate['run']['benchmark']:
+        print(f"⚠️  Comparing a {base['run']['benchmark']} run with a {candidate['run']['benchmark']} run")
+    print(f"📏 Base:      {describe_run(base)}")
+    print(f"📏 Candidate: {describe_run(candidate)}")
+
+    report = compare_runs(base, candidate, args.threshold, args.per_prompt, args.metrics)
+    if not report['metrics']:
+        print("❌ The runs have no prompts and metrics in common")
+        return 2
+    print(f"\n{'metric':<28}{'before':>12}{'after':>12}{'worse by':>10}")
+    for metric, row in report['metrics'].items():
+        flag = " ❌" if row['worse_by'] > args.threshold else ""
+        print(f"{metric:<28}{row['before']:>12.4g}{row['after']:>12.4g}{row['worse_by']:>+10.1%}{flag}")
+    if args.per_prompt:
+        print(f"\n{'prompt':<8}{'metric':<28}{'before':>12}{'after':>12}{'worse by':>10}")
+        for row in report['per_prompt']:
+            print(f"{row['prompt_id']:<8}{row['metric']:<28}{row['before']:>12.4g}{row['after']:>12.4g}"
+                  f"{row['worse_by']:>+10.1%}")
+
+    if report['regressions']:
+        print(f"\n❌ {len(report['regressions'])} regression(s) past {args.threshold:.0%}:")
+        for regression in report['regressions']:
+            print(f"   - {regression}")
+        return 1
+    print(f"\n✅ No regression past {args.threshold:.0%} over {report['prompts_compared']} prompt(s)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,316 @@
+# scheduler.py
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from admission import AdmissionController, RequestControl, RequestShed, aborted_error
+from generator_base import RequestTrace
+from metrics import record_aborted, record_shed
+
+class _PendingRequest:
+    def __init__(self, prompt, sampling_overrides, stream, cost, timeout=None):
+        self.prompt = prompt
+        self.sampling_overrides = sampling_overrides
+        self.enqueued_at = time.perf_counter()
+        # Prompt + max_tokens held against the admission budget until the request ends
+        self.cost = cost
+        self.control = RequestControl(timeout)
+        self.future = None
+        # Stream requests receive ('update', text, tokens) and ('done', result) events
+        self.updates = asyncio.Queue() if stream else None
+
+class MicroBatchScheduler:
+    """Asyncio front end that batches concurrent requests into one running engine call.
+
+    Requests arriving within ``window_ms`` of the first queued request are
+    submitted together through ``generator.generate_batch`` on a dedicated
+    engine thread. Requests arriving while that call runs join it between
+    engine steps (continuous batching, up to ``max_batch_size`` in flight
+    and ``max_batch_tokens`` of prompt + max_tokens), so nobody waits for a
+    long batch to drain. Each result is handed back to the coroutine
+    awaiting it as soon as its own request finishes.
+
+    Every request may carry a ``timeout`` (else ``default_timeout``): past
+    it, or once its awaiting coroutine is cancelled, it is dropped from the
+    queue or aborted on the engine between steps, freeing its KV blocks, and
+    the caller gets admission.DeadlineExceeded / RequestCancelled.
+    ``max_queued_tokens`` and ``max_queue_wait`` turn on admission control:
+    requests that would push the admitted prompt + max_tokens past the
+    budget, or whose projected wait passes ``max_queue_wait`` seconds or
+    their own deadline, are shed at submission with admission.RequestShed.
+    """
+
+    def __init__(self, generator, window_ms=5, max_batch_size=32, max_batch_tokens=None,
+                 max_queued_tokens=None, max_queue_wait=None, default_timeout=None):
+        self.generator = generator
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.default_timeout = default_timeout
+        self.admission = AdmissionController(max_queued_tokens, max_queue_wait)
+
+        # One thread: the engine must only be driven from one place at a time
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine")
+        # Waiting requests; a deque so the engine thread can take arrivals between steps
+        self._pending = deque()
+        self._arrived = None
+        self._loop = None
+        self._worker = None
+
+        self._in_flight = 0
+        # Batch sizes are the requests in flight after each admission into the engine
+        self._batches = 0
+        self._batched_requests = 0
+        self._requests = 0
+        self._max_batch_seen = 0
+        self._batch_size_counts = {}
+        self._total_queue_wait = 0.0
+        self._aborted = {}
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._loop is not loop:
+            if self._loop is not loop:
+                # Requests queued on a previous event loop can no longer be answered
+                self._pending = deque()
+            self._loop = loop
+            self._arrived = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+
+    def _request_cost(self, prompt, sampling_overrides):
+        # Also rejects prompts that cannot fit before they join (and fail) someone else's batch
+        prepared = self.generator.prepare_prompt(prompt, sampling_overrides)
+        max_tokens = (sampling_overrides or {}).get('max_tokens', self.generator.sampling_config['max_tokens'])
+        return len(prepared['token_ids']) + max_tokens
+
+    def check_admission(self, prompt, sampling_overrides=None, timeout=None):
+        """Raise RequestShed if the request would be shed right now, without queueing it"""
+        timeout = timeout or self.default_timeout
+        deadline = time.perf_counter() + timeout if timeout else None
+        self.admission.check(self._request_cost(prompt, sampling_overrides), deadline)
+
+    async def _enqueue(self, prompt, sampling_overrides, stream, timeout):
+        cost = self._request_cost(prompt, sampling_overrides)
+        request = _PendingRequest(prompt, sampling_overrides, stream, cost, timeout or self.default_timeout)
+        try:
+            self.admission.admit(cost, request.control.deadline)
+        except RequestShed as e:
+            record_shed(self.generator.mode, e.reason)
+            raise
+        self._ensure_started()
+        if not stream:
+            request.future = self._loop.create_future()
+        self._pending.append(request)
+        self._arrived.set()
+        return request
+
+    async def submit(self, prompt, sampling_overrides=None, timeout=None):
+        """Queue one prompt and wait for its result dict"""
+        request = await self._enqueue(prompt, sampling_overrides, stream=False, timeout=timeout)
+        try:
+            return await request.future
+        except asyncio.CancelledError:
+            # The caller went away: drop it from the queue or abort it on the engine
+            request.control.cancel()
+            raise
+
+    async def stream(self, prompt, sampling_overrides=None, timeout=None):
+        """Queue one prompt and yield updates in the same shape as generate_stream"""
+        request = await self._enqueue(prompt, sampling_overrides, stream=True, timeout=timeout)
+
+        # Timed from enqueue, so ttft includes the wait for a batch slot
+        trace = RequestTrace(request.enqueued_at)
+        text = ""
+        try:
+            while True:
+                event = await request.updates.get()
+                now = time.perf_counter()
+                if event[0] == 'error':
+                    raise event[1]
+                if event[0] == 'done':
+                    result = dict(event[1])
+                    result.update({
+                        'delta': "",
+                        'finished': True,
+                        'ttft': trace.ttft if trace.ttft is not None else now - request.enqueued_at,
+                        'inter_token_latencies': trace.inter_token_latencies
+                    })
+                    yield result
+                    return
+
+                _, new_text, num_tokens = event
+                trace.update(num_tokens, now)
+                delta = new_text[len(text):]
+                text = new_text
+                if delta:
+                    yield {'delta': delta, 'text': text, 'finished': False}
+        finally:
+            # A consumer that stops reading early cancels the request; a no-op once it has ended
+            request.control.cancel()
+
+    async def _collect_batch(self):
+        while not self._pending:
+            self._arrived.clear()
+            await self._arrived.wait()
+        deadline = time.perf_counter() + self.window
+        while len(self._pending) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return [self._pending.popleft() for _ in range(min(len(self._pending), self.max_batch_size))]
+
+    async def _run(self):
+        while True:
+            batch = await self._collect_batch()
+            await self._execute(batch)
+
+    def _fail(self, request, error):
+        if request.updates is not None:
+            request.updates.put_nowait(('error', error))
+        elif not request.future.done():
+            request.future.set_exception(error)
+
+    def _count_aborted(self, reason):
+        self._aborted[reason] = self._aborted.get(reason, 0) + 1
+
+    def _drop(self, request, reason):
+        """Expired or abandoned while queued: answer it without reaching the engine"""
+        self.admission.release(request.cost)
+        record_aborted(self.generator.mode, reason)
+        self._count_aborted(reason)
+        self._fail(request, aborted_error(reason))
+
+    def _record_batch(self, batch_size):
+        self._batches += 1
+        self._batched_requests += batch_size
+        self._max_batch_seen = max(self._max_batch_seen, batch_size)
+        self._batch_size_counts[batch_size] = self._batch_size_counts.get(batch_size, 0) + 1
+
+    def _deliver(self, request, result, wait, batch_size):
+        self.admission.release(request.cost)
+        self._requests += 1
+        self._total_queue_wait += wait
+        if result.get('aborted'):
+            self._count_aborted(result['aborted'])
+            self._fail(request, aborted_error(result['aborted'], result['text']))
+            return
+        if not result.get('cache_hit'):
+            # Service rate in admission cost per second: this request ran alongside batch_size - 1 others
+            elapsed = time.perf_counter() - request.enqueued_at - wait
+            self.admission.observe(request.cost * batch_size, elapsed)
+        result = dict(result, batch_size=batch_size, queue_wait=wait)
+        if result.get('phases'):
+            # Engine phases start at batch submission; the micro-batch window comes before that
+            result['phases'] = dict(result['phases'], scheduler_wait=wait)
+        if request.updates is not None:
+            request.updates.put_nowait(('done', result))
+        elif not request.future.done():
+            request.future.set_result(result)
+
+    async def _execute(self, batch):
+        loop = self._loop
+        started = time.perf_counter()
+        members = []
+        for request in batch:
+            reason = request.control.abort_reason(started)
+            if reason is None:
+                members.append(request)
+            else:
+                self._drop(request, reason)
+        if not members:
+            return
+        # Grown by admit() on the engine thread as requests join; index = position in generate_batch
+        waits = [started - r.enqueued_at for r in members]
+        delivered = set()
+        running = {'requests': len(members), 'tokens': sum(r.cost for r in members)}
+        initial = list(members)
+
+        def admit():
+            joined = []
+            now = time.perf_counter()
+            while self._pending and running['requests'] < self.max_batch_size:
+                request = self._pending[0]
+                if self.max_batch_tokens and running['tokens'] + request.cost > self.max_batch_tokens:
+                    break
+                self._pending.popleft()
+                reason = request.control.abort_reason(now)
+                if reason is not None:
+                    loop.call_soon_threadsafe(self._drop, request, reason)
+                    continue
+                members.append(request)
+                waits.append(now - request.enqueued_at)
+                running['requests'] += 1
+                running['tokens'] += request.cost
+                joined.append((request.prompt, request.sampling_overrides, request.control))
+            self._in_flight = running['requests']
+            if joined:
+                loop.call_soon_threadsafe(self._record_batch, running['requests'])
+            return joined
+
+        def on_update(i, output):
+            request = members[i]
+            if request.updates is not None:
+                completion = output.outputs[0]
+                event = ('update', completion.text, len(completion.token_ids))
+                loop.call_soon_threadsafe(request.updates.put_nowait, event)
+
+        def on_result(i, result):
+            # Batch size as this request finished: everything in flight alongside it, itself included
+            batch_size = running['requests']
+            delivered.add(i)
+            running['requests'] -= 1
+            running['tokens'] -= members[i].cost
+            self._in_flight = running['requests']
+            loop.call_soon_threadsafe(self._deliver, members[i], result, waits[i], batch_size)
+
+        self._in_flight = len(members)
+        self._record_batch(len(members))
+        try:
+            await loop.run_in_executor(
+                self._executor,
+                lambda: self.generator.generate_batch(
+                    [r.prompt for r in initial],
+                    [r.sampling_overrides for r in initial],
+                    max_batch_tokens=self.max_batch_tokens,
+                    on_update=on_update,
+                    controls=[r.control for r in initial],
+                    on_result=on_result,
+                    admit=admit
+                )
+            )
+        except Exception as e:
+            for i, request in enumerate(members):
+                if i not in delivered:
+                    self.admission.release(request.cost)
+                    self._fail(request, e)
+            return
+        finally:
+            self._in_flight = 0
+
+    def stats(self):
+        """Queue depth, batch-size and admission statistics"""
+        admission = self.admission.stats()
+        return {
+            'queue_depth': len(self._pending),
+            'in_flight': self._in_flight,
+            'batches': self._batches,
+            'requests': self._requests,
+            'mean_batch_size': self._batched_requests / self._batches if self._batches else 0,
+            'max_batch_size': self._max_batch_seen,
+            'batch_size_counts': dict(sorted(self._batch_size_counts.items())),
+            'mean_queue_wait': self._total_queue_wait / self._requests if self._requests else 0,
+            'queued_tokens': admission['queued_tokens'],
+            'projected_wait': admission['projected_wait'],
+            'shed': admission['shed'],
+            'aborted': dict(self._aborted)
+        }
+
+    def shutdown(self):
+        if self._worker is not None:
+            self._worker.cancel()
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,503 @@
+# sim_engine.py
+from backend import InferenceBackend, KV_BLOCK_SIZE, NGRAM_PROPOSER
+from prompt_pipeline import render_chatml
+from collections import OrderedDict, deque
+import hashlib
+import random
+import time
+import zlib
+
+# KV cache bytes per token (K and V, fp16) for the memory model
+TARGET_KV_BYTES_PER_TOKEN = 2 * 80 * 8 * 128 * 2  # Qwen2.5-72B: 80 layers, 8 KV heads, head_dim 128
+DRAFT_KV_BYTES_PER_TOKEN = 2 * 28 * 4 * 128 * 2   # Qwen2.5-7B: 28 layers, 4 KV heads, head_dim 128
+
+# Rough H100 numbers for Qwen2.5-72B-AWQ with a Qwen2.5-7B draft
+SIM_DEFAULTS = {
+    'gpu_memory_gb': 80,
+    'target_weights_gb': 40,
+    'draft_weights_gb': 14,
+    'activation_reserve_gb': 4,
+    'kv_cache_tokens': None,            # Overrides the memory model when set
+    'max_num_seqs': 256,
+    'prefill_overhead': 0.02,           # Seconds per prefill step
+    'prefill_time_per_token': 0.00015,
+    'decode_step_time': 0.035,          # One target forward pass at batch size 1
+    'decode_time_per_seq': 0.0003,      # Added per running sequence
+    'draft_step_time': 0.008,           # One draft forward pass
+    'ngram_lookup_time': 0.0002,        # Prompt-lookup proposal per running sequence (CPU)
+    'verify_overhead_per_token': 0.1,   # Verification cost grows with proposal length
+    'weight_load_time': 1.5,            # Startup phases, seconds (also scaled by time_scale)
+    'kv_cache_init_time': 0.3,
+    'graph_capture_time': 0.5,
+    'acceptance_rate': 0.7,             # Probability each draft token is accepted
+    'min_output_tokens': 48,
+    'max_output_tokens': 320,           # Natural answer length is drawn from [min, max]
+    'copy_fraction': 0.5,               # Share of output spans copied from source text in the prompt
+    'copy_min_prompt_tokens': 64,       # Shorter prompts carry no source text to copy
+    'time_scale': 1.0,                  # 0 skips sleeping entirely
+    'seed': 0,
+}
+
+WORDS = (
+    "the of and to in a is that for on with as by it are this be from or at "
+    "cloud data team customer service value cost model system process policy "
+    "security product platform growth risk quality support strategy project "
+    "migration performance users results teams business agile delivery key"
+).split()
+
+def ngram_proposal(token_ids, num_tokens, max_n, min_n):
+    """Prompt lookup as vLLM's NGramWorker does it: the tokens after the first
+    earlier occurrence of the context's last n tokens, trying the longest n first"""
+    for n in range(min(max_n, len(token_ids) - 1), min_n - 1, -1):
+        tail = token_ids[-n:]
+        for start in range(len(token_ids) - n):
+            if token_ids[start:start + n] == tail:
+                return token_ids[start + n:start + n + num_tokens]
+    return []
+
+class SimSamplingParams:
+    """Stand-in for vllm.SamplingParams; only the fields the simulator reads are named"""
+
+    def __init__(self, temperature=1.0, top_p=1.0, max_tokens=16, stop=None, seed=None, **extra):
+        self.temperature = temperature
+        self.top_p = top_p
+        self.max_tokens = max_tokens
+        self.stop = stop
+        self.seed = seed
+        for key, value in extra.items():
+            setattr(self, key, value)
+
+class SimTokenizer:
+    """Whitespace tokenizer with stable ids; decode maps ids back onto a small vocabulary.
+
+    ``decode(encode(text))`` round-trips for text made of WORDS, so generated
+    answers re-tokenize to the same ids when a later chat turn resends them.
+    """
+
+    vocab_size = 151_646
+    chat_template = "chatml"
+
+    def __init__(self):
+        self._words_by_id = {self.token_id(word): word for word in WORDS}
+
+    def token_id(self, word):
+        return zlib.crc32(word.encode()) % self.vocab_size
+
+    def encode(self, text):
+        return [self.token_id(word) for word in text.split()]
+
+    def decode(self, token_ids):
+        return " ".join(self._words_by_id.get(t, WORDS[t % len(WORDS)]) for t in token_ids)
+
+    def apply_chat_template(self, messages, tokenize=False, add_generation_prompt=False):
+        text = render_chatml(messages, add_generation_prompt)
+        return self.encode(text) if tokenize else text
+
+class SimCompletionOutput:
+    def __init__(self, text, token_ids, finish_reason=None):
+        self.index = 0
+        self.text = text
+        self.token_ids = token_ids
+        self.finish_reason = finish_reason
+
+class SimRequestMetrics:
+    def __init__(self, arrival_time):
+        self.arrival_time = arrival_time
+        self.last_token_time = arrival_time
+        self.first_scheduled_time = None
+        self.first_token_time = None
+        self.time_in_queue = None
+        self.finished_time = None
+
+class SimRequestOutput:
+    def __init__(self, request_id, prompt, prompt_token_ids, outputs, finished, metrics, num_cached_tokens=0):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.prompt_token_ids = prompt_token_ids
+        self.outputs = outputs
+        self.finished = finished
+        self.metrics = metrics
+        self.num_cached_tokens = num_cached_tokens
+
+class _SimRequest:
+    def __init__(self, request_id, prompt, prompt_token_ids, params, output_token_ids, seed):
+        self.request_id = request_id
+        self.prompt = prompt
+        self.prompt_token_ids = prompt_token_ids
+        self.params = params
+        self.output_token_ids = output_token_ids
+        self.num_generated = 0
+        self.num_cached_tokens = 0
+        self.rng = random.Random(seed)
+        self.metrics = SimRequestMetrics(time.time())
+
+    @property
+    def kv_reservation(self):
+        return len(self.prompt_token_ids) + len(self.output_token_ids)
+
+    @property
+    def done(self):
+        return self.num_generated >= len(self.output_token_ids)
+
+class SimulatedEngine(InferenceBackend):
+    """Deterministic CPU stand-in for QwenEngine.
+
+    Takes QwenEngine's arguments plus the cost-model knobs in SIM_DEFAULTS.
+    Prefill and decode steps sleep for their simulated GPU time, draft
+    tokens are accepted with ``acceptance_rate``, and admission is limited
+    by ``max_num_seqs`` and a KV cache sized from the memory budget. With
+    the NGRAM_PROPOSER the proposals come from a real prompt lookup over the
+    context and are accepted where they match the planned output, which
+    copies spans of long prompts (summarize/rewrite) at ``copy_fraction``.
+    Generated text depends only on the prompt and sampling seed, so both
+    modes produce the same tokens, as greedy decoding on the real model does.
+    """
+
+    name = "sim"
+
+    def __init__(self,
+                 target_model_path="./models/target",
+                 draft_model_path=None,
+                 num_speculative_tokens=5,
+                 gpu_memory_utilization=0.90,
+                 max_model_len=2048,
+                 speculative_disable_by_batch_size=None,
+                 use_v2_block_manager=True,
+                 enable_prefix_caching=True,
+                 ngram_prompt_lookup_max=4,
+                 ngram_prompt_lookup_min=1,
+                 **sim_overrides):
+        super().__init__()
+        unknown = set(sim_overrides) - set(SIM_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown simulator settings: {sorted(unknown)}")
+
+        self.target_model_path = target_model_path
+        self.draft_model_path = draft_model_path
+        self.num_speculative_tokens = num_speculative_tokens
+        self.gpu_memory_utilization = gpu_memory_utilization
+        self.max_model_len = max_model_len
+        self.use_v2_block_manager = use_v2_block_manager  # Accepted for parity, no effect here
+        self.enable_prefix_caching = enable_prefix_caching
+        self.ngram_prompt_lookup_max = ngram_prompt_lookup_max
+        self.ngram_prompt_lookup_min = ngram_prompt_lookup_min
+        # Prompt lookup needs neither draft weights nor draft KV cache
+        self.uses_draft_model = draft_model_path not in (None, NGRAM_PROPOSER)
+        self.config = {**SIM_DEFAULTS, **sim_overrides}
+
+        self.kv_cache_tokens = self.config['kv_cache_tokens'] or self._kv_capacity_from_memory()
+        self._simulate_startup()
+        self.speculative = self.supports_speculation
+        self.speculation_length = num_speculative_tokens
+        # Mirrors SpecDecodeWorker: no proposals once the running batch reaches this size
+        self.disable_by_batch_size = speculative_disable_by_batch_size or float("inf")
+        self._speculation_off = False
+
+        self._tokenizer = SimTokenizer()
+        self._waiting = deque()
+        self._running = []
+        self._kv_used = 0
+        # Hashes of full KV blocks whose contents are still cached, least recently used first
+        self._prefix_blocks = OrderedDict()
+        self.prefix_cache_queries = 0
+        self.prefix_cache_hits = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.emitted_tokens = 0
+        self.spec_emitted_tokens = 0
+
+    @property
+    def supports_speculation(self):
+        return self.draft_model_path is not None
+
+    @property
+    def model_identity(self):
+        return {'backend': self.name, 'target_model': self.target_model_path,
+                'draft_model': self.draft_model_path, 'seed': self.config['seed']}
+
+    @property
+    def can_toggle_speculation(self):
+        return True
+
+    def _simulate_startup(self):
+        start = time.perf_counter()
+        weights = self.config['weight_load_time']
+        if self.uses_draft_model:
+            weights *= 1 + self.config['draft_weights_gb'] / self.config['target_weights_gb']
+        for phase, seconds in (('weight_load', weights),
+                               ('kv_cache_allocation', self.config['kv_cache_init_time']),
+                               ('graph_capture', self.config['graph_capture_time'])):
+            phase_start = time.perf_counter()
+            self._sleep(seconds)
+            self.startup_phases[phase] = time.perf_counter() - phase_start
+        self.startup_phases['engine_total'] = time.perf_counter() - start
+
+    def _kv_capacity_from_memory(self):
+        budget_gb = self.config['gpu_memory_gb'] * self.gpu_memory_utilization
+        weights_gb = self.config['target_weights_gb'] + self.config['activation_reserve_gb']
+        bytes_per_token = TARGET_KV_BYTES_PER_TOKEN
+        if self.uses_draft_model:
+            weights_gb += self.config['draft_weights_gb']
+            bytes_per_token += DRAFT_KV_BYTES_PER_TOKEN
+
+        free_bytes = (budget_gb - weights_gb) * 1024 ** 3
+        if free_bytes < self.max_model_len * bytes_per_token:
+            raise ValueError(
+                f"No available memory for the cache blocks: {budget_gb:.1f}GB budget, "
+                f"{weights_gb:.1f}GB weights. Try increasing `gpu_memory_utilization`.")
+        return int(free_bytes // bytes_per_token)
+
+    def _propose_ngram(self, request, num_tokens):
+        context = request.prompt_token_ids + request.output_token_ids[:request.num_generated]
+        return ngram_proposal(context, num_tokens, self.ngram_prompt_lookup_max, self.ngram_prompt_lookup_min)
+
+    def _set_mode(self, speculative):
+        if speculative and not self.supports_speculation:
+            raise ValueError("Speculative mode requested but no draft model is configured")
+        self.speculative = speculative
+        self._speculation_off = False
+
+    @property
+    def active_speculation_length(self):
+        if not self.speculative or self._speculation_off:
+            return 0
+        return self.speculation_length
+
+    def set_speculation_length(self, num_tokens):
+        num_tokens = max(0, min(num_tokens, self.num_speculative_tokens))
+        if num_tokens > 0:
+            self.speculation_length = num_tokens
+        self._speculation_off = num_tokens == 0
+        return num_tokens
+
+    def speculation_counters(self):
+        if not self.supports_speculation:
+            return None
+        return {
+            'draft_tokens': self.draft_tokens,
+            'accepted_tokens': self.accepted_tokens,
+            'emitted_tokens': self.spec_emitted_tokens,
+            'steps': self.spec_steps,
+        }
+
+    def make_sampling_params(self, **kwargs):
+        return SimSamplingParams(**kwargs)
+
+    def get_tokenizer(self):
+        return self._tokenizer
+
+    def _plan_output(self, prompt_token_ids, params):
+        """Output token ids and acceptance-sampling seed, fixed by prompt and sampling seed"""
+        prompt_len = len(prompt_token_ids)
+        key = f"{self.config['seed']}|{params.seed}|{prompt_token_ids}".encode()
+        rng = random.Random(hashlib.sha256(key).digest())
+        length = rng.randint(self.config['min_output_tokens'], self.config['max_output_tokens'])
+        length = min(length, params.max_tokens, self.max_model_len - prompt_len)
+        if not self.config['copy_fraction'] or prompt_len < self.config['copy_min_prompt_tokens']:
+            words = [rng.choice(WORDS) for _ in range(length)]
+            return [self._tokenizer.token_id(w) for w in words], rng.random()
+        token_ids = []
+        while len(token_ids) < length:
+            if rng.random() < self.config['copy_fraction']:
+                start = rng.randrange(prompt_len)
+                token_ids.extend(prompt_token_ids[start:start + rng.randint(4, 16)])
+            else:
+                token_ids.extend(self._tokenizer.token_id(rng.choice(WORDS)) for _ in range(rng.randint(1, 4)))
+        return token_ids[:length], rng.random()
+
+    def _block_hashes(self, token_ids):
+        """Chained hash of every full block, as vLLM's prefix cache keys blocks"""
+        hashes, parent = [], ""
+        for start in range(0, len(token_ids) - KV_BLOCK_SIZE + 1, KV_BLOCK_SIZE):
+            parent = hashlib.sha1(f"{parent}|{token_ids[start:start + KV_BLOCK_SIZE]}".encode()).hexdigest()
+            hashes.append(parent)
+        return hashes
+
+    def _match_prefix(self, prompt_token_ids):
+        """Prompt tokens whose KV blocks are already cached (the last token is always recomputed)"""
+        if not self.enable_prefix_caching:
+            return 0
+        cached_blocks = 0
+        for block_hash in self._block_hashes(prompt_token_ids[:-1]):
+            if block_hash not in self._prefix_blocks:
+                break
+            self._prefix_blocks.move_to_end(block_hash)
+            cached_blocks += 1
+        self.prefix_cache_queries += len(prompt_token_ids)
+        self.prefix_cache_hits += cached_blocks * KV_BLOCK_SIZE
+        return cached_blocks * KV_BLOCK_SIZE
+
+    def _cache_blocks(self, token_ids):
+        if not self.enable_prefix_caching:
+            return
+        for block_hash in self._block_hashes(token_ids):
+            self._prefix_blocks[block_hash] = None
+            self._prefix_blocks.move_to_end(block_hash)
+        # Freed blocks stay reusable until the cache needs the space back
+        while len(self._prefix_blocks) * KV_BLOCK_SIZE > self.kv_cache_tokens:
+            self._prefix_blocks.popitem(last=False)
+
+    def add_request(self, request_id, prompt, sampling_params):
+        # Text, or {'prompt_token_ids': [...]} as vLLM's TokensPrompt
+        if isinstance(prompt, dict):
+            prompt_token_ids = list(prompt['prompt_token_ids'])
+            prompt = prompt.get('prompt')
+        else:
+            prompt_token_ids = self._tokenizer.encode(prompt)
+        if len(prompt_token_ids) > self.max_model_len:
+            raise ValueError(
+                f"Prompt length of {len(prompt_token_ids)} is longer than the maximum "
+                f"model length of {self.max_model_len}.")
+        output_token_ids, seed = self._plan_output(prompt_token_ids, sampling_params)
+        request = _SimRequest(request_id, prompt, prompt_token_ids, sampling_params, output_token_ids, seed)
+        if request.kv_reservation > self.kv_cache_tokens:
+            raise ValueError(
+                f"Request needs {request.kv_reservation} KV cache tokens but the cache "
+                f"only holds {self.kv_cache_tokens}.")
+        self._waiting.append(request)
+
+    def abort_request(self, request_ids):
+        if isinstance(request_ids, str):
+            request_ids = [request_ids]
+        request_ids = set(request_ids)
+        self._waiting = deque(r for r in self._waiting if r.request_id not in request_ids)
+        for request in [r for r in self._running if r.request_id in request_ids]:
+            self._running.remove(request)
+            self._kv_used -= request.kv_reservation
+
+    def has_unfinished_requests(self):
+        return bool(self._waiting or self._running)
+
+    def _sleep(self, seconds):
+        if self.config['time_scale'] > 0:
+            time.sleep(seconds * self.config['time_scale'])
+
+    def _admit(self):
+        admitted = []
+        while self._waiting and len(self._running) + len(admitted) < self.config['max_num_seqs']:
+            request = self._waiting[0]
+            if self._kv_used + request.kv_reservation > self.kv_cache_tokens:
+                break
+            self._waiting.popleft()
+            self._kv_used += request.kv_reservation
+            admitted.append(request)
+        return admitted
+
+    def _snapshot(self, request):
+        token_ids = request.output_token_ids[:request.num_generated]
+        finish_reason = None
+        if request.done:
+            hit_limit = len(request.output_token_ids) >= request.params.max_tokens
+            finish_reason = "length" if hit_limit else "stop"
+        completion = SimCompletionOutput(self._tokenizer.decode(token_ids), token_ids, finish_reason)
+        return SimRequestOutput(request.request_id, request.prompt, request.prompt_token_ids,
+                                [completion], request.done, request.metrics, request.num_cached_tokens)
+
+    def step(self):
+        admitted = self._admit()
+        if admitted:
+            # Prefill runs as its own step and emits each sequence's first token;
+            # blocks already in the prefix cache are not recomputed
+            for request in admitted:
+                request.num_cached_tokens = self._match_prefix(request.prompt_token_ids)
+                self._cache_blocks(request.prompt_token_ids)
+            prompt_tokens = sum(len(r.prompt_token_ids) - r.num_cached_tokens for r in admitted)
+            cost = self.config['prefill_overhead'] + self.config['prefill_time_per_token'] * prompt_tokens
+            if self.speculative and self.uses_draft_model:
+                cost *= 1.1  # Draft prefill
+            now = time.time()
+            for request in admitted:
+                request.metrics.first_scheduled_time = now
+                request.metrics.time_in_queue = now - request.metrics.arrival_time
+            self._sleep(cost)
+            self._running.extend(admitted)
+            stepped = admitted
+            emitted = {r.request_id: 1 for r in admitted}
+            proposals = {}
+        elif self._running:
+            batch_size = len(self._running)
+            k = self.speculation_length
+            speculate = (self.speculative and not self._speculation_off and k > 0
+                         and batch_size < self.disable_by_batch_size)
+            cost = self.config['decode_step_time'] + self.config['decode_time_per_seq'] * batch_size
+            emitted = {}
+            proposals = {}
+            if speculate and not self.uses_draft_model:
+                ngrams = {r.request_id: self._propose_ngram(r, k) for r in self._running}
+                lookup_cost = self.config['ngram_lookup_time'] * batch_size
+                if any(ngrams.values()):
+                    cost = lookup_cost + cost * (1 + self.config['verify_overhead_per_token'] * k)
+                    for request in self._running:
+                        proposal = ngrams[request.request_id]
+                        if not proposal:
+                            # Like vLLM: decoded normally, outside the rejection sampler's counts
+                            emitted[request.request_id] = 1
+                            continue
+                        proposals[request.request_id] = len(proposal)
+                        planned = request.output_token_ids[request.num_generated:]
+                        accepted = 0
+                        while accepted < min(len(proposal), len(planned)) and proposal[accepted] == planned[accepted]:
+                            accepted += 1
+                        emitted[request.request_id] = accepted + 1
+                        self.draft_tokens += len(proposal)
+                        self.accepted_tokens += accepted
+                        self.spec_emitted_tokens += accepted + 1
+                else:
+                    # vLLM runs a plain decode step when no sequence found a match
+                    cost += lookup_cost
+                    emitted = {r.request_id: 1 for r in self._running}
+            elif speculate:
+                cost = k * self.config['draft_step_time'] + cost * (1 + self.config['verify_overhead_per_token'] * k)
+                for request in self._running:
+                    accepted = 0
+                    while accepted < k and request.rng.random() < self.config['acceptance_rate']:
+                        accepted += 1
+                    emitted[request.request_id] = accepted + 1
+                    proposals[request.request_id] = k
+                    self.draft_tokens += k
+                    self.accepted_tokens += accepted
+                    self.spec_emitted_tokens += accepted + 1
+            else:
+                emitted = {r.request_id: 1 for r in self._running}
+            self._sleep(cost)
+            stepped = list(self._running)
+        else:
+            return []
+
+        self.last_step_proposals = proposals
+        self.spec_steps += len(proposals)
+        now = time.time()
+        outputs = []
+        for request in stepped:
+            remaining = len(request.output_token_ids) - request.num_generated
+            count = min(emitted[request.request_id], remaining)
+            request.num_generated += count
+            self.emitted_tokens += count
+            if count:
+                request.metrics.last_token_time = now
+                if request.metrics.first_token_time is None:
+                    request.metrics.first_token_time = now
+            if request.done:
+                request.metrics.finished_time = now
+                self._cache_blocks(request.prompt_token_ids + request.output_token_ids)
+                self._running.remove(request)
+                self._kv_used -= request.kv_reservation
+            outputs.append(self._snapshot(request))
+        return outputs
+
+    def metrics(self):
+        return {
+            'backend': self.name,
+            'speculative': self.speculative,
+            'can_toggle_speculation': True,
+            'unfinished_requests': len(self._waiting) + len(self._running),
+            'running': len(self._running),
+            'waiting': len(self._waiting),
+            'kv_cache_usage': self._kv_used / self.kv_cache_tokens,
+            'kv_cache_tokens': self.kv_cache_tokens,
+            'prefix_cache_hit_rate': (self.prefix_cache_hits / self.prefix_cache_queries
+                                      if self.prefix_cache_queries else 0),
+            'draft_tokens': self.draft_tokens,
+            'accepted_tokens': self.accepted_tokens,
+            'emitted_tokens': self.emitted_tokens,
+        }
@@ -0,0 +1,170 @@
+# spec_controller.py
+from collections import deque
+import json
+import time
+
+def expected_tokens_per_step(alpha, num_tokens):
+    """Tokens emitted per verification step when each draft token is accepted with ``alpha``"""
+    if alpha >= 1.0:
+        return num_tokens + 1
+    return (1 - alpha ** (num_tokens + 1)) / (1 - alpha)
+
+def per_token_acceptance(acceptance_rate, num_tokens):
+    """Invert vLLM's draft acceptance rate (accepted / proposed) into a per-token probability.
+
+    vLLM only counts the accepted prefix of each proposal, so a rate of
+    ``r`` at length ``k`` means ``(alpha + ... + alpha^k) / k == r``.
+    """
+    if num_tokens <= 0 or acceptance_rate <= 0:
+        return 0.0
+    if acceptance_rate >= 1:
+        return 1.0
+    target = acceptance_rate * num_tokens
+    low, high = 0.0, 1.0
+    for _ in range(40):
+        alpha = (low + high) / 2
+        if sum(alpha ** i for i in range(1, num_tokens + 1)) < target:
+            low = alpha
+        else:
+            high = alpha
+    return (low + high) / 2
+
+class AdaptiveSpeculationController:
+    """Chooses the speculation length for each request from recent acceptance.
+
+    Keeps a rolling window of per-request draft/accepted/emitted counts,
+    estimates the per-token acceptance probability and picks the length
+    ``k`` that maximises expected tokens per unit of step cost, where one
+    verification step costs ``1 + draft_cost_ratio * k`` target passes.
+    ``k = 0`` (no speculation) wins when acceptance is low, with a probe at
+    ``min_tokens`` every ``probe_interval`` requests to notice recovery. It
+    is forced while the engine's batch is at ``busy_batch_size`` or more
+    (re-checked between steps as requests join and finish, see adjust()),
+    because at high load the extra verification work costs more throughput
+    than it saves.
+
+    Every decision is appended to ``decisions`` and, with ``log_path``, to a
+    JSONL audit log.
+    """
+
+    def __init__(self,
+                 max_tokens=5,
+                 min_tokens=1,
+                 window=32,
+                 min_observations=4,
+                 draft_cost_ratio=0.2,
+                 busy_batch_size=16,
+                 probe_interval=8,
+                 log_path=None):
+        self.max_tokens = max_tokens
+        self.min_tokens = min_tokens
+        self.draft_cost_ratio = draft_cost_ratio
+        self.min_observations = min_observations
+        self.busy_batch_size = busy_batch_size
+        self.probe_interval = probe_interval
+        self.log_path = log_path
+
+        self.current_tokens = max_tokens
+        self._skipped = 0
+        self._observations = deque(maxlen=window)
+        self.decisions = deque(maxlen=1000)
+
+    def rolling_stats(self):
+        """Acceptance rate and tokens per verification step over the window"""
+        draft = sum(o['draft_tokens'] for o in self._observations)
+        accepted = sum(o['accepted_tokens'] for o in self._observations)
+        emitted = sum(o['emitted_tokens'] for o in self._observations)
+        steps = sum(o['steps'] for o in self._observations)
+        return {
+            'observations': len(self._observations),
+            'acceptance_rate': accepted / draft if draft else None,
+            'tokens_per_step': emitted / steps if steps else None,
+        }
+
+    def estimated_alpha(self):
+        """Draft-weighted per-token acceptance probability over the window"""
+        draft = sum(o['draft_tokens'] for o in self._observations)
+        if not draft:
+            return 0.0
+        return sum(
+            o['draft_tokens'] * per_token_acceptance(o['accepted_tokens'] / o['draft_tokens'], o['num_tokens'])
+            for o in self._observations
+        ) / draft
+
+    def _best_length(self, alpha):
+        best_k, best_score = 0, 1.0  # No speculation: one token per target pass
+        for k in range(self.min_tokens, self.max_tokens + 1):
+            score = expected_tokens_per_step(alpha, k) / (1 + self.draft_cost_ratio * k)
+            if score > best_score:
+                best_k, best_score = k, score
+        return best_k
+
+    def choose(self, batch_size=1):
+        """Speculation length for the next request or batch"""
+        stats = self.rolling_stats()
+        if batch_size >= self.busy_batch_size:
+            num_tokens, reason = 0, f"busy: batch of {batch_size} >= {self.busy_batch_size}"
+        elif stats['observations'] < self.min_observations:
+            num_tokens, reason = self.current_tokens, "warming up"
+        else:
+            alpha = self.estimated_alpha()
+            num_tokens = self._best_length(alpha)
+            reason = f"per-token acceptance {alpha:.2f}"
+            if num_tokens == 0:
+                self._skipped += 1
+                if self._skipped >= self.probe_interval:
+                    # Speculate now and then so a recovering acceptance rate is noticed
+                    self._skipped = 0
+                    num_tokens, reason = self.min_tokens, reason + ", probing"
+
+        self._record(num_tokens, batch_size, reason, stats)
+        if num_tokens > 0:
+            self.current_tokens = num_tokens
+        return num_tokens
+
+    def observe(self, num_tokens, before, after):
+        """Record the spec-decode counter delta of one finished request or batch"""
+        if num_tokens <= 0 or before is None or after is None:
+            return
+        draft = after['draft_tokens'] - before['draft_tokens']
+        steps = after['steps'] - before['steps']
+        if draft <= 0 or steps <= 0:
+            return
+        self._observations.append({
+            'draft_tokens': draft,
+            'accepted_tokens': after['accepted_tokens'] - before['accepted_tokens'],
+            'emitted_tokens': after['emitted_tokens'] - before['emitted_tokens'],
+            # Mean proposal length: n-gram proposals can be shorter than num_tokens
+            'num_tokens': max(1, round(draft / steps)),
+            'steps': steps,
+        })
+
+    def adjust(self, num_tokens, batch_size, active):
+        """Length for the next step of a session that chose ``num_tokens``, as requests join or finish.
+
+        ``active`` is the length in effect; a change is recorded like a decision.
+        """
+        target = 0 if batch_size >= self.busy_batch_size else num_tokens
+        if target != active:
+            if target == 0:
+                reason = f"busy: batch of {batch_size} >= {self.busy_batch_size}"
+            else:
+                reason = f"batch of {batch_size} below {self.busy_batch_size}"
+            self._record(target, batch_size, reason, self.rolling_stats())
+        return target
+
+    def _record(self, num_tokens, batch_size, reason, stats):
+        decision = {
+            'time': time.time(),
+            'num_speculative_tokens': num_tokens,
+            'batch_size': batch_size,
+            'reason': reason,
+            **stats,
+        }
+        previous = self.decisions[-1]['num_speculative_tokens'] if self.decisions else None
+        self.decisions.append(decision)
+        if previous is not None and previous != num_tokens:
+            print(f"🎛️  Speculation length {previous} → {num_tokens} ({reason})")
+        if self.log_path:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(decision) + "\n")
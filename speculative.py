@@ -1,65 +1,89 @@
 # speculative.py
-from vllm import LLM, SamplingParams
-import time
+from backend import NGRAM_PROPOSER, create_engine, describe_startup_phases
+from generator_base import QwenGeneratorBase
+from contextlib import contextmanager
 
-class QwenSpeculativeGenerator:
+DEFAULT_NUM_SPECULATIVE_TOKENS = 5
+# "draft" speculates with the Qwen2.5-7B draft, "ngram" by prompt lookup (no draft model)
+PROPOSERS = ("draft", "ngram")
+DEFAULT_NGRAM_PROMPT_LOOKUP_MAX = 4
+DEFAULT_NGRAM_PROMPT_LOOKUP_MIN = 1
+
+class QwenSpeculativeGenerator(QwenGeneratorBase):
     def __init__(self, 
                  draft_model_path="./models/draft",
                  target_model_path="./models/target",
-                 num_speculative_tokens=5):
-        
-        print("🚀 Loading Qwen2.5-72B-AWQ with Speculative Decoding...")
-        print(f"   Draft: Qwen2.5-7B")
-        print(f"   Target: Qwen2.5-72B-AWQ")
-        print(f"   Speculative tokens: {num_speculative_tokens}")
-        print("This may take 2-3 minutes...")
-        
-        self.llm = LLM(
-            model=target_model_path,
-            tensor_parallel_size=1,
-            gpu_memory_utilization=0.75,  # Reduced to prevent OOM with both models
-            max_model_len=2048,  # Reduced context length for better memory efficiency
-            trust_remote_code=True,
-            quantization="awq",  # Use AWQ quantization for target model
-            dtype="auto",
-            # Speculative decoding configuration
-            speculative_model=draft_model_path,
-            num_speculative_tokens=num_speculative_tokens,
-            use_v2_block_manager=True
-        )
-        
-        self.sampling_params = SamplingParams(
-            temperature=0.7,
-            top_p=0.9,
-            max_tokens=256,
-            stop=["<|endoftext|>", "<|im_end|>"]
-        )
+                 num_speculative_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS,
+                 ngram_prompt_lookup_max=DEFAULT_NGRAM_PROMPT_LOOKUP_MAX,
+                 ngram_prompt_lookup_min=DEFAULT_NGRAM_PROMPT_LOOKUP_MIN,
+                 engine=None,
+                 controller=None,
+                 cache=None,
+                 prompt_policy="reject"):
+        """Speculative decoding; pass ``engine`` to share a target with the baseline generator.
+
+        ``controller`` (a spec_controller.AdaptiveSpeculationController)
+        picks the speculation length before every request or batch. A
+        ``draft_model_path`` of backend.NGRAM_PROPOSER speculates by prompt
+        lookup over n-grams of ``ngram_prompt_lookup_min``..``max`` tokens.
+        """
+        if engine is None:
+            print("🚀 Loading Qwen2.5-72B-AWQ with Speculative Decoding...")
+            if draft_model_path == NGRAM_PROPOSER:
+                print(f"   Proposer: n-gram prompt lookup (n={ngram_prompt_lookup_min}..{ngram_prompt_lookup_max})")
+            else:
+                print(f"   Draft: Qwen2.5-7B")
+            print(f"   Target: Qwen2.5-72B-AWQ")
+            print(f"   Speculative tokens: {num_speculative_tokens}")
+            print("This may take 2-3 minutes...")
+            
+            engine = create_engine(
+                target_model_path=target_model_path,
+                draft_model_path=draft_model_path,
+                num_speculative_tokens=num_speculative_tokens,
+                ngram_prompt_lookup_max=ngram_prompt_lookup_max,
+                ngram_prompt_lookup_min=ngram_prompt_lookup_min
+            )
+            
+            print("✅ Speculative decoding enabled!")
+            print(f"   Startup: {describe_startup_phases(engine.startup_phases)}")
+            print(f"   Expected speedup: 2.5-3.5x")
+        elif not engine.supports_speculation:
+            raise ValueError("Shared engine was built without a draft model")
         
-        print("✅ Speculative decoding enabled!")
-        print(f"   Expected speedup: 2.5-3.5x")
+        super().__init__(engine, speculative=True, cache=cache, prompt_policy=prompt_policy)
+        self.controller = controller
+        # Length the controller picked for the current session (0: none)
+        self._chosen_length = 0
     
-    def generate(self, prompt):
-        """Generate response with speculative decoding"""
-        # Format prompt for Qwen chat template
-        formatted_prompt = f"<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
-        
-        start_time = time.time()
-        outputs = self.llm.generate([formatted_prompt], self.sampling_params)
-        latency = time.time() - start_time
-        
-        output_text = outputs[0].outputs[0].text
-        num_tokens = len(outputs[0].outputs[0].token_ids)
-        
-        return {
-            'text': output_text.strip(),
-            'latency': latency,
-            'tokens': num_tokens,
-            'tokens_per_sec': num_tokens / latency if latency > 0 else 0
-        }
+    @contextmanager
+    def _session(self, batch_size=1):
+        with self.engine.session(True) as engine:
+            if self.controller is None:
+                yield engine
+                return
+            
+            num_tokens = engine.set_speculation_length(self.controller.choose(batch_size))
+            self._chosen_length = num_tokens
+            before = engine.speculation_counters()
+            try:
+                yield engine
+            finally:
+                self._chosen_length = 0
+                self.controller.observe(num_tokens, before, engine.speculation_counters())
+    
+    def _before_step(self, engine, batch_size):
+        # Requests join and finish mid-session; stop speculating while the batch is busy
+        if self.controller is None or not self._chosen_length or not engine.can_toggle_speculation:
+            return
+        active = engine.active_speculation_length
+        target = self.controller.adjust(self._chosen_length, batch_size, active)
+        if target != active:
+            engine.set_speculation_length(target)
 
 # Test
 if __name__ == "__main__":
-    gen = QwenSpeculativeGenerator(num_speculative_tokens=5)
+    gen = QwenSpeculativeGenerator(num_speculative_tokens=DEFAULT_NUM_SPECULATIVE_TOKENS)
     
     test_prompt = "Explain quantum computing in 2 sentences."
     print(f"\n{'='*70}")
@@ -0,0 +1,89 @@
+# startup.py
+import threading
+import time
+
+WARMUP_PROMPT = "Reply with one short sentence about the weather."
+
+class EnginePreloader:
+    """Builds the serving generators on a background thread and warms them up.
+
+    ``load_generators`` returns ``{mode: generator}``; engines are created
+    inside it, and their ``startup_phases`` (weight load, KV cache
+    allocation, graph capture) are collected afterwards. Each mode then
+    streams a short greedy warmup generation, timed as the
+    ``first_token_warmup`` phase. ``readiness()`` is the body of the
+    readiness endpoint.
+    """
+
+    def __init__(self, load_generators, warmup_prompt=WARMUP_PROMPT, warmup_tokens=16):
+        self.load_generators = load_generators
+        self.warmup_prompt = warmup_prompt
+        self.warmup_tokens = warmup_tokens
+        self.status = "not_started"
+        self.phases = {}
+        self.error = None
+        self.started_at = None
+        self.ready_at = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self.started_at = time.time()
+            self._thread = threading.Thread(target=self._run, name="engine-preload", daemon=True)
+            self._thread.start()
+        return self
+
+    def _record(self, phase, seconds):
+        self.phases[phase] = round(seconds, 3)
+        print(f"⏱️  Startup phase {phase}: {seconds:.2f}s")
+
+    def _run(self):
+        try:
+            self.status = "loading"
+            print("🚀 Preloading engines in the background...")
+            start = time.perf_counter()
+            generators = self.load_generators()
+            engines = {id(g.engine): g.engine for g in generators.values()}.values()
+            for engine in engines:
+                for phase, seconds in engine.startup_phases.items():
+                    self._record(phase, seconds)
+            self._record('generators_total', time.perf_counter() - start)
+
+            self.status = "warming_up"
+            for mode, gen in generators.items():
+                result = None
+                overrides = {'max_tokens': self.warmup_tokens, 'temperature': 0.0}
+                for result in gen.generate_stream(self.warmup_prompt, overrides, use_cache=False):
+                    pass
+                self._record(f'first_token_warmup_{mode}', result['ttft'])
+                self._record(f'warmup_generation_{mode}', result['latency'])
+
+            self._record('startup_total', time.perf_counter() - start)
+            self.status = "ready"
+            self.ready_at = time.time()
+            print("✅ Engines loaded and warmed up; ready for traffic")
+        except Exception as e:
+            self.status = "failed"
+            self.error = f"{type(e).__name__}: {e}"
+            print(f"❌ Engine preload failed: {self.error}")
+        finally:
+            self._ready.set()
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def wait(self, timeout=None):
+        """Block until preload finishes (or fails); returns whether it is ready"""
+        self._ready.wait(timeout)
+        return self.ready
+
+    def readiness(self):
+        return {
+            'ready': self.ready,
+            'status': self.status,
+            'phases': dict(self.phases),
+            'elapsed': round(time.time() - self.started_at, 3) if self.started_at else 0,
+            'error': self.error,
+        }
@@ -0,0 +1,61 @@
+# status_server.py
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+class StatusServer:
+    """Stdlib HTTP server next to the Gradio app for probes and scrapers.
+
+    Each route maps a path to a callable returning ``(status_code, body)``;
+    dict bodies are served as JSON, strings as plain text. Runs on a daemon
+    thread so it never holds the process open.
+    """
+
+    def __init__(self, host="0.0.0.0", port=8000):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self._server = None
+
+    def add_route(self, path, handler, content_type=None):
+        self.routes[path] = (handler, content_type)
+
+    def start(self):
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                route = routes.get(self.path.split("?", 1)[0])
+                if route is None:
+                    self.send_error(404)
+                    return
+                handler, content_type = route
+                try:
+                    status, body = handler()
+                except Exception as e:
+                    status, body = 500, {'error': str(e)}
+                if isinstance(body, (dict, list)):
+                    payload = json.dumps(body, default=str).encode()
+                    content_type = "application/json"
+                else:
+                    payload = str(body).encode()
+                    content_type = content_type or "text/plain; charset=utf-8"
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass  # Probes hit these every few seconds; keep the console readable
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name="status-server", daemon=True).start()
+        print(f"🩺 Status endpoints on http://{self.host}:{self.port} ({', '.join(sorted(self.routes))})")
+        return self
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,157 @@
+# sweep.py
+from benchmark import DEMO_PROMPTS, load_generators
+from backend import BACKEND_ENV_VAR, load_engine_config
+from bench_stats import latency_summary
+from result_store import append_record, load_store
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import time
+
+# Grid keys handled outside create_engine(); everything else is an engine argument
+GENERATOR_KEYS = ("num_speculative_tokens", "adaptive_speculation", "proposer")
+SAMPLING_KEYS = ("max_tokens", "temperature", "top_p", "top_k", "repetition_penalty")
+
+def expand_grid(grid):
+    """Every combination of a ``{name: [values]}`` grid, in a stable order"""
+    names = sorted(grid)
+    values = [grid[name] if isinstance(grid[name], list) else [grid[name]] for name in names]
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+def config_id(config, backend, prompts, engine_defaults=None):
+    """Stable identity of one measurement: resolved configuration, backend and prompt set.
+
+    ``engine_defaults`` (load_engine_config()) are resolved under the
+    config's own values, so once capacity_planner.py --apply changes them
+    the same grid point counts as a new configuration.
+    """
+    resolved = {**(engine_defaults or {}), **config}
+    key = json.dumps({'config': resolved, 'backend': backend, 'prompts': list(prompts)}, sort_keys=True)
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+def split_config(config):
+    generator_options = {k: v for k, v in config.items() if k in GENERATOR_KEYS}
+    overrides = {k: v for k, v in config.items() if k in SAMPLING_KEYS}
+    engine_config = {k: v for k, v in config.items() if k not in GENERATOR_KEYS + SAMPLING_KEYS}
+    return generator_options, overrides, engine_config
+
+def measure_config(config, prompts, repeat=1, backend=None, engine_defaults=None):
+    """Build one configuration, run the prompt set through both modes and release the engine"""
+    generator_options, overrides, engine_config = split_config(config)
+    # Pinned to the defaults the config was identified under, even if the file changes mid-sweep
+    engine_config = {**(engine_defaults or {}), **engine_config}
+    baseline, speculative = load_generators(backend=backend, engine_config=engine_config,
+                                            **generator_options)
+    try:
+        latencies = {'baseline': [], 'speculative': []}
+        tokens_per_sec = {'baseline': [], 'speculative': []}
+        speedups = []
+        for _ in range(repeat):
+            for prompt in prompts:
+                base = baseline.generate(prompt, overrides or None)
+                spec = speculative.generate(prompt, overrides or None)
+                for mode, result in (('baseline', base), ('speculative', spec)):
+                    latencies[mode].append(result['latency'])
+                    tokens_per_sec[mode].append(result['tokens_per_sec'])
+                speedups.append(base['latency'] / spec['latency'] if spec['latency'] > 0 else 0)
+
+        metrics = {'mean_speedup': round(sum(speedups) / len(speedups), 3)}
+        for mode in latencies:
+            summary = latency_summary(latencies[mode])
+            metrics[f'{mode}_latency_mean'] = round(summary['mean'], 3)
+            metrics[f'{mode}_latency_p50'] = round(summary['p50'], 3)
+            metrics[f'{mode}_latency_p99'] = round(summary['p99'], 3)
+            metrics[f'{mode}_tokens_per_sec'] = round(sum(tokens_per_sec[mode]) / len(tokens_per_sec[mode]), 1)
+        metrics['speculation'] = speculative.speculation_summary()
+        return metrics
+    finally:
+        baseline.engine.shutdown()
+
+def run_sweep(grid, prompts=DEMO_PROMPTS, store_path='qwen_sweep_results.jsonl', repeat=1,
+              retry_failed=False, backend=None):
+    """Measure every configuration in ``grid`` not already in ``store_path``.
+
+    Each finished configuration is appended (and fsynced) to the store
+    before the next starts, so an interrupted sweep resumes where it
+    stopped. Failed configurations are recorded too and skipped on resume
+    unless ``retry_failed``.
+    """
+    print("\n" + "="*80)
+    print("🎯 QWEN 2.5 CONFIGURATION SWEEP")
+    print("="*80)
+
+    backend = backend or os.environ.get(BACKEND_ENV_VAR, "vllm")
+    configs = expand_grid(grid)
+    engine_defaults = load_engine_config()
+    if engine_defaults:
+        print(f"\n⚙️  Engine defaults from the planned engine config: {json.dumps(engine_defaults, sort_keys=True)}")
+    done = {}
+    for record in load_store(store_path):
+        if record['status'] == 'ok' or not retry_failed:
+            done[record['config_id']] = record
+
+    pending = [c for c in configs if config_id(c, backend, prompts, engine_defaults) not in done]
+    print(f"\n🧮 {len(configs)} configurations, {len(configs) - len(pending)} already in {store_path}, "
+          f"{len(pending)} to run ({len(prompts)} prompts x {repeat})")
+
+    for n, config in enumerate(pending, 1):
+        cid = config_id(config, backend, prompts, engine_defaults)
+        print(f"\n{'─'*80}")
+        print(f"[{n}/{len(pending)}] {cid} {json.dumps(config, sort_keys=True)}")
+        print(f"{'─'*80}")
+        record = {'config_id': cid, 'config': config, 'engine_defaults': engine_defaults, 'backend': backend,
+                  'num_prompts': len(prompts), 'repeat': repeat, 'started_at': time.time()}
+        start = time.perf_counter()
+        try:
+            record['metrics'] = measure_config(config, prompts, repeat, backend, engine_defaults)
+            record['status'] = 'ok'
+            print(f"  ✅ Speedup {record['metrics']['mean_speedup']:.2f}x | "
+                  f"baseline {record['metrics']['baseline_latency_mean']:.2f}s, "
+                  f"speculative {record['metrics']['speculative_latency_mean']:.2f}s")
+        except Exception as e:
+            record['status'] = 'error'
+            record['error'] = f"{type(e).__name__}: {e}"
+            print(f"  ❌ {record['error']}")
+        record['elapsed'] = round(time.perf_counter() - start, 3)
+        append_record(store_path, record)
+        done[cid] = record
+
+    measured = [done[config_id(c, backend, prompts, engine_defaults)] for c in configs]
+    ok = sorted((r for r in measured if r['status'] == 'ok'),
+                key=lambda r: r['metrics']['mean_speedup'], reverse=True)
+    print("\n" + "="*80)
+    print("📊 SWEEP SUMMARY (best speedup first)")
+    print("="*80)
+    for record in ok:
+        print(f"  {record['metrics']['mean_speedup']:.2f}x  {json.dumps(record['config'], sort_keys=True)}")
+    failed = len(measured) - len(ok)
+    if failed:
+        print(f"\n⚠️  {failed} configuration(s) failed; rerun with --retry-failed to try again")
+    print(f"\n📁 Results store: {store_path}")
+
+    return measured
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Resumable sweep over engine and speculation parameters")
+    parser.add_argument("grid",
+                        help='Parameter grid as a JSON file or inline JSON, e.g. '
+                             '\'{"num_speculative_tokens": [3, 5, 7], "max_model_len": [2048, 4096]}\'')
+    parser.add_argument("--store", default="qwen_sweep_results.jsonl",
+                        help="Append-only JSONL results store; measured configurations are skipped")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="Passes over the prompt set per configuration")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Run configurations whose previous attempt failed again")
+    parser.add_argument("--backend", choices=["vllm", "sim"], default=None)
+    args = parser.parse_args()
+
+    if os.path.exists(args.grid):
+        with open(args.grid) as f:
+            grid = json.load(f)
+    else:
+        grid = json.loads(args.grid)
+
+    run_sweep(grid, store_path=args.store, repeat=args.repeat,
+              retry_failed=args.retry_failed, backend=args.backend)
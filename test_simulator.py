@@ -0,0 +1,181 @@
+# test_simulator.py
+# CPU regression tests: the generators and scheduler driven through SimulatedEngine
+import asyncio
+import pytest
+from admission import DeadlineExceeded, RequestControl, RequestShed
+from backend import NGRAM_PROPOSER
+from baseline import BaselineGenerator
+from response_cache import ResponseCache
+from scheduler import MicroBatchScheduler
+from sim_engine import SimulatedEngine
+from speculative import QwenSpeculativeGenerator
+
+PROMPTS = [
+    "Summarize the key benefits of cloud migration in 3 bullet points.",
+    "Write a professional email declining a meeting request.",
+    "What are the differences between agile and waterfall?",
+]
+
+def make_generators(cache=None, **sim_overrides):
+    engine = SimulatedEngine(draft_model_path="./models/draft", **{'time_scale': 0, **sim_overrides})
+    return (BaselineGenerator(engine=engine, cache=cache),
+            QwenSpeculativeGenerator(engine=engine, cache=cache))
+
+@pytest.fixture
+def generators():
+    return make_generators()
+
+def test_batch_results_in_order(generators):
+    baseline, _ = generators
+    batch = baseline.generate_batch(PROMPTS, {'max_tokens': 32, 'temperature': 0.0})
+    assert batch['num_prompts'] == len(PROMPTS)
+    for prompt, result in zip(PROMPTS, batch['results']):
+        single = baseline.generate(prompt, {'max_tokens': 32, 'temperature': 0.0})
+        assert result['text'] == single['text']
+        assert 0 < result['tokens'] <= 32
+    assert batch['total_tokens'] == sum(r['tokens'] for r in batch['results'])
+
+def test_baseline_and_speculative_text_match(generators):
+    baseline, speculative = generators
+    overrides = {'max_tokens': 64, 'temperature': 0.0, 'seed': 7}
+    for prompt in PROMPTS:
+        base = baseline.generate(prompt, overrides)
+        spec = speculative.generate(prompt, overrides)
+        assert base['text'] == spec['text']
+        assert base.get('speculation') is None
+        assert spec['speculation']['draft_tokens'] > 0
+
+def test_per_request_speculation_matches_engine_counters(generators):
+    _, speculative = generators
+    engine = speculative.engine
+    before = engine.speculation_counters()
+    batch = speculative.generate_batch(PROMPTS, {'max_tokens': 48, 'temperature': 0.0})
+    after = engine.speculation_counters()
+    per_request = [r['speculation'] for r in batch['results']]
+    for key in ('draft_tokens', 'steps'):
+        assert sum(s[key] for s in per_request) == after[key] - before[key]
+    assert batch['speculation']['draft_tokens'] == after['draft_tokens'] - before['draft_tokens']
+
+def test_ngram_speculation_counts_only_real_proposals():
+    engine = SimulatedEngine(draft_model_path=NGRAM_PROPOSER, time_scale=0)
+    speculative = QwenSpeculativeGenerator(engine=engine)
+    before = engine.speculation_counters()
+    batch = speculative.generate_batch(PROMPTS, {'max_tokens': 48, 'temperature': 0.0})
+    after = engine.speculation_counters()
+    drafted = sum((r.get('speculation') or {}).get('draft_tokens', 0) for r in batch['results'])
+    assert drafted == after['draft_tokens'] - before['draft_tokens']
+
+def test_deadline_aborts_and_frees_the_engine(generators):
+    baseline, _ = generators
+    with pytest.raises(DeadlineExceeded):
+        baseline.generate(PROMPTS[0], {'max_tokens': 64}, control=RequestControl(timeout=1e-9))
+    assert baseline.engine.metrics()['unfinished_requests'] == 0
+
+def test_cancel_mid_batch_returns_partial_result(generators):
+    baseline, _ = generators
+    controls = [RequestControl(), RequestControl()]
+
+    def on_update(i, output):
+        if i == 0 and len(output.outputs[0].token_ids) >= 4:
+            controls[0].cancel()
+
+    batch = baseline.generate_batch(PROMPTS[:2], {'max_tokens': 64}, on_update=on_update, controls=controls)
+    cancelled, finished = batch['results']
+    assert cancelled['aborted'] == "cancelled"
+    assert cancelled['finish_reason'] == "abort"
+    assert not finished.get('aborted')
+    assert baseline.engine.metrics()['unfinished_requests'] == 0
+
+def test_closing_a_stream_aborts_the_request(generators):
+    _, speculative = generators
+    updates = speculative.generate_stream(PROMPTS[0], {'max_tokens': 64})
+    next(updates)
+    updates.close()
+    assert speculative.engine.metrics()['unfinished_requests'] == 0
+
+def test_response_cache_hit():
+    baseline, _ = make_generators(cache=ResponseCache())
+    overrides = {'max_tokens': 32, 'temperature': 0.0}
+    first = baseline.generate(PROMPTS[0], overrides)
+    second = baseline.generate(PROMPTS[0], overrides)
+    assert not first['cache_hit'] and second['cache_hit']
+    assert second['text'] == first['text']
+
+def test_scheduler_batches_concurrent_requests(generators):
+    baseline, _ = generators
+
+    async def run():
+        scheduler = MicroBatchScheduler(baseline, max_batch_size=2)
+        try:
+            results = await asyncio.gather(*[scheduler.submit(p, {'max_tokens': 16}) for p in PROMPTS])
+            return results, scheduler.stats()
+        finally:
+            scheduler.shutdown()
+
+    results, stats = asyncio.run(run())
+    assert [r['text'] for r in results] == [baseline.generate(p, {'max_tokens': 16})['text'] for p in PROMPTS]
+    assert all(1 <= r['batch_size'] <= 2 for r in results)
+    assert stats['requests'] == len(PROMPTS)
+    assert stats['max_batch_size'] <= 2
+
+def test_scheduler_late_request_joins_running_batch():
+    baseline, _ = make_generators(time_scale=0.02)
+
+    async def run():
+        scheduler = MicroBatchScheduler(baseline)
+        finished = []
+
+        async def submit(name, prompt, max_tokens, delay=0):
+            await asyncio.sleep(delay)
+            await scheduler.submit(prompt, {'max_tokens': max_tokens})
+            finished.append(name)
+
+        try:
+            await asyncio.gather(submit('long', PROMPTS[0], 200), submit('short', PROMPTS[1], 4, delay=0.05))
+        finally:
+            scheduler.shutdown()
+        return finished
+
+    assert asyncio.run(run()) == ['short', 'long']
+
+def test_scheduler_deadline_and_shedding(generators):
+    baseline, _ = generators
+
+    async def run():
+        scheduler = MicroBatchScheduler(baseline, window_ms=50, max_queued_tokens=400)
+        try:
+            # Expires while waiting out the micro-batch window
+            with pytest.raises(DeadlineExceeded):
+                await scheduler.submit(PROMPTS[0], {'max_tokens': 64}, timeout=0.01)
+            results = await asyncio.gather(*[scheduler.submit(p, {'max_tokens': 256}) for p in PROMPTS],
+                                           return_exceptions=True)
+            return results, scheduler.stats()
+        finally:
+            scheduler.shutdown()
+
+    results, stats = asyncio.run(run())
+    assert isinstance(results[0], dict)
+    assert any(isinstance(r, RequestShed) for r in results)
+    assert stats['shed'].get('token_budget')
+    assert stats['aborted'] == {'deadline': 1}
+    assert stats['queued_tokens'] == 0
+
+def test_scheduler_cancel_before_start(generators):
+    baseline, _ = generators
+
+    async def run():
+        scheduler = MicroBatchScheduler(baseline, window_ms=50)
+        try:
+            task = asyncio.ensure_future(scheduler.submit(PROMPTS[0], {'max_tokens': 32}))
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            await asyncio.sleep(0.1)
+            return scheduler.stats()
+        finally:
+            scheduler.shutdown()
+
+    stats = asyncio.run(run())
+    assert stats['aborted'] == {'cancelled': 1}
+    assert stats['queued_tokens'] == 0
@@ -0,0 +1,549 @@
+# worker_pool.py
+from admission import DeadlineExceeded, RequestCancelled, RequestShed
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+import asyncio
+import atexit
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+MODES = ("baseline", "speculative")
+LAYOUTS = ("shared", "isolated")
+MAX_CHAT_SESSIONS = 256
+# How often a cancellable wait for a worker reply checks whether its caller gave up
+CANCEL_POLL_INTERVAL = 0.1
+
+class WorkerUnavailable(RuntimeError):
+    """The worker for a mode is starting, restarting or has died"""
+
+class RemoteError(RuntimeError):
+    """An exception raised inside a worker, re-raised in the front end"""
+
+    def __init__(self, error_type, message):
+        super().__init__(message)
+        self.error_type = error_type
+
+def _remote_error(error_type, *args):
+    """Rebuild admission errors from a worker as themselves, so callers handle them the same either way"""
+    if error_type == "RequestShed":
+        return RequestShed(*args)
+    if error_type == "DeadlineExceeded":
+        return DeadlineExceeded(*args)
+    if error_type == "RequestCancelled":
+        return RequestCancelled(*args)
+    return RemoteError(error_type, *args)
+
+# ---------------------------------------------------------------- worker process side
+
+def _build_generators(spec):
+    from benchmark import load_generators
+    from response_cache import cache_from_env
+    cache = cache_from_env()
+    options = dict(spec.get('generator_options') or {}, backend=spec.get('backend'),
+                   engine_config=spec.get('engine_config'), cache=cache,
+                   prompt_policy=spec.get('prompt_policy', "reject"))
+    if spec['modes'] == ["baseline"]:
+        # Nothing here speculates, so the draft is never loaded
+        options['engine_config'] = dict(options['engine_config'] or {}, draft_model_path=None)
+        from backend import create_engine
+        from baseline import BaselineGenerator
+        engine = create_engine(options['backend'], **{'target_model_path': "./models/target",
+                                                      **options['engine_config']})
+        return {'baseline': BaselineGenerator(engine=engine, cache=cache, prompt_policy=options['prompt_policy'])}
+    baseline, speculative = load_generators(**options)
+    generators = {'baseline': baseline, 'speculative': speculative}
+    return {mode: generators[mode] for mode in spec['modes']}
+
+async def _handle(send, op, request_id, payload, generators, schedulers, sessions):
+    from chat import ChatSession
+    from metrics import REGISTRY
+    try:
+        if op == 'ping':
+            send(('ok', request_id, {'pid': os.getpid(),
+                                     'schedulers': {m: s.stats() for m, s in schedulers.items()}}))
+        elif op == 'metrics':
+            send(('ok', request_id, REGISTRY.render()))
+        elif op == 'speculation_summary':
+            send(('ok', request_id, generators[payload['mode']].speculation_summary()))
+        elif op == 'generate':
+            result = await schedulers[payload['mode']].submit(payload['prompt'], payload.get('overrides'),
+                                                              payload.get('timeout'))
+            send(('ok', request_id, result))
+        elif op == 'stream':
+            # aclosing(): a 'cancel' closes the scheduler stream right away, aborting the engine request
+            async with aclosing(schedulers[payload['mode']].stream(
+                    payload['prompt'], payload.get('overrides'), payload.get('timeout'))) as updates:
+                async for update in updates:
+                    send(('update', request_id, update))
+        elif op == 'chat':
+            mode = payload['mode']
+            key = (payload['session_id'], mode)
+            session = sessions.get(key)
+            if session is None or len(session.messages) != len(payload['history']):
+                # New, evicted or lost in a restart: rebuild from the front end's copy of the history
+                session = ChatSession(generators[mode], messages=payload['history'])
+            sessions[key] = session
+            sessions.move_to_end(key)
+            while len(sessions) > MAX_CHAT_SESSIONS:
+                sessions.popitem(last=False)
+            async with aclosing(session.stream(payload['message'], schedulers[mode], payload.get('overrides'),
+                                               payload.get('timeout'))) as updates:
+                async for update in updates:
+                    if update['finished']:
+                        update = dict(update, summary=session.summary())
+                    send(('update', request_id, update))
+        else:
+            raise ValueError(f"Unknown worker op: {op!r}")
+    except RequestShed as e:
+        send(('error', request_id, ("RequestShed", e.reason, e.projected_wait)))
+    except Exception as e:
+        send(('error', request_id, (type(e).__name__, str(e))))
+
+async def _serve(conn, generators, scheduler_options=None):
+    from metrics import register_scheduler_gauges
+    from scheduler import MicroBatchScheduler
+    loop = asyncio.get_running_loop()
+    scheduler_options = {'window_ms': 5, 'max_batch_size': 32, **(scheduler_options or {})}
+    schedulers = {mode: MicroBatchScheduler(gen, **scheduler_options) for mode, gen in generators.items()}
+    # Queue gauges in this worker's registry, merged into the front end's /metrics
+    register_scheduler_gauges(schedulers)
+    sessions = OrderedDict()
+    tasks = {}
+    send = conn.send  # Only called from this event loop's thread
+    while True:
+        try:
+            op, request_id, payload = await loop.run_in_executor(None, conn.recv)
+        except (EOFError, OSError):
+            break  # Front end went away
+        if op == 'shutdown':
+            break
+        if op == 'cancel':
+            # The front end gave up on request_id: cancelling its task aborts it in the scheduler
+            task = tasks.get(request_id)
+            if task is not None:
+                task.cancel()
+            continue
+        task = loop.create_task(_handle(send, op, request_id, payload, generators, schedulers, sessions))
+        tasks[request_id] = task
+        task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+    for scheduler in schedulers.values():
+        scheduler.shutdown()
+
+def _worker_main(conn, spec):
+    """Entry point of a worker process: build the generators, then serve requests from ``conn``"""
+    os.environ.update(spec.get('env') or {})
+    try:
+        generators = _build_generators(spec)
+    except Exception as e:
+        conn.send(('failed', None, f"{type(e).__name__}: {e}"))
+        return
+    engines = {id(g.engine): g.engine for g in generators.values()}.values()
+    conn.send(('ready', None, {'pid': os.getpid(), 'modes': list(generators),
+                               'startup_phases': [dict(e.startup_phases) for e in engines]}))
+    asyncio.run(_serve(conn, generators, spec.get('scheduler_options')))
+
+# ---------------------------------------------------------------- front end side
+
+class GeneratorWorker:
+    """One worker process hosting the generators for ``spec['modes']``.
+
+    Requests are ``(op, request_id, payload)`` tuples over a pipe; the
+    worker answers with ``ok``/``error`` or a series of ``update``
+    messages, so many requests are in flight at once and are micro-batched
+    inside the worker. A reader thread routes replies to the waiting
+    callers; when the process dies every pending request fails with
+    WorkerUnavailable.
+    """
+
+    def __init__(self, name, spec):
+        self.name = name
+        self.spec = spec
+        self.status = "stopped"
+        self.error = None
+        self.info = {}
+        self.restarts = 0
+        self.started_at = None
+        # Set by WorkerPool while a failed worker waits out its retry backoff
+        self.retry_at = None
+        self._process = None
+        self._conn = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._ready = threading.Event()
+
+    def start(self):
+        # spawn: CUDA cannot be initialised in a forked child
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(target=_worker_main, args=(child_conn, self.spec),
+                                  name=f"qwen-worker-{self.name}")
+        with self._lock:
+            self.status = "starting"
+            self.error = None
+            self.started_at = time.time()
+            self._ready = threading.Event()
+            self._pending = {}
+            process.start()
+            child_conn.close()
+            self._process, self._conn = process, parent_conn
+        threading.Thread(target=self._read_loop, args=(process, parent_conn, self._pending, self._ready),
+                         name=f"qwen-worker-{self.name}-reader", daemon=True).start()
+        return self
+
+    def _read_loop(self, process, conn, pending, ready):
+        try:
+            while True:
+                kind, request_id, payload = conn.recv()
+                if kind == 'ready':
+                    self.info, self.status = payload, "ready"
+                    print(f"✅ Worker {self.name} ready (pid {payload['pid']}, modes {', '.join(payload['modes'])})")
+                    ready.set()
+                elif kind == 'failed':
+                    self.status, self.error = "failed", payload
+                    print(f"❌ Worker {self.name} failed to start: {payload}")
+                    ready.set()
+                elif request_id in pending:
+                    pending[request_id].put((kind, payload))
+        except (EOFError, OSError):
+            pass
+        process.join(timeout=1)
+        with self._lock:
+            if conn is self._conn and self.status in ("starting", "ready"):
+                self.status = "dead"
+                self.error = f"exit code {process.exitcode}"
+                print(f"💥 Worker {self.name} died ({self.error})")
+        for replies in list(pending.values()):
+            replies.put(('crashed', None))
+        ready.set()
+
+    @property
+    def alive(self):
+        return self._process is not None and self._process.is_alive()
+
+    def wait_ready(self, timeout=None):
+        self._ready.wait(timeout)
+        return self.status == "ready"
+
+    def _exchange(self, op, payload, timeout=None, cancelled=None):
+        """Send one request and yield ``(kind, payload)`` replies until it completes.
+
+        Setting the ``cancelled`` event, or closing the generator early,
+        tells the worker to cancel the request.
+        """
+        with self._lock:
+            if self.status != "ready":
+                raise WorkerUnavailable(f"{self.name} worker is {self.status}"
+                                        + (f": {self.error}" if self.error else ""))
+            request_id = next(self._ids)
+            pending = self._pending
+            replies = pending[request_id] = queue.Queue()
+            try:
+                self._conn.send((op, request_id, payload))
+            except (OSError, ValueError) as e:
+                pending.pop(request_id, None)
+                raise WorkerUnavailable(f"{self.name} worker pipe is closed: {e}")
+        give_up = None if timeout is None else time.monotonic() + timeout
+        completed = False
+        try:
+            while True:
+                wait = timeout
+                if cancelled is not None:
+                    if cancelled.is_set():
+                        raise RequestCancelled()
+                    wait = CANCEL_POLL_INTERVAL if give_up is None else min(
+                        CANCEL_POLL_INTERVAL, max(give_up - time.monotonic(), 0))
+                try:
+                    kind, data = replies.get(timeout=wait)
+                except queue.Empty:
+                    if give_up is None or time.monotonic() < give_up:
+                        continue
+                    raise TimeoutError(f"{self.name} worker did not answer {op!r} within {timeout}s")
+                if kind in ('crashed', 'error'):
+                    completed = True
+                if kind == 'crashed':
+                    raise WorkerUnavailable(f"{self.name} worker died while serving the request")
+                if kind == 'error':
+                    raise _remote_error(*data)
+                yield kind, data
+                if kind == 'ok' or data.get('finished'):
+                    completed = True
+                    return
+        finally:
+            pending.pop(request_id, None)
+            if not completed:
+                self._cancel(request_id)
+
+    def _cancel(self, request_id):
+        with self._lock:
+            if self.status != "ready":
+                return
+            try:
+                self._conn.send(('cancel', request_id, None))
+            except (OSError, ValueError):
+                pass
+
+    def request(self, op, payload=None, timeout=None, cancelled=None):
+        for _, data in self._exchange(op, payload or {}, timeout, cancelled):
+            return data
+
+    def stream(self, op, payload, cancelled=None):
+        for _, data in self._exchange(op, payload, cancelled=cancelled):
+            yield data
+
+    def ping(self, timeout=5):
+        return self.request('ping', timeout=timeout)
+
+    def stop(self, timeout=10):
+        with self._lock:
+            process, conn = self._process, self._conn
+            self.status = "stopped"
+        if process is None:
+            return
+        try:
+            conn.send(('shutdown', None, None))
+        except (OSError, ValueError):
+            pass
+        process.join(timeout)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        conn.close()
+
+    def restart(self):
+        self.stop(timeout=5)
+        self.restarts += 1
+        print(f"🔁 Restarting worker {self.name} (restart #{self.restarts})")
+        return self.start()
+
+    def stats(self):
+        return {'status': self.status, 'pid': self.info.get('pid') if self.status == "ready" else None,
+                'modes': self.spec['modes'], 'restarts': self.restarts, 'error': self.error,
+                'retry_in': round(max(self.retry_at - time.time(), 0), 1) if self.retry_at else None,
+                'in_flight': len(self._pending)}
+
+class RemoteScheduler:
+    """MicroBatchScheduler-shaped async front for one mode of a WorkerPool"""
+
+    def __init__(self, pool, mode):
+        self.pool = pool
+        self.mode = mode
+
+    async def submit(self, prompt, sampling_overrides=None, timeout=None):
+        worker = self.pool.worker_for(self.mode)
+        payload = {'mode': self.mode, 'prompt': prompt, 'overrides': sampling_overrides, 'timeout': timeout}
+        cancelled = threading.Event()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool._executor, lambda: worker.request('generate', payload, cancelled=cancelled))
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    def stream(self, prompt, sampling_overrides=None, timeout=None):
+        return self.pool.astream(self.mode, 'stream', {
+            'mode': self.mode, 'prompt': prompt, 'overrides': sampling_overrides, 'timeout': timeout})
+
+    def stats(self):
+        return self.pool.worker_for(self.mode).stats()
+
+class RemoteGenerator:
+    """Blocking generate() and speculation_summary() for one mode, as the benchmark uses them"""
+
+    def __init__(self, pool, mode):
+        self.pool = pool
+        self.mode = mode
+
+    def generate(self, prompt, sampling_overrides=None):
+        return self.pool.worker_for(self.mode).request('generate', {
+            'mode': self.mode, 'prompt': prompt, 'overrides': sampling_overrides})
+
+    def speculation_summary(self):
+        return self.pool.worker_for(self.mode).request('speculation_summary', {'mode': self.mode})
+
+class WorkerPool:
+    """Generator modes hosted in worker processes, health-checked and restarted when they die.
+
+    ``layout="shared"`` runs one worker with both modes on one shared
+    engine (one GPU, as in-process). ``"isolated"`` runs one worker per
+    mode, each with its own engine (the baseline one without the draft),
+    so the modes run truly concurrently; ``devices`` maps modes to
+    CUDA_VISIBLE_DEVICES values to put them on separate GPUs. Either way an
+    engine crash or OOM only takes down its worker: the monitor thread
+    pings each worker every ``health_interval`` seconds and restarts one
+    that has exited or missed ``max_missed_pings`` pings in a row. A
+    worker that failed to start is retried after ``health_interval``
+    seconds, doubling per consecutive failure up to ``max_retry_backoff``.
+    """
+
+    def __init__(self, layout="shared", backend=None, engine_config=None, generator_options=None,
+                 prompt_policy="reject", devices=None, health_interval=5, max_missed_pings=3, scheduler_options=None,
+                 max_retry_backoff=300):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown worker layout: {layout!r} (expected one of {', '.join(LAYOUTS)})")
+        self.layout = layout
+        self.health_interval = health_interval
+        self.max_missed_pings = max_missed_pings
+        self.max_retry_backoff = max_retry_backoff
+        base = {'backend': backend, 'engine_config': engine_config, 'generator_options': generator_options,
+                'prompt_policy': prompt_policy, 'scheduler_options': scheduler_options}
+        if layout == "shared":
+            self.workers = {'engine': GeneratorWorker('engine', {**base, 'modes': list(MODES)})}
+            self._routes = {mode: 'engine' for mode in MODES}
+        else:
+            self.workers = {}
+            for mode in MODES:
+                env = {'CUDA_VISIBLE_DEVICES': str(devices[mode])} if devices and mode in devices else {}
+                self.workers[mode] = GeneratorWorker(mode, {**base, 'modes': [mode], 'env': env})
+            self._routes = {mode: mode for mode in MODES}
+        self._missed = {name: 0 for name in self.workers}
+        self._failures = {name: 0 for name in self.workers}
+        # Each in-flight request blocks one thread on its reply queue
+        self._executor = ThreadPoolExecutor(max_workers=256, thread_name_prefix="worker-io")
+        self._stop = threading.Event()
+        self._monitor = None
+
+    @property
+    def concurrent(self):
+        """Whether the two modes run in parallel rather than taking turns on one engine"""
+        return self.layout == "isolated"
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+        self._monitor = threading.Thread(target=self._monitor_loop, name="worker-monitor", daemon=True)
+        self._monitor.start()
+        atexit.register(self.shutdown)
+        return self
+
+    def wait_ready(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in self.workers.values():
+            remaining = None if deadline is None else max(deadline - time.time(), 0)
+            if not worker.wait_ready(remaining):
+                return False
+        return True
+
+    @property
+    def ready(self):
+        return all(w.status == "ready" for w in self.workers.values())
+
+    def readiness(self):
+        return {'ready': self.ready, 'layout': self.layout,
+                'workers': {name: w.stats() for name, w in self.workers.items()},
+                'failed': {name: w.error for name, w in self.workers.items() if w.status == "failed"},
+                'startup_phases': {name: w.info.get('startup_phases') for name, w in self.workers.items()}}
+
+    def worker_for(self, mode):
+        return self.workers[self._routes[mode]]
+
+    def scheduler(self, mode):
+        return RemoteScheduler(self, mode)
+
+    def generator(self, mode):
+        return RemoteGenerator(self, mode)
+
+    async def astream(self, mode, op, payload):
+        """Relay a streaming worker request into the event loop"""
+        loop = asyncio.get_running_loop()
+        updates = asyncio.Queue()
+        worker = self.worker_for(mode)
+
+        cancelled = threading.Event()
+
+        def pump():
+            try:
+                for update in worker.stream(op, payload, cancelled=cancelled):
+                    loop.call_soon_threadsafe(updates.put_nowait, ('update', update))
+            except Exception as e:
+                loop.call_soon_threadsafe(updates.put_nowait, ('error', e))
+
+        loop.run_in_executor(self._executor, pump)
+        try:
+            while True:
+                kind, item = await updates.get()
+                if kind == 'error':
+                    raise item
+                yield item
+                if item['finished']:
+                    return
+        finally:
+            # Stopped reading early: the pump tells the worker to cancel (a no-op once finished)
+            cancelled.set()
+
+    def chat(self, mode, session_id, history, message, sampling_overrides=None, timeout=None):
+        """Stream one chat turn; the worker keeps the session (and rebuilds it from ``history`` if lost)"""
+        return self.astream(mode, 'chat', {'mode': mode, 'session_id': session_id, 'history': history,
+                                           'message': message, 'overrides': sampling_overrides,
+                                           'timeout': timeout})
+
+    def _retry_failed(self, name, worker):
+        # Startup errors are often transient (GPU still held, OOM); back off instead of giving up
+        if worker.retry_at is None:
+            self._failures[name] += 1
+            delay = min(self.health_interval * 2 ** (self._failures[name] - 1), self.max_retry_backoff)
+            worker.retry_at = time.time() + delay
+            print(f"⏳ Retrying worker {name} in {delay:.1f}s (failure #{self._failures[name]}: {worker.error})")
+        elif time.time() >= worker.retry_at:
+            worker.retry_at = None
+            worker.restart()
+
+    def _monitor_loop(self):
+        while not self._stop.wait(self.health_interval):
+            for name, worker in self.workers.items():
+                if self._stop.is_set() or worker.status in ("starting", "stopped"):
+                    continue
+                if worker.status == "failed":
+                    self._retry_failed(name, worker)
+                    continue
+                if worker.status == "dead" or not worker.alive:
+                    worker.restart()
+                    self._missed[name] = 0
+                    continue
+                try:
+                    worker.ping(timeout=self.health_interval)
+                    self._missed[name] = 0
+                    self._failures[name] = 0
+                except (TimeoutError, WorkerUnavailable):
+                    self._missed[name] += 1
+                    if self._missed[name] >= self.max_missed_pings:
+                        print(f"⚠️  Worker {name} missed {self._missed[name]} health checks")
+                        worker.error = "unresponsive"
+                        worker.restart()
+                        self._missed[name] = 0
+
+    def metrics_text(self):
+        """Prometheus text from every worker, merged per metric family"""
+        families = OrderedDict()
+        for worker in self.workers.values():
+            try:
+                text = worker.request('metrics', timeout=5)
+            except (TimeoutError, WorkerUnavailable, RemoteError):
+                continue
+            name = None
+            for line in text.splitlines():
+                if line.startswith("# HELP "):
+                    name = line.split()[2]
+                    families.setdefault(name, [line, None, []])
+                elif line.startswith("# TYPE "):
+                    families[name][1] = line
+                elif line:
+                    families[name][2].append(line)
+        lines = []
+        for help_line, type_line, samples in families.values():
+            lines += [help_line, type_line] + samples
+        return "\n".join(lines) + "\n"
+
+    def stats(self):
+        return {name: worker.stats() for name, worker in self.workers.items()}
+
+    def shutdown(self):
+        self._stop.set()
+        for worker in self.workers.values():
+            worker.stop()
+        self._executor.shutdown(wait=False)